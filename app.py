@@ -1,18 +1,36 @@
+import asyncio
 import base64
-import mimetypes
+import binascii
+import contextvars
+import gzip
 import os
 import io
-from typing import Optional, List
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, StreamingResponse
+from typing import Optional, List, Literal
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse, Response, FileResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 import uvicorn
 from datetime import datetime
 import json
+import random
+import ssl
 import time
+import hashlib
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, deque
+import certifi
+import httpx
+
+try:
+    import brotli
+except ImportError:  # Optional; without it only gzip variants of static files are built
+    brotli = None
 
 app = FastAPI()
 
@@ -37,1122 +55,3221 @@ AVAILABLE_MODELS = [
     "gemini-2.0-flash-exp"
 ]
 
-# Track current API key index and failed keys
-current_key_index = 0
-failed_keys = set()
-last_key_rotation = time.time()
+# Per-model metadata; history_token_budget caps the prior turns sent with each request
+MODEL_METADATA = {
+    "gemini-2.5-flash-image-preview": {
+        "history_token_budget": 4000, "max_image_dimension": 1024, "response_cache_ttl": 86400, "max_concurrency": 8
+    },
+    "gemini-2.5-pro": {
+        "history_token_budget": 8000, "max_image_dimension": 2048, "response_cache_ttl": 3600, "max_concurrency": 16
+    },
+    "gemini-2.5-flash": {
+        "history_token_budget": 16000, "max_image_dimension": 1536, "response_cache_ttl": 3600, "max_concurrency": 32
+    },
+    "gemini-2.0-flash-exp": {
+        "history_token_budget": 16000, "max_image_dimension": 1536, "response_cache_ttl": 3600, "max_concurrency": 32
+    }
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 8000
+# Longest image edge (pixels) the browser uploads; larger images are downscaled first
+DEFAULT_MAX_IMAGE_DIMENSION = int(os.environ.get("DEFAULT_MAX_IMAGE_DIMENSION", "1536"))
+
+# Fold turns that no longer fit the history budget into a rolling summary, generated
+# in the background with a fast model
+HISTORY_SUMMARY_ENABLED = os.environ.get("HISTORY_SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", "gemini-2.5-flash")
+
+# Optional override for the Gemini API endpoint, e.g. a local stub server
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+# HTTP connection pool limits for each per-key Gemini client
+GEMINI_MAX_CONNECTIONS = int(os.environ.get("GEMINI_MAX_CONNECTIONS", "100"))
+GEMINI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("GEMINI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.environ.get("GEMINI_KEEPALIVE_EXPIRY", "60"))
+
+# Long-lived Gemini clients keyed by API key index, so connections and TLS sessions are reused
+gemini_clients = {}
+ssl_context = None
+
+# Upstream responses opened by the generation attempt running in the current task
+attempt_responses = contextvars.ContextVar("attempt_responses", default=None)
+
+async def track_upstream_response(response: httpx.Response):
+    """Hand each upstream response to the attempt that opened it, which closes it"""
+    responses = attempt_responses.get()
+    if responses is not None:
+        responses.append(response)
 
-def get_working_client():
-    """Get a working Gemini client, rotating through API keys if needed"""
-    global current_key_index, failed_keys, last_key_rotation
+def get_client(key_index):
+    """Get the shared Gemini client for an API key, creating it on first use"""
+    global ssl_context
     
-    # Reset failed keys every hour
-    if time.time() - last_key_rotation > 3600:
-        failed_keys = set()
-        last_key_rotation = time.time()
+    client = gemini_clients.get(key_index)
+    if client is not None:
+        return client
     
-    # Try to find a working key
-    attempts = 0
-    while attempts < len(API_KEYS):
-        if current_key_index not in failed_keys:
-            try:
-                client = genai.Client(api_key=API_KEYS[current_key_index])
-                return client, current_key_index
-            except Exception as e:
-                print(f"API key {current_key_index} failed during initialization: {str(e)}")
-                failed_keys.add(current_key_index)
-        
-        # Move to next key
-        current_key_index = (current_key_index + 1) % len(API_KEYS)
-        attempts += 1
+    # Loading the CA bundle is slow, so build one SSL context and share it across clients
+    if ssl_context is None:
+        ssl_context = ssl.create_default_context(
+            cafile=os.environ.get("SSL_CERT_FILE", certifi.where()),
+            capath=os.environ.get("SSL_CERT_DIR")
+        )
+    
+    client_args = {
+        "verify": ssl_context,
+        "limits": httpx.Limits(
+            max_connections=GEMINI_MAX_CONNECTIONS,
+            max_keepalive_connections=GEMINI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY
+        )
+    }
+    client = genai.Client(
+        api_key=API_KEYS[key_index],
+        http_options=types.HttpOptions(
+            base_url=GEMINI_BASE_URL,
+            client_args=client_args,
+            async_client_args={**client_args, "event_hooks": {"response": [track_upstream_response]}}
+        )
+    )
+    gemini_clients[key_index] = client
+    return client
+
+# Free-tier quotas per model and API key: requests and tokens per minute
+MODEL_RATE_LIMITS = {
+    "gemini-2.5-flash-image-preview": {"rpm": 10, "tpm": 200000},
+    "gemini-2.5-pro": {"rpm": 5, "tpm": 250000},
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250000},
+    "gemini-2.0-flash-exp": {"rpm": 10, "tpm": 250000}
+}
+DEFAULT_RATE_LIMIT = {"rpm": 10, "tpm": 250000}
+
+# Overall request rate per API key across all models
+KEY_RPM_LIMIT = float(os.environ.get("KEY_RPM_LIMIT", "60"))
+
+# Cooldown after a 429 that doesn't say when to retry; each one lasts a random time
+# between half and all of it, so keys rate limited together don't return together
+RATE_LIMIT_COOLDOWN = float(os.environ.get("RATE_LIMIT_COOLDOWN", "20"))
+
+# Failing keys back off exponentially from the base up to the max cooldown
+FAILURE_COOLDOWN_BASE = float(os.environ.get("FAILURE_COOLDOWN_BASE", "5"))
+FAILURE_COOLDOWN_MAX = float(os.environ.get("FAILURE_COOLDOWN_MAX", "3600"))
+
+# How long a request may wait for a key to have quota before giving up
+KEY_WAIT_TIMEOUT = float(os.environ.get("KEY_WAIT_TIMEOUT", "10"))
+
+# Output tokens assumed when reserving TPM quota, corrected once usage is known
+ESTIMATED_OUTPUT_TOKENS = 1000
+# Gemini bills each input image at a flat token count
+IMAGE_TOKENS = 258
+
+# Consecutive transient failures that open a key+model circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+
+# Conversation history limits; idle conversations expire after the TTL (seconds)
+MAX_CONVERSATIONS = int(os.environ.get("MAX_CONVERSATIONS", "10000"))
+CONVERSATION_TTL = float(os.environ.get("CONVERSATION_TTL", "3600"))
+CONVERSATION_MEMORY_BUDGET = int(os.environ.get("CONVERSATION_MEMORY_BUDGET", str(256 * 1024 * 1024)))
+MAX_TURNS_PER_CONVERSATION = int(os.environ.get("MAX_TURNS_PER_CONVERSATION", "50"))
+# Approximate bookkeeping cost of stored objects, counted against the memory budget
+CONVERSATION_OVERHEAD_BYTES = 200
+TURN_OVERHEAD_BYTES = 150
+IMAGE_REF_BYTES = 120
+
+# Content-addressed image blobs: recently used ones are kept in memory, all of them on
+# disk under BLOB_DIR (set it empty to keep blobs in memory only)
+BLOB_DIR = os.environ.get("BLOB_DIR", os.path.join("uploads", "blobs"))
+BLOB_MEMORY_BUDGET = int(os.environ.get("BLOB_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+BLOB_DISK_BUDGET = int(os.environ.get("BLOB_DISK_BUDGET", str(1024 * 1024 * 1024)))
+BLOB_MAX_BYTES = int(os.environ.get("BLOB_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Raster image types accepted from clients, with the extension blobs of each type are
+# stored under; anything else (SVG in particular, which can carry scripts) is refused
+IMAGE_TYPES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "image/heic": ".heic",
+    "image/avif": ".avif"
+}
+IMAGE_TYPES_BY_EXTENSION = {extension: mime_type for mime_type, extension in IMAGE_TYPES.items()}
+# Nonstandard names clients send for allowed types
+IMAGE_TYPE_ALIASES = {"image/jpg": "image/jpeg", "image/pjpeg": "image/jpeg", "image/x-png": "image/png"}
+
+# Opt-in exact-match cache of complete responses, keyed by everything sent to the model.
+# Only temperature 0 requests are cached unless sampled responses are explicitly allowed
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_ALLOW_SAMPLED = os.environ.get("RESPONSE_CACHE_ALLOW_SAMPLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MEMORY_BUDGET = int(os.environ.get("RESPONSE_CACHE_MEMORY_BUDGET", str(32 * 1024 * 1024)))
+# Set a directory to also keep entries on disk, across restarts
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_BUDGET = int(os.environ.get("RESPONSE_CACHE_DISK_BUDGET", str(256 * 1024 * 1024)))
+# Entry lifetime (seconds) for models without a response_cache_ttl in MODEL_METADATA
+DEFAULT_RESPONSE_CACHE_TTL = float(os.environ.get("DEFAULT_RESPONSE_CACHE_TTL", "3600"))
+
+# Attach concurrent identical requests to one upstream generation instead of
+# spending quota on each
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "true").lower() in ("1", "true", "yes")
+
+# Background jobs: worker tasks running queued generations, how many jobs may wait,
+# and how long (seconds) finished jobs and their results are kept
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "1000"))
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "3600"))
+MAX_FINISHED_JOBS = int(os.environ.get("MAX_FINISHED_JOBS", "10000"))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+# Admission control: concurrent generations per model (max_concurrency in MODEL_METADATA,
+# else the default), how many more may queue, and how long (seconds) they may wait
+ADMISSION_DEFAULT_CONCURRENCY = int(os.environ.get("ADMISSION_DEFAULT_CONCURRENCY", "16"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Opt-in AIMD: shrink the limit on 429s or time-to-first-token above the target, and
+# grow it back while requests are healthy
+ADMISSION_ADAPTIVE = os.environ.get("ADMISSION_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+ADMISSION_TARGET_LATENCY = float(os.environ.get("ADMISSION_TARGET_LATENCY", "5"))
+ADMISSION_MIN_CONCURRENCY = 1
+ADMISSION_DECREASE_FACTOR = 0.7
+ADMISSION_SAMPLE_SIZE = 200
+
+# Workload lanes sharing admission: slots are split between waiting lanes in
+# proportion to weight (measured in reserved tokens), and each lane has a cap on
+# concurrent generations across all models
+WORKLOAD_LANES = {
+    "text": {"weight": 6, "max_concurrency": 64},
+    "vision": {"weight": 3, "max_concurrency": 24},
+    "image_output": {"weight": 1, "max_concurrency": 6}
+}
+
+# Sampling temperature when the request doesn't set one
+DEFAULT_TEMPERATURE = 0.7
+
+# Frontend sources, and where their fingerprinted and precompressed copies are built
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_BUILD_DIR = os.path.join(STATIC_DIR, "build")
+# Files referenced from index.html, served under content-hashed names
+STATIC_ASSETS = ["app.css", "app.js"]
+# Smaller files aren't worth compressing
+STATIC_MIN_COMPRESS_BYTES = 1024
+
+# Base64 image payloads larger than this (in characters) are decoded off the event loop
+INLINE_DECODE_LIMIT = 256 * 1024
+
+# Most keys a single request tries before giving up
+MAX_KEY_ATTEMPTS = int(os.environ.get("MAX_KEY_ATTEMPTS", "3"))
+
+# Opt-in request hedging: if no chunk has arrived by the given percentile of recent
+# time-to-first-token, race a second attempt on another key
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+# Hedges may add at most this fraction of extra upstream requests
+HEDGE_MAX_EXTRA_LOAD = float(os.environ.get("HEDGE_MAX_EXTRA_LOAD", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAMPLE_SIZE = 200
+
+# When a stream breaks after output was sent, continue from the partial text on
+# another key (at most this many times per request) instead of failing
+RESUME_MAX_ATTEMPTS = int(os.environ.get("RESUME_MAX_ATTEMPTS", "2"))
+# Continuation text is held back until this many characters arrived, so a restated
+# tail can be trimmed; overlaps shorter than the minimum are left alone
+RESUME_MAX_OVERLAP = 200
+RESUME_MIN_OVERLAP = 4
+
+# Error kinds returned by classify_error
+ERROR_QUOTA = "quota"
+ERROR_AUTH = "auth"
+ERROR_TRANSIENT = "transient"
+ERROR_CLIENT = "client"
+
+# Status recorded for requests whose client disconnected first (nginx's convention)
+CLIENT_CLOSED_REQUEST = 499
+
+# Histogram bucket bounds: latencies in seconds, upstream calls per request, and
+# streamed chunks per call
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+METRICS_ATTEMPT_BUCKETS = (1, 2, 3, 4, 5, 8)
+METRICS_CHUNK_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Chat requests slower than this (seconds) are logged with their stage timings as
+# one JSON line; 0 disables the log
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", "10"))
+
+# Set a file to append the shape and upstream timing of every chat request to, for
+# replay.py; prompts and images themselves are never written
+TRAFFIC_RECORD_FILE = os.environ.get("TRAFFIC_RECORD_FILE", "")
+
+class RateWindow:
+    """Per-minute limit enforced over a sliding 60 second window, the way the API
+    counts it, so no 60 seconds ever carry more than the limit"""
+    
+    def __init__(self, per_minute: float):
+        self.limit = per_minute
+        self.entries = deque()  # [monotonic time, amount], oldest first
+        self.used = 0.0
+    
+    def expire(self, now: float):
+        while self.entries and now - self.entries[0][0] >= 60:
+            _, amount = self.entries.popleft()
+            self.used -= amount
+    
+    def available(self, now: float) -> float:
+        self.expire(now)
+        return self.limit - self.used
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until the window has room for the given amount"""
+        self.expire(now)
+        # Requests larger than the limit only wait for the window to empty
+        excess = self.used + min(amount, self.limit) - self.limit
+        if excess <= 0:
+            return 0.0
+        for started, freed in self.entries:
+            excess -= freed
+            if excess <= 0:
+                return started + 60 - now
+        return 0.0
+    
+    def consume(self, amount: float, now: float):
+        self.expire(now)
+        if amount > 0:
+            self.entries.append([now, amount])
+            self.used += amount
+            return
+        # Refunds of overestimates come off the newest entries, which they belong to
+        refund = -amount
+        for entry in reversed(self.entries):
+            if refund <= 0:
+                break
+            taken = min(entry[1], refund)
+            entry[1] -= taken
+            self.used -= taken
+            refund -= taken
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker for one model on one API key
+    
+    Opens after BREAKER_FAILURE_THRESHOLD consecutive transient failures. Once
+    BREAKER_RESET_TIMEOUT has passed it goes half-open and lets exactly one probe
+    request through; the probe's result closes or re-opens the circuit.
+    """
+    
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+    
+    def wait_time(self, now: float) -> float:
+        """Seconds until the breaker lets a request through"""
+        if self.state == "open":
+            remaining = self.opened_at + BREAKER_RESET_TIMEOUT - now
+            if remaining > 0:
+                return remaining
+            self.state = "half_open"
+        if self.state == "half_open" and self.probe_in_flight:
+            # Re-check once the probe has had time to finish
+            return 1.0
+        return 0.0
+    
+    def on_acquire(self):
+        if self.state == "half_open":
+            self.probe_in_flight = True
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+    
+    def record_failure(self, now: float):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = now
+        self.probe_in_flight = False
+    
+    def release_probe(self):
+        """Free the probe slot after an outcome that says nothing about health"""
+        self.probe_in_flight = False
+
+class ModelQuota:
+    """Rate limit and circuit state for one model on one API key"""
+    
+    def __init__(self, model: str):
+        limits = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+        self.requests = RateWindow(limits["rpm"])
+        self.tokens = RateWindow(limits["tpm"])
+        self.breaker = CircuitBreaker()
+        self.cooldown_until = 0.0
+        self.rate_limited = 0
+
+class KeyState:
+    """Scheduling state for one API key"""
+    
+    def __init__(self, index: int):
+        self.index = index
+        self.requests = RateWindow(KEY_RPM_LIMIT)
+        self.models = {}
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_used = 0.0
+    
+    def quota(self, model: str) -> ModelQuota:
+        if model not in self.models:
+            self.models[model] = ModelQuota(model)
+        return self.models[model]
+    
+    def wait_time(self, model: str, tokens: float, now: float) -> float:
+        """Seconds until this key can take a request for the model"""
+        quota = self.quota(model)
+        return max(
+            self.cooldown_until - now,
+            quota.cooldown_until - now,
+            self.requests.wait_time(1, now),
+            quota.requests.wait_time(1, now),
+            quota.tokens.wait_time(tokens, now),
+            quota.breaker.wait_time(now)
+        )
+
+class KeyScheduler:
+    """Assigns requests to API keys using per-key and per-model rate windows
+    
+    Rate-limited keys cool down for as long as the API asks, keys rejected as
+    invalid back off exponentially, flaky key+model pairs are cut off by a circuit
+    breaker, and among ready keys the least loaded one is picked. Selection never
+    awaits between checking and reserving quota, so it is safe under asyncio.
+    """
+    
+    def __init__(self, key_count: int):
+        self.keys = [KeyState(index) for index in range(key_count)]
+    
+    async def acquire(self, model: str, tokens: float, exclude=(), timeout: float = KEY_WAIT_TIMEOUT):
+        """Reserve quota on the best available key, waiting up to timeout; None if none frees up"""
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            candidates = [key for key in self.keys if key.index not in exclude]
+            if not candidates:
+                return None
+            
+            waits = {key.index: key.wait_time(model, tokens, now) for key in candidates}
+            ready = [key for key in candidates if waits[key.index] <= 0]
+            if ready:
+                key = min(ready, key=lambda k: (k.in_flight, k.last_used))
+                quota = key.quota(model)
+                key.requests.consume(1, now)
+                quota.requests.consume(1, now)
+                quota.tokens.consume(tokens, now)
+                quota.breaker.on_acquire()
+                key.in_flight += 1
+                key.last_used = now
+                return key.index
+            
+            wait = min(waits.values())
+            if now + wait > deadline:
+                return None
+            await asyncio.sleep(wait)
+    
+    def release(self, key_index: int, model: str, outcome: str, tokens_reserved: float = 0,
+                tokens_used: Optional[float] = None, retry_after: Optional[float] = None):
+        """Return a key after a request, with outcome "success", "released" or an error kind"""
+        key = self.keys[key_index]
+        quota = key.quota(model)
+        now = time.monotonic()
+        key.in_flight = max(0, key.in_flight - 1)
+        
+        # Correct the token reservation with the real usage; failed calls bill nothing
+        if tokens_used is None and outcome in (ERROR_QUOTA, ERROR_AUTH, ERROR_TRANSIENT, ERROR_CLIENT):
+            tokens_used = 0
+        if tokens_used is not None:
+            quota.tokens.consume(tokens_used - tokens_reserved, now)
+        
+        if outcome == "success":
+            key.successes += 1
+            key.consecutive_failures = 0
+            quota.breaker.record_success()
+        elif outcome == ERROR_QUOTA:
+            quota.rate_limited += 1
+            if retry_after is None:
+                retry_after = RATE_LIMIT_COOLDOWN * random.uniform(0.5, 1)
+            quota.cooldown_until = now + retry_after
+            quota.breaker.release_probe()
+        elif outcome == ERROR_AUTH:
+            # The key itself is rejected, whatever the model
+            key.failures += 1
+            key.consecutive_failures += 1
+            cooldown = FAILURE_COOLDOWN_BASE * 2 ** (key.consecutive_failures - 1)
+            key.cooldown_until = now + min(cooldown, FAILURE_COOLDOWN_MAX)
+            quota.breaker.release_probe()
+        elif outcome == ERROR_TRANSIENT:
+            key.failures += 1
+            quota.breaker.record_failure(now)
+        else:
+            quota.breaker.release_probe()
+    
+    def reset(self):
+        """Clear all cooldowns and failure streaks"""
+        for key in self.keys:
+            key.cooldown_until = 0.0
+            key.consecutive_failures = 0
+            for quota in key.models.values():
+                quota.cooldown_until = 0.0
+                quota.breaker = CircuitBreaker()
+    
+    def cooling_down(self):
+        """Indexes of keys that are currently unusable for every model"""
+        now = time.monotonic()
+        return [key.index for key in self.keys if key.cooldown_until > now]
+    
+    def snapshot(self):
+        """Scheduler state for the health endpoint"""
+        now = time.monotonic()
+        return [
+            {
+                "index": key.index,
+                "in_flight": key.in_flight,
+                "successes": key.successes,
+                "failures": key.failures,
+                "consecutive_failures": key.consecutive_failures,
+                "cooldown_remaining": round(max(0.0, key.cooldown_until - now), 1),
+                "requests_available": round(key.requests.available(now), 2),
+                "models": {
+                    model: {
+                        "requests_available": round(quota.requests.available(now), 2),
+                        "tokens_available": round(quota.tokens.available(now)),
+                        "rate_limited": quota.rate_limited,
+                        "cooldown_remaining": round(max(0.0, quota.cooldown_until - now), 1),
+                        "circuit": quota.breaker.state,
+                        "circuit_trips": quota.breaker.trips
+                    }
+                    for model, quota in key.models.items()
+                }
+            }
+            for key in self.keys
+        ]
+
+key_scheduler = KeyScheduler(len(API_KEYS))
+
+class LaneState:
+    """Weight, concurrency cap and statistics of one workload lane, shared by all models"""
+    
+    def __init__(self, weight: float, max_concurrency: int):
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.admitted = 0
+        self.finish = 0.0  # Virtual finish time of the lane's last admitted request
+        self.waits = deque(maxlen=ADMISSION_SAMPLE_SIZE)
+
+class ModelAdmission:
+    """Concurrency limit, per-lane wait queues and statistics for one model"""
+    
+    def __init__(self, limit: int):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.active = 0
+        self.queues = {lane: deque() for lane in WORKLOAD_LANES}  # (future, cost) of waiting requests
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = deque(maxlen=ADMISSION_SAMPLE_SIZE)
+        self.service_time = None  # Moving average of admitted request duration
+        self.last_decrease = 0.0
+    
+    def capacity(self) -> int:
+        return max(1, int(self.limit))
+    
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+class AdmissionController:
+    """Bounds concurrent generations per model and shares them fairly between workload lanes
+    
+    Requests beyond a model's concurrency limit, or their lane's cap, wait in per-lane
+    FIFO queues and are rejected right away with 503 once the model's queue is full, or
+    after waiting ADMISSION_QUEUE_TIMEOUT. Free slots go to the waiting lane that is
+    furthest behind its weighted share of reserved tokens (start-time fair queueing), so
+    a burst of image generations can't starve text chat. With ADMISSION_ADAPTIVE the
+    model limit follows AIMD: it grows by about one per limit's worth of healthy
+    requests and is cut multiplicatively on 429s or slow first tokens.
+    """
+    
+    def __init__(self):
+        self.models = {}
+        self.lanes = {name: LaneState(**config) for name, config in WORKLOAD_LANES.items()}
+        self.virtual_time = 0.0
+    
+    def model(self, model: str) -> ModelAdmission:
+        if model not in self.models:
+            limit = MODEL_METADATA.get(model, {}).get("max_concurrency", ADMISSION_DEFAULT_CONCURRENCY)
+            self.models[model] = ModelAdmission(limit)
+        return self.models[model]
+    
+    async def acquire(self, model: str, lane: str, cost: float) -> float:
+        """Wait for a slot; returns the admission time or raises HTTPException(503)"""
+        state = self.model(model)
+        lane_state = self.lanes[lane]
+        now = time.monotonic()
+        if state.active < state.capacity() and lane_state.active < lane_state.max_concurrency and not state.queued():
+            self._admit(state, lane, cost)
+            state.waits.append(0.0)
+            lane_state.waits.append(0.0)
+            return now
+        
+        if state.queued() >= ADMISSION_QUEUE_SIZE:
+            state.rejected += 1
+            raise self._overloaded(state, "Server is at capacity")
+        
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, cost)
+        state.queues[lane].append(entry)
+        # Other lanes may be waiting only on their own caps; this one may fit right away
+        self._wake()
+        try:
+            await asyncio.wait_for(waiter, ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            state.timed_out += 1
+            raise self._overloaded(state, "Timed out waiting for capacity")
+        except asyncio.CancelledError:
+            # Handed a slot just as we were cancelled; pass it on
+            if waiter.done() and not waiter.cancelled():
+                state.active -= 1
+                lane_state.active -= 1
+                self._wake()
+            raise
+        finally:
+            if entry in state.queues[lane]:
+                state.queues[lane].remove(entry)
+        
+        admitted_at = time.monotonic()
+        state.waits.append(admitted_at - now)
+        lane_state.waits.append(admitted_at - now)
+        return admitted_at
+    
+    def release(self, model: str, lane: str, admitted_at: float, first_event_at: Optional[float], rate_limited: bool):
+        """Free a slot and, if adaptive, adjust the model limit from the request's outcome"""
+        state = self.model(model)
+        now = time.monotonic()
+        state.active -= 1
+        self.lanes[lane].active -= 1
+        duration = now - admitted_at
+        if state.service_time is None:
+            state.service_time = duration
+        else:
+            state.service_time += 0.1 * (duration - state.service_time)
+        
+        if ADMISSION_ADAPTIVE:
+            slow = first_event_at is not None and first_event_at - admitted_at > ADMISSION_TARGET_LATENCY
+            if rate_limited or slow:
+                # Cut at most once per target latency so one congested moment counts once
+                if now - state.last_decrease > ADMISSION_TARGET_LATENCY:
+                    state.limit = max(ADMISSION_MIN_CONCURRENCY, state.limit * ADMISSION_DECREASE_FACTOR)
+                    state.last_decrease = now
+            elif first_event_at is not None:
+                state.limit = min(state.max_limit, state.limit + 1 / state.limit)
+        self._wake()
+    
+    def snapshot(self):
+        """Admission state per model and per lane for the health endpoint"""
+        return {
+            "models": {
+                model: {
+                    "limit": state.capacity(),
+                    "active": state.active,
+                    "queued": state.queued(),
+                    "admitted": state.admitted,
+                    "rejected": state.rejected,
+                    "timed_out": state.timed_out,
+                    "avg_wait": round(sum(state.waits) / len(state.waits), 3) if state.waits else 0.0,
+                    "max_wait": round(max(state.waits), 3) if state.waits else 0.0
+                }
+                for model, state in self.models.items()
+            },
+            "lanes": {
+                lane: {
+                    "weight": lane_state.weight,
+                    "max_concurrency": lane_state.max_concurrency,
+                    "active": lane_state.active,
+                    "queued": sum(len(state.queues[lane]) for state in self.models.values()),
+                    "admitted": lane_state.admitted,
+                    "avg_wait": round(sum(lane_state.waits) / len(lane_state.waits), 3) if lane_state.waits else 0.0,
+                    "max_wait": round(max(lane_state.waits), 3) if lane_state.waits else 0.0
+                }
+                for lane, lane_state in self.lanes.items()
+            }
+        }
+    
+    def _admit(self, state: ModelAdmission, lane: str, cost: float):
+        lane_state = self.lanes[lane]
+        state.active += 1
+        state.admitted += 1
+        lane_state.active += 1
+        lane_state.admitted += 1
+        # Charge the lane for its share: the more it has been given relative to its
+        # weight, the further back it goes in line
+        start = max(lane_state.finish, self.virtual_time)
+        lane_state.finish = start + cost / lane_state.weight
+        self.virtual_time = start
+    
+    def _wake(self):
+        """Hand free slots to waiters, picking the lane furthest behind its fair share"""
+        # Lane caps span models, so a release in one model can unblock another
+        for state in self.models.values():
+            while state.active < state.capacity():
+                eligible = [
+                    lane for lane, queue in state.queues.items()
+                    if queue and self.lanes[lane].active < self.lanes[lane].max_concurrency
+                ]
+                if not eligible:
+                    break
+                lane = min(eligible, key=lambda name: max(self.lanes[name].finish, self.virtual_time))
+                waiter, cost = state.queues[lane].popleft()
+                if waiter.done():
+                    continue
+                self._admit(state, lane, cost)
+                waiter.set_result(True)
+    
+    def _overloaded(self, state: ModelAdmission, reason: str) -> HTTPException:
+        # Suggest retrying once the queue ahead would have drained
+        service_time = state.service_time or 1.0
+        retry_after = max(1, round(service_time * (state.queued() + 1) / state.capacity()))
+        return HTTPException(
+            status_code=503,
+            detail=f"{reason}. Please try again in {retry_after} seconds.",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+admission_controller = AdmissionController()
+
+# Recent time-to-first-token per model and hedging outcomes
+ttft_samples = {}
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+background_tasks = set()
+hedge_stats = {"requests": 0, "launched": 0, "wins": 0, "losses": 0}
+
+# Generations that identical concurrent requests can join, by request fingerprint
+in_flight = {}
+single_flight_stats = {"flights": 0, "coalesced": 0}
+
+# Metrics exposed at /metrics in the Prometheus text format
+METRICS = []
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values) -> str:
+    """Render label names and values as {name="value",...}"""
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    """Monotonic counter per combination of label values
+    
+    Metrics are only updated from the event loop, so plain dict updates need no lock.
+    """
+    
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        METRICS.append(self)
     
-    # If all keys failed, reset and try again
-    failed_keys = set()
-    current_key_index = 0
-    return genai.Client(api_key=API_KEYS[0]), 0
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, value in list(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, values)} {value}")
+        return lines
+
+class Histogram:
+    """Distribution of observed values over fixed bucket bounds, per combination of label values
+    
+    Each series is one list of per-bucket counts followed by the sum; cumulative counts
+    are only computed when rendering.
+    """
+    
+    def __init__(self, name: str, documentation: str, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        METRICS.append(self)
+    
+    def observe(self, labels: tuple, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, series in list(self.values.items()):
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series):
+                count += bucket_count
+                labels = format_labels(self.labels + ("le",), values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
 
-# Initialize with first working client
-client, _ = get_working_client()
+chat_requests = Counter(
+    "chat_requests_total", "Chat requests by model and where the response came from (upstream, cache, coalesced)",
+    ("model", "source")
+)
+chat_request_errors = Counter(
+    "chat_request_errors_total", "Chat requests that failed, by model and HTTP status code", ("model", "status_code")
+)
+chat_requests_cancelled = Counter(
+    "chat_requests_cancelled_total",
+    "Chat requests whose client disconnected before the response finished, by model, source and "
+    "stage (waiting: before any output, streaming: after)",
+    ("model", "source", "stage")
+)
+chat_request_duration = Histogram(
+    "chat_request_duration_seconds", "Time from receiving a chat request to its last event", ("model", "source")
+)
+chat_input_bytes = Counter(
+    "chat_input_bytes_total", "Prompt, history and image bytes sent to the model, once per upstream call", ("model",)
+)
+chat_output_bytes = Counter(
+    "chat_output_bytes_total", "Text and image bytes generated by the model", ("model",)
+)
+chat_attempts = Histogram(
+    "chat_upstream_attempts_per_request", "Upstream calls made for one generation, including retries and hedges",
+    ("model",), buckets=METRICS_ATTEMPT_BUCKETS
+)
+key_rotations = Counter(
+    "chat_key_rotations_total", "Retries moved to another API key, by the error kind that caused them",
+    ("model", "reason")
+)
+upstream_attempts = Counter(
+    "gemini_attempts_total", "Upstream generation calls by model, API key index and outcome (quota means 429)",
+    ("model", "key", "outcome")
+)
+upstream_ttft = Histogram(
+    "gemini_time_to_first_token_seconds", "Time from starting an upstream call to its first output",
+    ("model", "key")
+)
+upstream_duration = Histogram(
+    "gemini_generation_duration_seconds", "Duration of successful upstream calls", ("model", "key")
+)
+upstream_chunks = Histogram(
+    "gemini_chunks_per_generation", "Streamed chunks received per successful upstream call",
+    ("model", "key"), buckets=METRICS_CHUNK_BUCKETS
+)
+upstream_fallbacks = Counter(
+    "gemini_stream_fallbacks_total", "Streaming calls retried as non-streaming on the same key", ("model", "key")
+)
+hedges_launched = Counter(
+    "gemini_hedges_launched_total", "Second calls started on another key because the first was slow to answer",
+    ("model",)
+)
+hedge_results = Counter(
+    "gemini_hedge_results_total", "Hedged requests by which call answered first (win: the hedge, loss: the original)",
+    ("model", "result")
+)
+
+class StageTimer:
+    """Durations of the stages of one chat request, measured with a monotonic clock"""
+    
+    def __init__(self, started: Optional[float] = None):
+        self.started = started if started is not None else time.monotonic()
+        self.stages = {}
+    
+    def add(self, stage: str, since: float) -> float:
+        """Add the time elapsed since a monotonic timestamp to a stage; returns the current time"""
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0) + now - since
+        return now
+    
+    def finish(self):
+        self.stages["total"] = time.monotonic() - self.started
+    
+    def milliseconds(self) -> dict:
+        return {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()}
+    
+    def header(self) -> str:
+        """The stages as a Server-Timing header value"""
+        return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items())
+
+class RequestTimingMiddleware:
+    """Stamp each HTTP request with the time it arrived, before its body is read and validated"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.monotonic()
+        await self.app(scope, receive, send)
+
+app.add_middleware(RequestTimingMiddleware)
+
+def request_timer(request: Request) -> StageTimer:
+    """Timer for a chat request whose first stage is reading and validating the body"""
+    received_at = getattr(request.state, "received_at", None)
+    timer = StageTimer(received_at)
+    if received_at is not None:
+        timer.add("parse", received_at)
+    return timer
+
+def estimate_text_tokens(text: str) -> int:
+    """Roughly estimate the tokens in a text, at about 4 characters per token"""
+    return len(text) // 4 + 1 if text else 0
+
+def estimate_tokens(message, image_count: int, history_tokens: int = 0) -> int:
+    """Roughly estimate the tokens a chat request will use, for TPM reservations"""
+    return (
+        estimate_text_tokens(message.message)
+        + IMAGE_TOKENS * image_count
+        + history_tokens
+        + ESTIMATED_OUTPUT_TOKENS
+    )
+
+def classify_error(error: Exception) -> str:
+    """Classify a Gemini call failure as quota, auth, transient or client error"""
+    if isinstance(error, errors.APIError):
+        if error.code == 429:
+            return ERROR_QUOTA
+        if error.code in (401, 403):
+            return ERROR_AUTH
+        # Invalid keys are reported as 400 INVALID_ARGUMENT with an API_KEY_INVALID reason
+        if isinstance(error.details, dict):
+            for detail in error.details.get("error", error.details).get("details", []):
+                if isinstance(detail, dict) and detail.get("reason") == "API_KEY_INVALID":
+                    return ERROR_AUTH
+        if error.code == 408 or error.code >= 500:
+            return ERROR_TRANSIENT
+        # Bad model names, malformed images and other problems with the request itself
+        return ERROR_CLIENT
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return ERROR_TRANSIENT
+    # Unknown failures (e.g. a malformed stream) are treated as the key's problem
+    return ERROR_TRANSIENT
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Extract the server-suggested retry delay in seconds from a rate limit error"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    
+    # Gemini reports e.g. {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "37s"}
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", details).get("details", []):
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
 
 # Request/Response models
 class ImageData(BaseModel):
-    data: str
-    mime_type: str
+    data: Optional[str] = None  # Base64 image bytes
+    handle: Optional[str] = None  # Handle returned by POST /blobs, sent instead of data
+    mime_type: Optional[str] = None  # Required with data; taken from the blob for handles
+    
+    @model_validator(mode="after")
+    def check_source(self):
+        if (self.data is None) == (self.handle is None):
+            raise ValueError("Provide exactly one of 'data' or 'handle'")
+        if self.data is not None and not self.mime_type:
+            raise ValueError("'mime_type' is required with 'data'")
+        if self.mime_type is not None:
+            mime_type = normalize_image_type(self.mime_type)
+            if mime_type is None:
+                raise ValueError(f"Unsupported image type '{self.mime_type}'; use one of {', '.join(IMAGE_TYPES)}")
+            self.mime_type = mime_type
+        return self
+
+class HistoryTurn(BaseModel):
+    role: Literal["user", "model"]
+    text: str
 
 class ChatMessage(BaseModel):
     message: str
     images: List[ImageData] = []
     model: str = "gemini-2.0-flash-exp"
     generate_image: bool = False
+    # Continue a stored conversation; a new one is started if omitted. Ids are keys of
+    # the conversation store, so they are kept short to stay within its memory budget
+    conversation_id: Optional[str] = Field(None, max_length=64)
+    history: List[HistoryTurn] = []  # Prior turns supplied by the client; replaces stored history when given
+    temperature: Optional[float] = Field(None, ge=0, le=2)  # Defaults to DEFAULT_TEMPERATURE
+    
+    @field_validator("model")
+    @classmethod
+    def check_model(cls, model: str) -> str:
+        # Per-model admission, quota and metrics state is only ever created for known models
+        if model not in AVAILABLE_MODELS:
+            raise ValueError(f"Unknown model '{model}'; use one of {', '.join(AVAILABLE_MODELS)}")
+        return model
 
 class ChatResponse(BaseModel):
     text: str
-    images: List[dict] = []  # List of {"data": base64_string, "mime_type": str}
+    images: List[dict] = []  # List of {"url": "/images/<sha256>", "mime_type": str}
+    conversation_id: Optional[str] = None
+    prompt_tokens_saved: int = 0  # History tokens left out to stay within the model's budget
+    timings: Optional[dict] = None  # Milliseconds spent in each stage, as in the Server-Timing header
 
-# Store conversation history in memory (consider using a database for production)
-conversations = {}
+class Turn:
+    """One stored conversation turn: text plus (handle, mime_type) references into blob_store"""
+    __slots__ = ("role", "text", "images", "tokens", "seq")
+    
+    def __init__(self, role: str, text: str, images: tuple = (), tokens: Optional[int] = None, seq: int = 0):
+        self.role = role
+        self.text = text
+        self.images = images
+        self.tokens = tokens
+        self.seq = seq
+    
+    def token_count(self) -> int:
+        """Token count of the turn, estimated once and cached unless known exactly"""
+        if self.tokens is None:
+            self.tokens = estimate_text_tokens(self.text) + IMAGE_TOKENS * len(self.images)
+        return self.tokens
+    
+    def size(self) -> int:
+        return TURN_OVERHEAD_BYTES + len(self.text.encode("utf-8")) + IMAGE_REF_BYTES * len(self.images)
 
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    """Serve the main chat interface"""
-    return """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Gemini AI Multi-Model Chat</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-        }
-        
-        .chat-container {
-            width: 90%;
-            max-width: 900px;
-            height: 90vh;
-            background: white;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            display: flex;
-            flex-direction: column;
-            overflow: hidden;
-        }
-        
-        .chat-header {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .header-title {
-            font-size: 24px;
-            font-weight: bold;
-        }
-        
-        .model-selector {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }
-        
-        .model-selector label {
-            font-size: 14px;
-        }
-        
-        .model-dropdown {
-            padding: 8px 12px;
-            border-radius: 10px;
-            border: none;
-            background: rgba(255, 255, 255, 0.9);
-            color: #333;
-            font-size: 14px;
-            cursor: pointer;
-            outline: none;
-            min-width: 200px;
-        }
-        
-        .chat-messages {
-            flex: 1;
-            overflow-y: auto;
-            padding: 20px;
-            background: #f5f5f5;
-        }
-        
-        .message {
-            margin-bottom: 15px;
-            display: flex;
-            animation: slideIn 0.3s ease;
-        }
-        
-        @keyframes slideIn {
-            from {
-                opacity: 0;
-                transform: translateY(10px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
-        
-        .message.user {
-            justify-content: flex-end;
-        }
-        
-        .message-content {
-            max-width: 70%;
-            padding: 12px 18px;
-            border-radius: 18px;
-            word-wrap: break-word;
-        }
-        
-        .message.user .message-content {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-        }
-        
-        .message.assistant .message-content {
-            background: white;
-            color: #333;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }
-        
-        .message.error .message-content {
-            background: #ffebee;
-            color: #c62828;
-            border: 1px solid #ef5350;
-        }
-        
-        .message-image {
-            max-width: 100%;
-            max-height: 400px;
-            border-radius: 10px;
-            margin-top: 10px;
-            cursor: pointer;
-            transition: transform 0.2s;
-            display: block;
-        }
-        
-        .message-image:hover {
-            transform: scale(1.02);
-        }
-        
-        .model-badge {
-            display: inline-block;
-            background: rgba(102, 126, 234, 0.1);
-            color: #667eea;
-            padding: 2px 8px;
-            border-radius: 12px;
-            font-size: 11px;
-            margin-bottom: 5px;
-        }
-        
-        .error-badge {
-            display: inline-block;
-            background: rgba(198, 40, 40, 0.1);
-            color: #c62828;
-            padding: 2px 8px;
-            border-radius: 12px;
-            font-size: 11px;
-            margin-bottom: 5px;
-        }
-        
-        .retry-button {
-            margin-top: 10px;
-            padding: 8px 16px;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            border-radius: 20px;
-            font-size: 14px;
-            cursor: pointer;
-            transition: transform 0.2s;
-            display: inline-block;
-        }
-        
-        .retry-button:hover {
-            transform: scale(1.05);
-        }
-        
-        .retry-button:disabled {
-            opacity: 0.5;
-            cursor: not-allowed;
-        }
-        
-        .chat-input-container {
-            padding: 20px;
-            background: white;
-            border-top: 1px solid #e0e0e0;
-        }
-        
-        .uploaded-images-preview {
-            display: none;
-            margin-bottom: 15px;
-            padding: 10px;
-            background: #f9f9f9;
-            border-radius: 10px;
-        }
-        
-        .uploaded-images-preview.active {
-            display: block;
-        }
-        
-        .preview-title {
-            font-size: 12px;
-            color: #666;
-            margin-bottom: 10px;
-            font-weight: 600;
-        }
-        
-        .images-grid {
-            display: flex;
-            flex-wrap: wrap;
-            gap: 10px;
-        }
-        
-        .image-preview-item {
-            position: relative;
-            width: 100px;
-            height: 100px;
-            border-radius: 8px;
-            overflow: hidden;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }
-        
-        .image-preview-item img {
-            width: 100%;
-            height: 100%;
-            object-fit: cover;
-        }
-        
-        .remove-image-btn {
-            position: absolute;
-            top: 5px;
-            right: 5px;
-            background: rgba(255, 0, 0, 0.8);
-            color: white;
-            border: none;
-            border-radius: 50%;
-            width: 24px;
-            height: 24px;
-            cursor: pointer;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 16px;
-            line-height: 1;
-            transition: background 0.2s;
-        }
-        
-        .remove-image-btn:hover {
-            background: rgba(255, 0, 0, 1);
-        }
-        
-        .options-row {
-            display: flex;
-            gap: 10px;
-            margin-bottom: 10px;
-            align-items: center;
-            justify-content: space-between;
-        }
-        
-        .left-options {
-            display: flex;
-            gap: 10px;
-            align-items: center;
-        }
-        
-        .right-options {
-            display: flex;
-            gap: 10px;
-            align-items: center;
-        }
-        
-        .checkbox-wrapper {
-            display: flex;
-            align-items: center;
-            gap: 5px;
-        }
-        
-        .checkbox-wrapper input[type="checkbox"] {
-            width: 18px;
-            height: 18px;
-            cursor: pointer;
-        }
-        
-        .checkbox-wrapper label {
-            cursor: pointer;
-            font-size: 14px;
-            color: #666;
-        }
-        
-        .restore-button {
-            padding: 6px 12px;
-            background: #4caf50;
-            color: white;
-            border: none;
-            border-radius: 15px;
-            font-size: 13px;
-            cursor: pointer;
-            transition: all 0.3s;
-            display: none;
-        }
-        
-        .restore-button.active {
-            display: inline-block;
-        }
-        
-        .restore-button:hover {
-            background: #45a049;
-            transform: scale(1.05);
-        }
-        
-        .input-wrapper {
-            display: flex;
-            gap: 10px;
-            align-items: flex-end;
-        }
-        
-        .chat-input {
-            flex: 1;
-            padding: 12px;
-            border: 2px solid #e0e0e0;
-            border-radius: 25px;
-            font-size: 16px;
-            outline: none;
-            transition: border-color 0.3s;
-        }
-        
-        .chat-input:focus {
-            border-color: #667eea;
-        }
-        
-        .file-input-wrapper {
-            position: relative;
-            overflow: hidden;
-            display: inline-block;
-        }
-        
-        .file-input-wrapper input[type=file] {
-            position: absolute;
-            left: -9999px;
-        }
-        
-        .file-input-label {
-            display: inline-block;
-            padding: 10px 15px;
-            background: #f0f0f0;
-            border-radius: 20px;
-            cursor: pointer;
-            transition: background 0.3s;
-        }
-        
-        .file-input-label:hover {
-            background: #e0e0e0;
-        }
-        
-        .image-count-badge {
-            display: inline-block;
-            background: #667eea;
-            color: white;
-            border-radius: 10px;
-            padding: 2px 6px;
-            font-size: 11px;
-            margin-left: 5px;
-        }
-        
-        .send-button {
-            padding: 10px 25px;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            border: none;
-            border-radius: 25px;
-            font-size: 16px;
-            cursor: pointer;
-            transition: transform 0.2s;
-        }
-        
-        .send-button:hover {
-            transform: scale(1.05);
-        }
-        
-        .send-button:disabled {
-            opacity: 0.5;
-            cursor: not-allowed;
-        }
-        
-        .typing-indicator {
-            display: none;
-            padding: 20px;
-            text-align: center;
-            color: #666;
-        }
-        
-        .typing-indicator.active {
-            display: block;
-        }
-        
-        .dots {
-            display: inline-block;
-        }
-        
-        .dots::after {
-            content: '...';
-            animation: dots 1.5s steps(4, end) infinite;
-        }
-        
-        @keyframes dots {
-            0%, 20% {
-                color: rgba(0, 0, 0, 0);
-                text-shadow: .25em 0 0 rgba(0, 0, 0, 0), .5em 0 0 rgba(0, 0, 0, 0);
-            }
-            40% {
-                color: #666;
-                text-shadow: .25em 0 0 rgba(0, 0, 0, 0), .5em 0 0 rgba(0, 0, 0, 0);
-            }
-            60% {
-                text-shadow: .25em 0 0 #666, .5em 0 0 rgba(0, 0, 0, 0);
-            }
-            80%, 100% {
-                text-shadow: .25em 0 0 #666, .5em 0 0 #666;
-            }
-        }
-        
-        .error-message {
-            background: #ff4444;
-            color: white;
-            padding: 10px;
-            border-radius: 10px;
-            margin: 10px 20px;
-            display: none;
-        }
-        
-        .image-gallery {
-            display: flex;
-            flex-wrap: wrap;
-            gap: 10px;
-            margin-top: 10px;
-        }
-        
-        .image-gallery img {
-            max-width: 200px;
-            max-height: 200px;
-            object-fit: cover;
-            border-radius: 8px;
-            cursor: pointer;
-        }
-        
-        .clear-all-btn {
-            background: #ff4444;
-            color: white;
-            border: none;
-            padding: 5px 10px;
-            border-radius: 5px;
-            font-size: 12px;
-            cursor: pointer;
-            margin-left: auto;
-        }
-        
-        .clear-all-btn:hover {
-            background: #ff6666;
-        }
-    </style>
-</head>
-<body>
-    <div class="chat-container">
-        <div class="chat-header">
-            <div class="header-title">🤖 Gemini AI Multi-Model Chat</div>
-            <div class="model-selector">
-                <label for="modelSelect">Model:</label>
-                <select id="modelSelect" class="model-dropdown">
-                    <option value="gemini-2.0-flash-exp">Gemini 2.0 Flash Exp</option>
-                    <option value="gemini-2.5-flash">Gemini 2.5 Flash</option>
-                    <option value="gemini-2.5-flash-image-preview">Gemini 2.5 Flash Image Preview</option>
-                    <option value="gemini-2.5-pro">Gemini 2.5 Pro</option>
-                </select>
-            </div>
-        </div>
-        
-        <div class="chat-messages" id="chatMessages">
-            <div class="message assistant">
-                <div class="message-content">
-                    <div class="model-badge">System</div>
-                    <div>Hello! I'm your AI assistant powered by Gemini. You can:
-                    • Switch between different models using the dropdown above
-                    • Upload multiple images for analysis
-                    • Request image generation (with compatible models)
-                    • Remove uploaded images before sending
-                    • Retry failed messages without re-uploading
-                    
-                    How can I help you today?</div>
-                </div>
-            </div>
-        </div>
-        
-        <div class="typing-indicator" id="typingIndicator">
-            <span class="dots">Thinking</span>
-        </div>
-        
-        <div class="error-message" id="errorMessage"></div>
-        
-        <div class="chat-input-container">
-            <div class="uploaded-images-preview" id="uploadedImagesPreview">
-                <div style="display: flex; align-items: center;">
-                    <span class="preview-title">Uploaded Images:</span>
-                    <button class="clear-all-btn" onclick="clearAllImages()">Clear All</button>
-                </div>
-                <div class="images-grid" id="imagesGrid"></div>
-            </div>
-            
-            <div class="options-row">
-                <div class="left-options">
-                    <div class="checkbox-wrapper">
-                        <input type="checkbox" id="generateImageCheck">
-                        <label for="generateImageCheck">Request image generation</label>
-                    </div>
-                </div>
-                <div class="right-options">
-                    <button id="restoreButton" class="restore-button" onclick="restoreLastMessage()">
-                        ↻ Restore Last Message
-                    </button>
-                </div>
-            </div>
-            
-            <div class="input-wrapper">
-                <input 
-                    type="text" 
-                    class="chat-input" 
-                    id="chatInput" 
-                    placeholder="Type your message..."
-                    onkeypress="handleKeyPress(event)"
-                >
-                
-                <div class="file-input-wrapper">
-                    <input type="file" id="fileInput" accept="image/*" multiple onchange="handleFileSelect(event)">
-                    <label for="fileInput" class="file-input-label">
-                        📷 Upload
-                        <span id="imageCountBadge" class="image-count-badge" style="display: none;">0</span>
-                    </label>
-                </div>
-                
-                <button class="send-button" id="sendButton" onclick="sendMessage()">
-                    Send
-                </button>
-            </div>
-        </div>
-    </div>
-    
-    <script>
-        let uploadedImages = [];
-        let lastMessageData = null;
-        let retryCount = 0;
-        
-        function handleKeyPress(event) {
-            if (event.key === 'Enter' && !event.shiftKey) {
-                event.preventDefault();
-                sendMessage();
-            }
-        }
-        
-        function handleFileSelect(event) {
-            const files = Array.from(event.target.files);
-            
-            files.forEach(file => {
-                if (file && file.type.startsWith('image/')) {
-                    const reader = new FileReader();
-                    reader.onload = function(e) {
-                        const imageData = {
-                            data: e.target.result.split(',')[1], // Remove data:image/...;base64,
-                            mimeType: file.type,
-                            name: file.name,
-                            preview: e.target.result,
-                            id: Date.now() + Math.random() // Unique ID for each image
-                        };
-                        uploadedImages.push(imageData);
-                        updateImagePreview();
-                    };
-                    reader.readAsDataURL(file);
-                }
-            });
-            
-            // Clear the file input
-            event.target.value = '';
-        }
-        
-        function updateImagePreview() {
-            const previewContainer = document.getElementById('uploadedImagesPreview');
-            const imagesGrid = document.getElementById('imagesGrid');
-            const imageCountBadge = document.getElementById('imageCountBadge');
-            
-            if (uploadedImages.length > 0) {
-                previewContainer.classList.add('active');
-                imageCountBadge.style.display = 'inline-block';
-                imageCountBadge.textContent = uploadedImages.length;
-                
-                // Clear and rebuild the grid
-                imagesGrid.innerHTML = '';
-                
-                uploadedImages.forEach((image, index) => {
-                    const imageItem = document.createElement('div');
-                    imageItem.className = 'image-preview-item';
-                    imageItem.innerHTML = `
-                        <img src="${image.preview}" alt="${image.name}" title="${image.name}">
-                        <button class="remove-image-btn" onclick="removeImage(${index})" title="Remove image">×</button>
-                    `;
-                    imagesGrid.appendChild(imageItem);
-                });
-            } else {
-                previewContainer.classList.remove('active');
-                imageCountBadge.style.display = 'none';
-                imagesGrid.innerHTML = '';
-            }
-        }
-        
-        function removeImage(index) {
-            uploadedImages.splice(index, 1);
-            updateImagePreview();
-        }
-        
-        function clearAllImages() {
-            uploadedImages = [];
-            updateImagePreview();
-        }
-        
-        function saveLastMessage(message, images, model, generateImage) {
-            lastMessageData = {
-                message: message,
-                images: [...images], // Create a copy
-                model: model,
-                generateImage: generateImage,
-                timestamp: Date.now()
-            };
-            
-            // Show restore button
-            document.getElementById('restoreButton').classList.add('active');
+class Conversation:
+    __slots__ = ("turns", "updated", "size", "next_seq", "summary", "summary_through", "summarizing")
+    
+    def __init__(self):
+        self.turns = []
+        self.updated = time.monotonic()
+        self.size = CONVERSATION_OVERHEAD_BYTES
+        self.next_seq = 0
+        # Rolling summary of every turn with seq below summary_through
+        self.summary = None
+        self.summary_through = 0
+        self.summarizing = False
+
+class ConversationStore:
+    """In-memory conversation history bounded by count, idle TTL and a memory budget
+    
+    Conversations are kept in least-recently-used order and evicted from the cold
+    end. Images live in the shared blob store, under its budgets, and turns only hold
+    their handles, so an image is never kept twice however many turns refer to it.
+    """
+    
+    def __init__(self, max_conversations: int, ttl: float, memory_budget: int, max_turns: int):
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self.max_turns = max_turns
+        self.conversations = OrderedDict()
+        self.bytes_used = 0
+        self.evictions = 0
+    
+    def get(self, conversation_id: str) -> list:
+        """Turns of a conversation, oldest first; empty if unknown or expired"""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return []
+        if time.monotonic() - conversation.updated > self.ttl:
+            self._remove(conversation_id)
+            return []
+        self.conversations.move_to_end(conversation_id)
+        return list(conversation.turns)
+    
+    async def append(self, conversation_id: str, user_text: str, user_images, model_text: str, model_images,
+                     model_tokens: Optional[int] = None):
+        """Record a user/model exchange; images are (bytes, mime_type) pairs"""
+        # Store the images first, as other requests may change the conversation meanwhile
+        user_refs = await self._store_images(user_images)
+        model_refs = await self._store_images(model_images)
+        
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            conversation = self.conversations[conversation_id] = Conversation()
+            self.bytes_used += conversation.size
+        
+        exchange = (("user", user_text, user_refs, None), ("model", model_text, model_refs, model_tokens))
+        for role, text, refs, tokens in exchange:
+            turn = Turn(role, text, refs, tokens=tokens, seq=conversation.next_seq)
+            conversation.next_seq += 1
+            conversation.turns.append(turn)
+            conversation.size += turn.size()
+            self.bytes_used += turn.size()
+        
+        # Drop the oldest turns of long conversations
+        while len(conversation.turns) > self.max_turns:
+            self._drop_turn(conversation, conversation.turns.pop(0))
+        
+        conversation.updated = time.monotonic()
+        self.conversations.move_to_end(conversation_id)
+        self._evict()
+    
+    def summary(self, conversation_id: str):
+        """The conversation's rolling summary and the seq of the first turn it doesn't cover"""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return None, 0
+        return conversation.summary, conversation.summary_through
+    
+    def start_summary(self, conversation_id: str) -> bool:
+        """Claim the conversation for summarizing; False if unknown or already in progress"""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None or conversation.summarizing:
+            return False
+        conversation.summarizing = True
+        return True
+    
+    def finish_summary(self, conversation_id: str, summary: Optional[str] = None, through: int = 0):
+        """Store a new rolling summary (if any) and release the summarizing claim"""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return
+        conversation.summarizing = False
+        if summary:
+            size_change = len(summary.encode("utf-8")) - len((conversation.summary or "").encode("utf-8"))
+            conversation.summary = summary
+            conversation.summary_through = through
+            conversation.size += size_change
+            self.bytes_used += size_change
+    
+    async def to_content(self, turn: Turn):
+        """Rebuild a Gemini content entry from a stored turn; images the blob store has
+        since evicted are left out"""
+        parts = []
+        if turn.text:
+            parts.append(types.Part.from_text(text=turn.text))
+        for handle, mime_type in turn.images:
+            blob = await blob_store.get(handle)
+            if blob is not None:
+                parts.append(types.Part.from_bytes(mime_type=mime_type, data=blob[0]))
+        return types.Content(role=turn.role, parts=parts)
+    
+    def stats(self):
+        return {
+            "conversations": len(self.conversations),
+            "bytes_used": self.bytes_used,
+            "memory_budget": self.memory_budget,
+            "evictions": self.evictions
         }
-        
-        function restoreLastMessage() {
-            if (!lastMessageData) return;
-            
-            // Restore text
-            document.getElementById('chatInput').value = lastMessageData.message;
-            
-            // Restore images
-            uploadedImages = [...lastMessageData.images];
-            updateImagePreview();
-            
-            // Restore model
-            document.getElementById('modelSelect').value = lastMessageData.model;
-            
-            // Restore generate image checkbox
-            document.getElementById('generateImageCheck').checked = lastMessageData.generateImage;
-            
-            // Hide restore button after restoring
-            document.getElementById('restoreButton').classList.remove('active');
+    
+    @staticmethod
+    async def _store_images(images) -> tuple:
+        """Put images in the blob store; returns their (handle, mime_type) references"""
+        refs = []
+        for data, mime_type in images:
+            handle, _ = await blob_store.put(data, mime_type)
+            refs.append((handle, mime_type))
+        return tuple(refs)
+    
+    def _drop_turn(self, conversation: Conversation, turn: Turn):
+        conversation.size -= turn.size()
+        self.bytes_used -= turn.size()
+    
+    def _remove(self, conversation_id: str):
+        conversation = self.conversations.pop(conversation_id)
+        for turn in conversation.turns:
+            self._drop_turn(conversation, turn)
+        self.bytes_used -= conversation.size
+    
+    def _evict(self):
+        """Evict expired, then least recently used conversations until within bounds"""
+        now = time.monotonic()
+        while self.conversations:
+            conversation_id, conversation = next(iter(self.conversations.items()))
+            over_budget = (
+                len(self.conversations) > self.max_conversations
+                or self.bytes_used > self.memory_budget
+            )
+            if not over_budget and now - conversation.updated <= self.ttl:
+                break
+            self._remove(conversation_id)
+            self.evictions += 1
+
+# Store conversation history in memory (consider using a database for production)
+conversation_store = ConversationStore(
+    max_conversations=MAX_CONVERSATIONS,
+    ttl=CONVERSATION_TTL,
+    memory_budget=CONVERSATION_MEMORY_BUDGET,
+    max_turns=MAX_TURNS_PER_CONVERSATION
+)
+
+def normalize_image_type(content_type: Optional[str]) -> Optional[str]:
+    """The canonical name of an allowed image type, or None if the type isn't allowed"""
+    mime_type = (content_type or "").split(";", 1)[0].strip().lower()
+    mime_type = IMAGE_TYPE_ALIASES.get(mime_type, mime_type)
+    return mime_type if mime_type in IMAGE_TYPES else None
+
+def write_atomically(path: str, data: bytes):
+    """Write a file under a temporary name and rename it into place, so readers (and
+    other workers) never see a partial file"""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def is_blob_handle(handle: str) -> bool:
+    """Whether a string looks like a blob handle (a lowercase hex SHA-256 digest)"""
+    return len(handle) == 64 and all(c in "0123456789abcdef" for c in handle)
+
+class BlobStore:
+    """Content-addressed image store with a memory tier in front of a disk tier
+    
+    Blobs are keyed by the SHA-256 of their bytes, so the same image is only stored
+    once however often it is uploaded. Each tier evicts least recently used blobs to
+    stay within its byte budget; blobs evicted from memory are read back from disk.
+    """
+    
+    def __init__(self, directory: str, memory_budget: int, disk_budget: int):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()  # sha256 -> (bytes, mime_type)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # sha256 -> (path, size, mime_type)
+        self.disk_bytes = 0
+        self.stored = 0
+        self.duplicates = 0
+        self.evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+    
+    def mime_type(self, digest: str) -> Optional[str]:
+        """Mime type of a stored blob, or None if unknown"""
+        if digest in self.memory:
+            return self.memory[digest][1]
+        if digest in self.disk:
+            return self.disk[digest][2]
+        return None
+    
+    def path(self, digest: str) -> Optional[str]:
+        """Path of a blob in the disk tier, or None if it isn't on disk"""
+        entry = self.disk.get(digest)
+        return entry[0] if entry else None
+    
+    async def put(self, data: bytes, mime_type: str):
+        """Store a blob; returns its handle and whether it was new"""
+        if len(data) > INLINE_DECODE_LIMIT:
+            digest = await run_in_threadpool(lambda: hashlib.sha256(data).hexdigest())
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+        
+        if self.mime_type(digest) is not None:
+            self.duplicates += 1
+            self._touch(digest)
+            return digest, False
+        
+        self.stored += 1
+        self._remember(digest, data, mime_type)
+        if self.directory:
+            path = os.path.join(self.directory, digest + IMAGE_TYPES.get(mime_type, ".bin"))
+            await run_in_threadpool(write_atomically, path, data)
+            if digest not in self.disk:
+                self.disk[digest] = (path, len(data), mime_type)
+                self.disk_bytes += len(data)
+            await run_in_threadpool(self._remove_files, self._evict_disk())
+        return digest, True
+    
+    async def get(self, digest: str):
+        """(bytes, mime_type) of a stored blob, or None if unknown"""
+        if digest in self.memory:
+            self._touch(digest)
+            return self.memory[digest]
+        entry = self.disk.get(digest)
+        if entry is None:
+            return None
+        path, _, mime_type = entry
+        try:
+            data = await run_in_threadpool(self._read_file, path)
+        except OSError:
+            # Removed behind our back; forget it
+            self._forget_disk(digest)
+            return None
+        # A put may have evicted the blob from disk while it was being read; it
+        # mustn't come back as a memory-only copy
+        if digest in self.disk:
+            self._touch(digest)
+            self._remember(digest, data, mime_type)
+        return data, mime_type
+    
+    def stats(self):
+        return {
+            "memory_blobs": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "memory_budget": self.memory_budget,
+            "disk_blobs": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+            "disk_budget": self.disk_budget,
+            "stored": self.stored,
+            "duplicates": self.duplicates,
+            "evictions": self.evictions
         }
-        
-        async function sendMessage(isRetry = false) {
-            const input = document.getElementById('chatInput');
-            const message = input.value.trim();
-            const selectedModel = document.getElementById('modelSelect').value;
-            const generateImage = document.getElementById('generateImageCheck').checked;
-            
-            if (!message && uploadedImages.length === 0) return;
-            
-            const sendButton = document.getElementById('sendButton');
-            sendButton.disabled = true;
-            
-            // Save message data before sending (for retry functionality)
-            if (!isRetry) {
-                saveLastMessage(message, uploadedImages, selectedModel, generateImage);
-                retryCount = 0;
-                
-                // Add user message to chat with all uploaded images
-                const userImagePreviews = uploadedImages.map(img => img.preview);
-                addMessage(message, 'user', userImagePreviews, null, selectedModel);
-            } else {
-                retryCount++;
-            }
-            
-            // Prepare images for API
-            const apiImages = uploadedImages.map(img => ({
-                data: img.data,
-                mime_type: img.mimeType
-            }));
-            
-            // Clear input and images (only if not retrying)
-            if (!isRetry) {
-                input.value = '';
-                clearAllImages();
-                document.getElementById('generateImageCheck').checked = false;
-            }
-            
-            // Show typing indicator
-            document.getElementById('typingIndicator').classList.add('active');
-            
-            try {
-                const response = await fetch('/chat', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        message: message,
-                        images: apiImages,
-                        model: selectedModel,
-                        generate_image: generateImage
-                    })
-                });
-                
-                if (!response.ok) {
-                    const error = await response.text();
-                    throw new Error(error || 'Failed to get response');
-                }
-                
-                const data = await response.json();
-                
-                // Add assistant response to chat
-                const assistantImages = data.images.map(img => 
-                    'data:' + img.mime_type + ';base64,' + img.data
-                );
-                
-                addMessage(data.text, 'assistant', null, assistantImages, selectedModel);
-                
-                // Clear saved message data on success
-                lastMessageData = null;
-                document.getElementById('restoreButton').classList.remove('active');
-                
-                // Clear input if it was a retry
-                if (isRetry) {
-                    input.value = '';
-                    clearAllImages();
-                    document.getElementById('generateImageCheck').checked = false;
-                }
-                
-            } catch (error) {
-                console.error('Error:', error);
-                
-                // Add error message to chat with retry button
-                addErrorMessage(error.message, selectedModel);
-                
-            } finally {
-                document.getElementById('typingIndicator').classList.remove('active');
-                sendButton.disabled = false;
-            }
+    
+    def _touch(self, digest: str):
+        if digest in self.memory:
+            self.memory.move_to_end(digest)
+        if digest in self.disk:
+            self.disk.move_to_end(digest)
+    
+    def _remember(self, digest: str, data: bytes, mime_type: str):
+        """Add a blob to the memory tier, evicting the coldest ones beyond the budget"""
+        if digest in self.memory or len(data) > self.memory_budget:
+            return
+        self.memory[digest] = (data, mime_type)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_budget:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            # Without a disk tier the blob is gone for good
+            if not self.directory:
+                self.evictions += 1
+    
+    def _evict_disk(self) -> list:
+        """Drop the coldest blobs from the disk index until within budget; returns their paths"""
+        paths = []
+        while self.disk_bytes > self.disk_budget and len(self.disk) > 1:
+            digest = next(iter(self.disk))
+            paths.append(self.disk[digest][0])
+            self._forget_disk(digest)
+            self.evictions += 1
+            # A blob evicted from disk mustn't linger in memory only
+            if digest in self.memory:
+                self.memory_bytes -= len(self.memory.pop(digest)[0])
+        return paths
+    
+    def _forget_disk(self, digest: str):
+        # Tolerates blobs already forgotten, e.g. evicted while a read was in flight
+        entry = self.disk.pop(digest, None)
+        if entry is not None:
+            self.disk_bytes -= entry[1]
+    
+    def _load_disk_index(self):
+        """Index blobs left on disk by a previous run, oldest first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            digest = os.path.splitext(name)[0]
+            if not is_blob_handle(digest):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            mime_type = IMAGE_TYPES_BY_EXTENSION.get(os.path.splitext(name)[1], "application/octet-stream")
+            entries.append((stat.st_mtime, digest, path, stat.st_size, mime_type))
+        for _, digest, path, size, mime_type in sorted(entries):
+            self.disk[digest] = (path, size, mime_type)
+            self.disk_bytes += size
+        self._remove_files(self._evict_disk())
+    
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+    
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# Uploaded images, referenced from chat messages by handle so they're only sent once
+blob_store = BlobStore(BLOB_DIR, memory_budget=BLOB_MEMORY_BUDGET, disk_budget=BLOB_DISK_BUDGET)
+
+class ResponseCache:
+    """Exact-match cache of complete chat responses: a memory tier plus an optional disk tier
+    
+    Entries are keyed by a hash of everything sent to the model and expire after a
+    per-model TTL. Generated images aren't copied into entries; they stay in the blob
+    store and entries only hold their handles. Both tiers evict least recently used
+    entries beyond their byte budgets.
+    """
+    
+    def __init__(self, memory_budget: int, directory: str, disk_budget: int):
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()  # key -> (entry, size, expires)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # key -> size
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+    
+    async def get(self, key: str) -> Optional[dict]:
+        """A fresh cached entry, or None; counts the hit or miss"""
+        now = time.time()
+        cached = self.memory.get(key)
+        if cached is not None and cached[2] > now:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+        
+        if key in self.disk:
+            record = await run_in_threadpool(self._read_file, key)
+            if record is not None and record["expires"] > now:
+                self.disk.move_to_end(key)
+                self._remember(key, record["entry"], self.disk[key], record["expires"])
+                self.hits += 1
+                return record["entry"]
+        
+        # Expired or unreadable entries are dropped from both tiers
+        self.discard(key)
+        self.misses += 1
+        return None
+    
+    async def put(self, key: str, entry: dict, ttl: float):
+        """Cache a response entry for ttl seconds"""
+        expires = time.time() + ttl
+        data = json.dumps({"expires": expires, "entry": entry}).encode("utf-8")
+        self.stores += 1
+        self._remember(key, entry, len(data), expires)
+        if self.directory:
+            await run_in_threadpool(write_atomically, self._path(key), data)
+            if key in self.disk:
+                self.disk_bytes -= self.disk.pop(key)
+            self.disk[key] = len(data)
+            self.disk_bytes += len(data)
+            evicted = []
+            while self.disk_bytes > self.disk_budget and self.disk:
+                evicted_key, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                self.evictions += 1
+                evicted.append(evicted_key)
+            await run_in_threadpool(self._remove_files, evicted)
+    
+    def discard(self, key: str):
+        """Drop an entry, e.g. because the images it references are gone"""
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        if key in self.disk:
+            self.disk_bytes -= self.disk.pop(key)
+            self._remove_files([key])
+    
+    def stats(self):
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "memory_budget": self.memory_budget,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+            "disk_budget": self.disk_budget
         }
-        
-        function addErrorMessage(errorText, model) {
-            const messagesContainer = document.getElementById('chatMessages');
-            const messageDiv = document.createElement('div');
-            messageDiv.className = 'message error';
-            
-            let content = '<div class="message-content">';
-            content += '<div class="error-badge">Error</div>';
-            content += '<div>' + escapeHtml(errorText || 'Failed to send message. Please try again.') + '</div>';
-            content += `<button class="retry-button" onclick="retryLastMessage()" ${retryCount >= 3 ? 'disabled' : ''}>
-                        ${retryCount >= 3 ? 'Max retries reached' : '🔄 Try Again (Attempt ' + (retryCount + 1) + '/3)'}
-                       </button>`;
-            content += '</div>';
-            
-            messageDiv.innerHTML = content;
-            messagesContainer.appendChild(messageDiv);
-            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    
+    def _remember(self, key: str, entry: dict, size: int, expires: float):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        if size > self.memory_budget:
+            return
+        self.memory[key] = (entry, size, expires)
+        self.memory_bytes += size
+        while self.memory_bytes > self.memory_budget:
+            evicted_key, (_, evicted_size, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+            # Entries still on disk aren't lost
+            if evicted_key not in self.disk:
+                self.evictions += 1
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+    
+    def _load_disk_index(self):
+        """Index entries left on disk by a previous run, oldest first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            if extension == ".json" and is_blob_handle(key):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+    
+    def _read_file(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def _remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+# Complete responses to repeated identical requests
+response_cache = ResponseCache(
+    memory_budget=RESPONSE_CACHE_MEMORY_BUDGET,
+    directory=RESPONSE_CACHE_DIR,
+    disk_budget=RESPONSE_CACHE_DISK_BUDGET
+)
+
+class TrafficRecorder:
+    """Appends the shape and upstream timing of each chat request to a JSON lines file
+    
+    Only sizes, counts, flags and timings are written, never prompt text or image data.
+    Identical requests share a fingerprint salted per process, so a replay can reproduce
+    cache hits and coalescing without the recording revealing what was asked.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.salt = os.urandom(16)
+        self.records = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+    
+    def fingerprint(self, request_key: Optional[str]) -> Optional[str]:
+        if request_key is None:
+            return None
+        return hashlib.sha256(self.salt + request_key.encode("ascii")).hexdigest()[:16]
+    
+    def write(self, record: dict):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Line buffered: each record is one small append
+            self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.records += 1
+    
+    def stats(self):
+        return {"enabled": self.enabled, "records": self.records}
+
+# Sanitized record of chat traffic for replaying performance regressions offline
+traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_FILE)
+
+# File suffixes of the precompressed variants, in order of preference
+STATIC_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def acceptable_encodings(accept_encoding: str) -> list:
+    """Names of STATIC_ENCODINGS an Accept-Encoding header allows, best first
+    
+    Codings are ranked by their q-value, ties going to STATIC_ENCODINGS order; those
+    with q=0, or refused through "*;q=0", are left out.
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding.strip():
+            qualities[coding.strip().lower()] = quality
+    
+    ranked = []
+    for preference, (name, _) in enumerate(STATIC_ENCODINGS):
+        quality = qualities.get(name, qualities.get("*", 0.0))
+        if quality > 0:
+            ranked.append((-quality, preference, name))
+    return [name for _, _, name in sorted(ranked)]
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that prefers precompressed .br/.gz variants of fingerprinted, immutable files"""
+    
+    async def get_response(self, path: str, scope):
+        accepted = acceptable_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        encoding = None
+        for candidate in accepted:
+            suffix = dict(STATIC_ENCODINGS)[candidate]
+            if os.path.isfile(os.path.join(self.directory, path + suffix)):
+                encoding = candidate
+                path += suffix
+                break
+        
+        response = await super().get_response(path, scope)
+        if encoding and response.status_code == 200:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        # A changed file gets a new name, so any copy can be cached forever
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+def compress_variants(content: bytes) -> dict:
+    """The content keyed by content-coding (None for identity), keeping only variants that are smaller"""
+    variants = {None: content}
+    if len(content) < STATIC_MIN_COMPRESS_BYTES:
+        return variants
+    compressed = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed["br"] = brotli.compress(content, quality=11)
+    for encoding, data in compressed.items():
+        if len(data) < len(content):
+            variants[encoding] = data
+    return variants
+
+def build_static_files(source_dir: str, build_dir: str) -> bytes:
+    """Write fingerprinted frontend assets with gzip/brotli variants; returns the rewritten index.html
+    
+    Asset names get the first 12 hex digits of their SHA-256, so a changed asset gets a
+    new URL and any cached copy of the old one can be kept forever.
+    """
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(source_dir, "index.html"), encoding="utf-8") as f:
+        index = f.read()
+    
+    built = set()
+    for name in STATIC_ASSETS:
+        with open(os.path.join(source_dir, name), "rb") as f:
+            content = f.read()
+        stem, extension = os.path.splitext(name)
+        fingerprinted = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+        index = index.replace(f"/static/{name}", f"/static/{fingerprinted}")
+        
+        for encoding, data in compress_variants(content).items():
+            variant_name = fingerprinted + dict(STATIC_ENCODINGS).get(encoding, "")
+            write_atomically(os.path.join(build_dir, variant_name), data)
+            built.add(variant_name)
+    
+    # Drop assets left over from earlier builds. Other workers build at the same time,
+    # so their in-progress temporary files from write_atomically are left alone
+    for name in set(os.listdir(build_dir)) - built:
+        if name.endswith(".tmp"):
+            continue
+        try:
+            os.remove(os.path.join(build_dir, name))
+        except OSError:
+            pass
+    return index.encode("utf-8")
+
+index_page = build_static_files(STATIC_DIR, STATIC_BUILD_DIR)
+index_page_hash = hashlib.sha256(index_page).hexdigest()[:16]
+index_page_variants = compress_variants(index_page)
+app.mount("/static", PrecompressedStaticFiles(directory=STATIC_BUILD_DIR), name="static")
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    """Serve the main chat interface"""
+    # Kept in memory and revalidated by ETag; the assets it references are cached forever
+    accepted = acceptable_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((name for name in accepted if name in index_page_variants), None)
+    etag = f'"{index_page_hash}-{encoding}"' if encoding else f'"{index_page_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return HTMLResponse(index_page_variants[encoding], headers=headers)
+
+def prompt_text(message: ChatMessage) -> str:
+    """Text sent to the model for a chat message"""
+    # If requesting image generation, modify the prompt
+    if message.message and message.generate_image:
+        return f"Generate an image of: {message.message}"
+    return message.message
+
+async def build_contents(message: ChatMessage, uploaded_images, history=()):
+    """Build the Gemini request contents for a chat message after any stored history
+    
+    uploaded_images holds the decoded (bytes, mime_type) pairs of the request's images.
+    """
+    parts = []
+    
+    # Add text if present
+    if message.message:
+        parts.append(types.Part.from_text(text=prompt_text(message)))
+    
+    # Add all uploaded images
+    for image_bytes, mime_type in uploaded_images:
+        parts.append(types.Part.from_bytes(
+            mime_type=mime_type,
+            data=image_bytes
+        ))
+    
+    if not parts:
+        return []
+    
+    return [await conversation_store.to_content(turn) for turn in history] + [
+        types.Content(
+            role="user",
+            parts=parts
+        )
+    ]
+
+def build_generation_config(message: ChatMessage, system_instruction: Optional[str] = None):
+    """Configure generation based on model and request type"""
+    temperature = DEFAULT_TEMPERATURE if message.temperature is None else message.temperature
+    
+    # Add response modalities for image-capable models when image generation is requested
+    if message.generate_image and "image" in message.model.lower():
+        return types.GenerateContentConfig(
+            temperature=temperature,
+            top_p=0.95,
+            top_k=40,
+            max_output_tokens=8192,
+            response_modalities=["IMAGE", "TEXT"],
+            system_instruction=system_instruction
+        )
+    
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=8192,
+        system_instruction=system_instruction
+    )
+
+def fit_history(turns, budget: int):
+    """Keep the newest turns that fit within the token budget, starting with a user turn"""
+    kept = []
+    used = 0
+    for turn in reversed(turns):
+        tokens = turn.token_count()
+        if used + tokens > budget:
+            break
+        kept.append(turn)
+        used += tokens
+    kept.reverse()
+    
+    while kept and kept[0].role != "user":
+        kept.pop(0)
+    return kept
+
+def summary_instruction(summary: str) -> str:
+    """System instruction carrying the rolling summary of older turns"""
+    return f"Summary of the earlier part of this conversation:\n{summary}"
+
+def schedule_history_summary(conversation_id: str, turns):
+    """Fold turns that fell out of the history budget into the rolling summary in the background"""
+    if not conversation_store.start_summary(conversation_id):
+        return
+    task = asyncio.create_task(summarize_history(conversation_id, turns))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def summarize_history(conversation_id: str, turns):
+    """Generate a new rolling summary covering the previous summary plus the given turns"""
+    previous, _ = conversation_store.summary(conversation_id)
+    transcript = "\n".join(
+        f"{turn.role}: {turn.text}" + (f" [{len(turn.images)} image(s)]" if turn.images else "")
+        for turn in turns
+    )
+    prompt = (
+        "Update the running summary of a chat so it stays useful as context for future replies. "
+        "Keep facts, decisions, names and open questions; be concise.\n\n"
+        f"Current summary:\n{previous or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    
+    summary = None
+    tokens = estimate_text_tokens(prompt) + ESTIMATED_OUTPUT_TOKENS
+    key_index = await key_scheduler.acquire(HISTORY_SUMMARY_MODEL, tokens)
+    try:
+        if key_index is None:
+            return
+        response = await get_client(key_index).aio.models.generate_content(
+            model=HISTORY_SUMMARY_MODEL,
+            contents=prompt
+        )
+        summary = response.text
+        key_scheduler.release(
+            key_index, HISTORY_SUMMARY_MODEL, "success", tokens_reserved=tokens,
+            tokens_used=response.usage_metadata.total_token_count if response.usage_metadata else None
+        )
+    except Exception as e:
+        print(f"Summarizing conversation {conversation_id} failed: {str(e)}")
+        key_scheduler.release(key_index, HISTORY_SUMMARY_MODEL, classify_error(e), tokens_reserved=tokens)
+    finally:
+        conversation_store.finish_summary(conversation_id, summary, through=turns[-1].seq + 1)
+
+def part_to_event(part):
+    """Convert a response part into a text or image event, or None if it has no output"""
+    # Handle text
+    if hasattr(part, 'text') and part.text:
+        return {"type": "text", "text": part.text}
+    
+    # Handle inline data (images)
+    if hasattr(part, 'inline_data') and part.inline_data and part.inline_data.data:
+        # Raw bytes; generate_chat_events stores them and sends a URL instead
+        return {
+            "type": "image",
+            "bytes": part.inline_data.data,
+            "mime_type": part.inline_data.mime_type
         }
+    
+    return None
+
+def usage_to_dict(usage):
+    """Extract token counts from Gemini usage metadata"""
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "output_tokens": usage.candidates_token_count,
+        "total_tokens": usage.total_token_count
+    }
+
+class GenerationAttempt:
+    """One generation call for a chat message on one API key"""
+    
+    def __init__(self, key_index: int, message: ChatMessage, contents, config, estimated_tokens: int,
+                 profiles: Optional[list] = None):
+        self.key_index = key_index
+        self.message = message
+        self.contents = contents
+        self.config = config
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+        self.emitted = False
+        self.usage = None
+        self.chunks = 0
+        self.released = False
+        self.error_code = None
+        # When recording traffic, the attempt's entry in the flight's profiles, in launch order
+        self.profiles = profiles
+        self.profile = None
+        if profiles is not None:
+            self.profile = {"key": key_index, "outcome": None, "status": None, "duration_ms": None, "chunks": []}
+            profiles.append(self.profile)
+        self.events = self.run()
+    
+    async def run(self):
+        """Yield text/image events as chunks arrive, then a done event with finish/usage metadata"""
+        client = get_client(self.key_index)
+        finish_reason = None
         
-        function retryLastMessage() {
-            if (!lastMessageData || retryCount >= 3) return;
-            
-            // Remove the last error message
-            const messages = document.getElementById('chatMessages');
-            const errorMessages = messages.querySelectorAll('.message.error');
-            if (errorMessages.length > 0) {
-                errorMessages[errorMessages.length - 1].remove();
-            }
-            
-            // Restore the message data
-            document.getElementById('chatInput').value = lastMessageData.message;
-            uploadedImages = [...lastMessageData.images];
-            updateImagePreview();
-            document.getElementById('modelSelect').value = lastMessageData.model;
-            document.getElementById('generateImageCheck').checked = lastMessageData.generateImage;
-            
-            // Retry sending
-            sendMessage(true);
-        }
+        # The SDK leaves a stream it stops reading open until garbage collection, so the
+        # attempt closes its own responses as soon as it ends
+        responses = []
+        attempt_responses.set(responses)
         
-        function addMessage(text, sender, uploadedImages = null, generatedImages = null, model = null) {
-            const messagesContainer = document.getElementById('chatMessages');
-            const messageDiv = document.createElement('div');
-            messageDiv.className = 'message ' + sender;
-            
-            let content = '<div class="message-content">';
-            
-            // Add model badge for assistant messages
-            if (sender === 'assistant' && model) {
-                content += '<div class="model-badge">' + model + '</div>';
-            }
-            
-            if (text) {
-                content += '<div>' + escapeHtml(text) + '</div>';
-            }
+        try:
+            try:
+                # Use streaming so chunks can be forwarded as soon as they arrive
+                response_stream = await client.aio.models.generate_content_stream(
+                    model=self.message.model,
+                    contents=self.contents,
+                    config=self.config,
+                )
+                
+                async for chunk in response_stream:
+                    self.chunks += 1
+                    if self.profile is not None:
+                        self.log_chunk(chunk)
+                    if chunk.usage_metadata:
+                        self.usage = chunk.usage_metadata
+                    if chunk.candidates:
+                        candidate = chunk.candidates[0]
+                        if candidate.finish_reason:
+                            finish_reason = candidate.finish_reason
+                        if candidate.content and candidate.content.parts:
+                            for part in candidate.content.parts:
+                                event = part_to_event(part)
+                                if event:
+                                    self.emitted = True
+                                    yield event
+                
+                # Success - the stream completed
+                print(f"Successfully used API key index {self.key_index}")
             
-            // Display uploaded images
-            if (uploadedImages && uploadedImages.length > 0) {
-                if (uploadedImages.length === 1) {
-                    content += '<img src="' + uploadedImages[0] + '" class="message-image" onclick="openImage(this.src)" />';
-                } else {
-                    content += '<div class="image-gallery">';
-                    uploadedImages.forEach(img => {
-                        content += '<img src="' + img + '" onclick="openImage(this.src)" />';
-                    });
-                    content += '</div>';
-                }
-            }
+            except Exception as stream_error:
+                # Only a transient failure before any output is worth retrying on the same
+                # key; once output was sent, regenerating from scratch would duplicate it
+                if self.emitted or classify_error(stream_error) != ERROR_TRANSIENT:
+                    raise
+                
+                # Fallback to non-streaming if streaming fails
+                print(f"Streaming failed with key {self.key_index}, trying non-streaming: {str(stream_error)}")
+                upstream_fallbacks.inc((self.message.model, self.key_index))
+                
+                response = await client.aio.models.generate_content(
+                    model=self.message.model,
+                    contents=self.contents,
+                    config=self.config,
+                )
+                
+                self.usage = response.usage_metadata or self.usage
+                self.chunks += 1
+                if self.profile is not None:
+                    self.log_chunk(response)
+                if response.candidates:
+                    candidate = response.candidates[0]
+                    finish_reason = candidate.finish_reason or finish_reason
+                    if candidate.content and candidate.content.parts:
+                        for part in candidate.content.parts:
+                            event = part_to_event(part)
+                            if event:
+                                self.emitted = True
+                                yield event
             
-            // Display generated images
-            if (generatedImages && generatedImages.length > 0) {
-                if (generatedImages.length === 1) {
-                    content += '<img src="' + generatedImages[0] + '" class="message-image" onclick="openImage(this.src)" />';
-                } else {
-                    content += '<div class="image-gallery">';
-                    generatedImages.forEach(img => {
-                        content += '<img src="' + img + '" onclick="openImage(this.src)" />';
-                    });
-                    content += '</div>';
-                }
+            yield {
+                "type": "done",
+                "model": self.message.model,
+                "key_index": self.key_index,
+                "finish_reason": getattr(finish_reason, "value", finish_reason),
+                "usage": usage_to_dict(self.usage)
             }
-            
-            content += '</div>';
-            
-            messageDiv.innerHTML = content;
-            messagesContainer.appendChild(messageDiv);
-            messagesContainer.scrollTop = messagesContainer.scrollHeight;
-        }
-        
-        function escapeHtml(text) {
-            const div = document.createElement('div');
-            div.textContent = text;
-            return div.innerHTML;
-        }
-        
-        function openImage(src) {
-            window.open(src, '_blank');
-        }
-        
-        function showError(message) {
-            const errorDiv = document.getElementById('errorMessage');
-            errorDiv.textContent = message;
-            errorDiv.style.display = 'block';
-            setTimeout(() => {
-                errorDiv.style.display = 'none';
-            }, 5000);
-        }
-    </script>
-</body>
-</html>
+        finally:
+            for response in responses:
+                await response.aclose()
+    
+    def log_chunk(self, chunk):
+        """Note when a chunk arrived and how much text and image data it held"""
+        text_chars = image_bytes = 0
+        for candidate in chunk.candidates or []:
+            for part in (candidate.content.parts if candidate.content else None) or []:
+                if part.text:
+                    text_chars += len(part.text)
+                elif part.inline_data and part.inline_data.data:
+                    image_bytes += len(part.inline_data.data)
+        self.profile["chunks"].append([round((time.monotonic() - self.started) * 1000, 1), text_chars, image_bytes])
+    
+    def release(self, outcome: str, retry_after: Optional[float] = None):
+        """Hand the key back to the scheduler; only the first call has any effect"""
+        if self.released:
+            return
+        self.released = True
+        if self.profile is not None:
+            self.profile.update(
+                outcome=outcome, status=self.error_code,
+                duration_ms=round((time.monotonic() - self.started) * 1000, 1)
+            )
+        labels = (self.message.model, self.key_index)
+        upstream_attempts.inc(labels + (outcome,))
+        if outcome == "success":
+            upstream_duration.observe(labels, time.monotonic() - self.started)
+            upstream_chunks.observe(labels, self.chunks)
+        key_scheduler.release(
+            self.key_index, self.message.model, outcome,
+            tokens_reserved=self.estimated_tokens,
+            tokens_used=self.usage.total_token_count if self.usage and outcome == "success" else None,
+            retry_after=retry_after
+        )
+    
+    def fail(self, error: Exception) -> str:
+        """Release the key after an error and return the error kind"""
+        kind = classify_error(error)
+        self.error_code = getattr(error, "code", None)
+        self.release(kind, retry_after=get_retry_after(error) if kind == ERROR_QUOTA else None)
+        return kind
+    
+    async def cancel(self, task: Optional[asyncio.Task] = None):
+        """Abandon the attempt, closing its upstream stream"""
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+        await self.events.aclose()
+        self.release("released")
+
+def continuation_contents(contents, partial_text: str):
+    """Request contents that ask the model to continue from already generated text"""
+    # Partial images can't be resumed, so only the text goes into the model turn
+    return contents + [
+        types.Content(
+            role="model",
+            parts=[types.Part.from_text(text=partial_text)]
+        )
+    ]
+
+def trim_overlap(previous: str, continuation: str) -> str:
+    """Drop the start of a continuation that repeats the end of the previous text"""
+    for size in range(min(len(previous), len(continuation), RESUME_MAX_OVERLAP), RESUME_MIN_OVERLAP - 1, -1):
+        if previous.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
+async def with_first_event(event: dict, events):
+    """Put an already received first event back in front of the rest of the stream"""
+    yield event
+    async for event in events:
+        yield event
+
+async def splice_continuation(events, previous_text: str):
+    """Trim whatever a continuation restates from the end of the previous text
+    
+    The start of the continuation is held back until RESUME_MAX_OVERLAP characters
+    have arrived (or a non-text event does) so the overlap can be detected.
     """
+    buffer = ""
+    trimmed = False
+    async for event in events:
+        if not trimmed:
+            if event["type"] == "text":
+                buffer += event["text"]
+                if len(buffer) < RESUME_MAX_OVERLAP:
+                    continue
+            trimmed = True
+            text = trim_overlap(previous_text, buffer)
+            if text:
+                yield {"type": "text", "text": text}
+            if event["type"] == "text":
+                continue
+        yield event
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(message: ChatMessage):
-    """Handle chat messages and generate responses with automatic API key rotation"""
-    global current_key_index, failed_keys, client
+def record_ttft(model: str, seconds: float):
+    """Remember a time-to-first-token sample for hedging decisions"""
+    if model not in ttft_samples:
+        ttft_samples[model] = deque(maxlen=HEDGE_SAMPLE_SIZE)
+    ttft_samples[model].append(seconds)
+
+def hedge_delay(model: str) -> Optional[float]:
+    """How long to wait for a first chunk before hedging, or None to not hedge"""
+    if not HEDGE_ENABLED:
+        return None
+    samples = ttft_samples.get(model)
+    if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    threshold = ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+    return max(HEDGE_MIN_DELAY, threshold)
+
+def hedge_budget_available() -> bool:
+    """Check that hedges stay within the allowed share of extra upstream load"""
+    return hedge_stats["launched"] < HEDGE_MAX_EXTRA_LOAD * hedge_stats["requests"]
+
+async def first_event(attempt: GenerationAttempt, tried_keys: set):
+    """Wait for the attempt's first event, racing a hedge on another key if it is slow
+    
+    Returns the winning attempt and its first event. Losing and failed attempts are
+    released; if every attempt fails, the last error is raised.
+    """
+    first = asyncio.ensure_future(attempt.events.__anext__())
+    delay = hedge_delay(attempt.message.model)
+    pending = {first: attempt}
     
-    max_retries = len(API_KEYS)
-    retry_count = 0
+    if delay is not None:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if not done and hedge_budget_available():
+            # Only hedge onto a key that is ready right now
+            hedge_key = await key_scheduler.acquire(
+                attempt.message.model, attempt.estimated_tokens, exclude=tried_keys, timeout=0
+            )
+            if hedge_key is not None:
+                tried_keys.add(hedge_key)
+                hedge_stats["launched"] += 1
+                hedges_launched.inc((attempt.message.model,))
+                hedge = GenerationAttempt(
+                    hedge_key, attempt.message, attempt.contents, attempt.config, attempt.estimated_tokens,
+                    profiles=attempt.profiles
+                )
+                pending[asyncio.ensure_future(hedge.events.__anext__())] = hedge
+                print(f"Hedging slow request on key {attempt.key_index} with key {hedge_key}")
+    
+    hedged = len(pending) > 1
     last_error = None
     
-    while retry_count < max_retries:
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                candidate = pending.pop(task)
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    candidate.fail(last_error)
+                    continue
+                
+                if hedged:
+                    hedge_won = candidate is not attempt
+                    hedge_stats["wins" if hedge_won else "losses"] += 1
+                    hedge_results.inc((attempt.message.model, "win" if hedge_won else "loss"))
+                ttft = time.monotonic() - candidate.started
+                record_ttft(candidate.message.model, ttft)
+                upstream_ttft.observe((candidate.message.model, candidate.key_index), ttft)
+                return candidate, task.result()
+        
+        raise last_error
+    finally:
+        # Cancel the losers, or everything if we were cancelled ourselves
+        for task, loser in pending.items():
+            await loser.cancel(task)
+
+def decode_inline_images(images: List[ImageData]) -> list:
+    """Decode the base64 data of request images, rejecting malformed data with a 422"""
+    decoded = []
+    for index, image in enumerate(images):
+        if image.data is None:
+            continue
         try:
-            # Get current working client
-            client, key_index = get_working_client()
-            
-            # Build content parts
-            parts = []
-            
-            # Add text if present
-            if message.message:
-                # If requesting image generation, modify the prompt
-                if message.generate_image:
-                    parts.append(types.Part.from_text(
-                        text=f"Generate an image of: {message.message}"
-                    ))
-                else:
-                    parts.append(types.Part.from_text(text=message.message))
-            
-            # Add all uploaded images
-            for image in message.images:
-                image_bytes = base64.b64decode(image.data)
-                parts.append(types.Part.from_bytes(
-                    mime_type=image.mime_type,
-                    data=image_bytes
-                ))
-            
-            # If no content, return early
-            if not parts:
-                return ChatResponse(text="Please provide a message or upload images.", images=[])
-            
-            # Create content
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=parts
-                )
+            decoded.append(base64.b64decode(image.data))
+        except binascii.Error as e:
+            raise HTTPException(status_code=422, detail=f"Image {index} is not valid base64: {str(e)}")
+    return decoded
+
+async def decode_images(images: List[ImageData]):
+    """Resolve request images to (bytes, mime_type) pairs from base64 data or blob handles"""
+    # Large payloads are decoded in a worker thread to keep the event loop responsive
+    if sum(len(image.data) for image in images if image.data is not None) > INLINE_DECODE_LIMIT:
+        decoded = await run_in_threadpool(decode_inline_images, images)
+    else:
+        decoded = decode_inline_images(images)
+    decoded = iter(decoded)
+    
+    uploaded_images = []
+    for image in images:
+        if image.data is not None:
+            uploaded_images.append((next(decoded), image.mime_type))
+            continue
+        blob = await blob_store.get(image.handle) if is_blob_handle(image.handle) else None
+        if blob is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Unknown image handle '{image.handle}'. Upload the image again via POST /blobs."
+            )
+        uploaded_images.append(blob)
+    return uploaded_images
+
+class Flight:
+    """One upstream generation whose events are fanned out to every identical request riding on it
+    
+    Subscribers replay the events published so far and then follow along live, so a
+    request joining late still gets the whole response. The generation is cancelled
+    once its last subscriber leaves.
+    """
+    
+    def __init__(self, key: Optional[str] = None):
+        self.key = key
+        self.events = []
+        self.error = None
+        self.finished = False
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task = None
+        # Outcome each subscriber records in its own conversation
+        self.completed = False
+        self.text = ""
+        self.generated_images = []
+        self.model_tokens = None
+        self.first_event_at = None
+        self.quota_errors = 0
+        # API keys called for the generation, including hedges, and bytes generated
+        self.tried_keys = set()
+        self.output_bytes = 0
+        # Stages of the shared generation: admission queue, key wait, first token, streaming
+        self.timer = StageTimer()
+        # Upstream calls as written to the traffic recording
+        self.attempt_profiles = [] if traffic_recorder.enabled else None
+    
+    def start(self, producer):
+        """Run the producer coroutine in the background, open to joiners while it runs"""
+        if self.key:
+            in_flight[self.key] = self
+        single_flight_stats["flights"] += 1
+        self.task = asyncio.create_task(self._run(producer))
+    
+    def publish(self, event: dict):
+        if self.first_event_at is None:
+            self.first_event_at = time.monotonic()
+        self.events.append(event)
+        self._notify()
+    
+    async def subscribe(self):
+        """Yield the flight's events from the start, then raise its error if it failed"""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = self.changed
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            # Nobody is listening anymore; stop generating
+            if self.subscribers == 0 and not self.finished:
+                self._forget()
+                self.task.cancel()
+    
+    async def _run(self, producer):
+        try:
+            await producer
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._forget()
+            self._notify()
+    
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+    
+    def _forget(self):
+        if self.key and in_flight.get(self.key) is self:
+            del in_flight[self.key]
+
+def log_slow_request(message: ChatMessage, timer: StageTimer, source: str, conversation_id: str, image_count: int):
+    """Log a request that took longer than SLOW_REQUEST_THRESHOLD as one JSON line"""
+    total = timer.stages.get("total", 0)
+    if SLOW_REQUEST_THRESHOLD <= 0 or total < SLOW_REQUEST_THRESHOLD:
+        return
+    print(json.dumps({
+        "event": "slow_request",
+        "model": message.model,
+        "source": source,
+        "conversation_id": conversation_id,
+        "prompt_chars": len(message.message),
+        "images": image_count,
+        "generate_image": message.generate_image,
+        "total_ms": round(total * 1000, 2),
+        "timings": timer.milliseconds()
+    }))
+
+def record_traffic(message: ChatMessage, uploaded_images, history, timer: StageTimer, source: str,
+                   status_code: int, request_key: Optional[str] = None, attempts=None):
+    """Append the request's shape and its upstream calls to the traffic recording"""
+    traffic_recorder.write({
+        "t": round(time.time() - (time.monotonic() - timer.started), 3),
+        "model": message.model,
+        "prompt_chars": len(message.message),
+        "history_turns": len(history),
+        "history_chars": sum(len(turn.text) for turn in history),
+        "images": [len(data) for data, _ in uploaded_images],
+        "generate_image": message.generate_image,
+        "temperature": message.temperature,
+        "fingerprint": traffic_recorder.fingerprint(request_key),
+        "source": source,
+        "status": status_code,
+        "total_ms": round((time.monotonic() - timer.started) * 1000, 1),
+        "attempts": attempts or []
+    })
+
+def cacheable(message: ChatMessage) -> bool:
+    """Whether a request may be answered from or stored in the response cache"""
+    if not RESPONSE_CACHE_ENABLED:
+        return False
+    # Sampled responses are meant to vary between identical requests
+    if message.temperature != 0 and not RESPONSE_CACHE_ALLOW_SAMPLED:
+        response_cache.bypassed += 1
+        return False
+    return True
+
+async def request_fingerprint(model: str, contents, config) -> str:
+    """Canonical hash of everything that determines a response: model, config and contents"""
+    def digest():
+        canonical = {
+            "model": model,
+            "config": config.model_dump(mode="json", exclude_none=True),
+            "contents": [
+                [content.role, [
+                    ["text", part.text] if part.text is not None
+                    else ["image", part.inline_data.mime_type, hashlib.sha256(part.inline_data.data).hexdigest()]
+                    for part in content.parts
+                ]]
+                for content in contents
             ]
-            
-            # Configure generation based on model and request type
-            generate_content_config = types.GenerateContentConfig(
-                temperature=0.7,
-                top_p=0.95,
-                top_k=40,
-                max_output_tokens=8192,
+        }
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    # Hashing large images is done in a worker thread to keep the event loop responsive
+    image_bytes = sum(
+        len(part.inline_data.data) for content in contents for part in content.parts if part.inline_data
+    )
+    return await run_in_threadpool(digest) if image_bytes > INLINE_DECODE_LIMIT else digest()
+
+async def generate_chat_events(message: ChatMessage, uploaded_images=None, timer: Optional[StageTimer] = None):
+    """Generate a chat response as a stream of events with automatic API key rotation
+    
+    Yields {"type": "text"} and {"type": "image"} events as chunks arrive from the
+    model, followed by a single {"type": "done"} event carrying finish/usage metadata
+    and per-stage timings. Generated images are stored and sent as /images/ URLs.
+    uploaded_images are already decoded (bytes, mime_type) pairs; if omitted they are
+    decoded from message.images.
+    """
+    mark = time.monotonic()
+    timer = timer or StageTimer(mark)
+    conversation_id = message.conversation_id or uuid.uuid4().hex
+    if uploaded_images is None:
+        uploaded_images = await decode_images(message.images)
+        mark = timer.add("decode", mark)
+    
+    # Client-supplied history replaces the stored one; only stored history is summarized
+    summary = None
+    if message.history:
+        history = [Turn(turn.role, turn.text) for turn in message.history]
+    else:
+        history = conversation_store.get(conversation_id)
+        summary, summary_through = conversation_store.summary(conversation_id)
+        history = [turn for turn in history if turn.seq >= summary_through]
+    
+    # Send only the newest turns that fit the model's history budget
+    budget = MODEL_METADATA.get(message.model, {}).get("history_token_budget", DEFAULT_HISTORY_TOKEN_BUDGET)
+    summary_tokens = estimate_text_tokens(summary) if summary else 0
+    kept_history = fit_history(history, budget - summary_tokens)
+    omitted = history[:len(history) - len(kept_history)]
+    history_tokens = sum(turn.token_count() for turn in kept_history) + summary_tokens
+    prompt_tokens_saved = max(0, sum(turn.token_count() for turn in omitted) - summary_tokens)
+    if omitted and HISTORY_SUMMARY_ENABLED and not message.history:
+        schedule_history_summary(conversation_id, omitted)
+    
+    contents = await build_contents(message, uploaded_images, kept_history)
+    mark = timer.add("history", mark)
+    
+    # If no content, return early
+    if not contents:
+        yield {"type": "text", "text": "Please provide a message or upload images."}
+        yield {"type": "done", "model": message.model, "conversation_id": conversation_id, "finish_reason": None, "usage": None}
+        return
+    
+    generate_content_config = build_generation_config(
+        message, system_instruction=summary_instruction(summary) if summary else None
+    )
+    
+    # Requests with the same fingerprint would get the same response
+    request_key = None
+    if RESPONSE_CACHE_ENABLED or COALESCE_REQUESTS:
+        request_key = await request_fingerprint(message.model, contents, generate_content_config)
+        mark = timer.add("fingerprint", mark)
+    
+    # Serve repeated identical requests from the cache when every image they produced is still stored
+    cache_key = request_key if request_key and cacheable(message) else None
+    cached = await response_cache.get(cache_key) if cache_key else None
+    if cache_key:
+        mark = timer.add("cache", mark)
+    if cached:
+        cached_images = [await blob_store.get(image["handle"]) for image in cached["images"]]
+        if None in cached_images:
+            response_cache.discard(cache_key)
+        else:
+            if cached["text"]:
+                yield {"type": "text", "text": cached["text"]}
+            for image in cached["images"]:
+                yield {"type": "image", "url": f"/images/{image['handle']}", "mime_type": image["mime_type"]}
+            await conversation_store.append(
+                conversation_id, prompt_text(message), uploaded_images, cached["text"], cached_images
             )
-            
-            # Add response modalities for image-capable models when image generation is requested
-            if message.generate_image and "image" in message.model.lower():
-                generate_content_config = types.GenerateContentConfig(
-                    temperature=0.7,
-                    top_p=0.95,
-                    top_k=40,
-                    max_output_tokens=8192,
-                    response_modalities=["IMAGE", "TEXT"]
+            timer.finish()
+            chat_requests.inc((message.model, "cache"))
+            chat_request_duration.observe((message.model, "cache"), timer.stages["total"])
+            log_slow_request(message, timer, "cache", conversation_id, len(uploaded_images))
+            if traffic_recorder.enabled:
+                record_traffic(message, uploaded_images, kept_history, timer, "cache", 200, request_key)
+            yield {
+                "type": "done", "model": message.model, "conversation_id": conversation_id,
+                "prompt_tokens_saved": prompt_tokens_saved, "finish_reason": cached["finish_reason"],
+                "usage": None, "cached": True, "timings": timer.milliseconds()
+            }
+            return
+    
+    estimated_tokens = estimate_tokens(message, len(uploaded_images), history_tokens)
+    
+    # Identical requests already in flight share its upstream generation
+    source = "upstream"
+    flight = in_flight.get(request_key) if request_key and COALESCE_REQUESTS else None
+    if flight is None:
+        flight = Flight(request_key if COALESCE_REQUESTS else None)
+        flight.start(generate_admitted_response(
+            flight, message, contents, generate_content_config, estimated_tokens, len(uploaded_images), cache_key
+        ))
+    else:
+        single_flight_stats["coalesced"] += 1
+        source = "coalesced"
+    chat_requests.inc((message.model, source))
+    
+    subscription = flight.subscribe()
+    streaming = False
+    try:
+        async for event in subscription:
+            # Shared stages so far, for a Server-Timing header sent with the first event
+            timer.stages.update(flight.timer.stages)
+            if event["type"] != "done":
+                streaming = True
+                yield event
+                continue
+            if flight.completed:
+                await conversation_store.append(
+                    conversation_id, prompt_text(message), uploaded_images, flight.text, flight.generated_images,
+                    model_tokens=flight.model_tokens
+                )
+            timer.finish()
+            chat_request_duration.observe((message.model, source), timer.stages["total"])
+            log_slow_request(message, timer, source, conversation_id, len(uploaded_images))
+            if traffic_recorder.enabled:
+                record_traffic(
+                    message, uploaded_images, kept_history, timer, source, 200, request_key,
+                    flight.attempt_profiles if source == "upstream" else None
                 )
+            yield {
+                **event, "conversation_id": conversation_id, "prompt_tokens_saved": prompt_tokens_saved,
+                "timings": timer.milliseconds()
+            }
+    except HTTPException as e:
+        chat_request_errors.inc((message.model, e.status_code))
+        if traffic_recorder.enabled:
+            record_traffic(
+                message, uploaded_images, kept_history, timer, source, e.status_code, request_key,
+                flight.attempt_profiles if source == "upstream" else None
+            )
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client disconnected (or the consumer stopped reading) mid-request
+        chat_requests_cancelled.inc((message.model, source, "streaming" if streaming else "waiting"))
+        if traffic_recorder.enabled:
+            timer.finish()
+            record_traffic(
+                message, uploaded_images, kept_history, timer, source, CLIENT_CLOSED_REQUEST, request_key,
+                flight.attempt_profiles if source == "upstream" else None
+            )
+        raise
+    finally:
+        # Leave the flight now rather than when the subscription is garbage collected,
+        # so a generation nobody is waiting for anymore is cancelled right away
+        await subscription.aclose()
+
+def content_bytes(contents) -> int:
+    """Size of the text and inline image data in request contents"""
+    size = 0
+    for content in contents:
+        for part in content.parts:
+            text = part.text
+            if text:
+                # ASCII text is one byte per character, without encoding it
+                size += len(text) if text.isascii() else len(text.encode("utf-8"))
+            elif part.inline_data:
+                size += len(part.inline_data.data)
+    return size
+
+def workload_lane(message: ChatMessage, image_count: int) -> str:
+    """Admission lane of a request: image generation, image understanding or plain text"""
+    if message.generate_image and "image" in message.model.lower():
+        return "image_output"
+    if image_count:
+        return "vision"
+    return "text"
+
+async def generate_admitted_response(flight, message: ChatMessage, contents, generate_content_config,
+                                     estimated_tokens: int, image_count: int, cache_key: Optional[str]):
+    """Run generate_response once the admission controller has a slot for it in the request's lane"""
+    lane = workload_lane(message, image_count)
+    queued_at = time.monotonic()
+    admitted_at = await admission_controller.acquire(message.model, lane, estimated_tokens)
+    flight.timer.add("queue", queued_at)
+    try:
+        await generate_response(
+            flight, message, contents, generate_content_config, estimated_tokens, image_count, cache_key
+        )
+    finally:
+        admission_controller.release(
+            message.model, lane, admitted_at, flight.first_event_at, flight.quota_errors > 0
+        )
+        if flight.tried_keys:
+            chat_attempts.observe((message.model,), len(flight.tried_keys))
+            chat_input_bytes.inc((message.model,), content_bytes(contents) * len(flight.tried_keys))
+            chat_output_bytes.inc((message.model,), flight.output_bytes)
+
+async def generate_response(flight, message: ChatMessage, contents, generate_content_config, estimated_tokens: int,
+                            image_count: int, cache_key: Optional[str]):
+    """Generate the model's response with automatic API key rotation, publishing events to the flight
+    
+    Publishes text/image events and a final done event, or raises HTTPException.
+    """
+    hedge_stats["requests"] += 1
+    
+    tried_keys = flight.tried_keys
+    last_error = None
+    last_error_kind = None
+    
+    # Text already sent to the client, kept so a broken stream can be resumed
+    partial_text = ""
+    generated_images = []
+    generated_handles = []
+    resumes = 0
+    
+    while len(tried_keys) < min(MAX_KEY_ATTEMPTS + resumes, len(API_KEYS)):
+        # Reserve quota on the least loaded key that hasn't failed this request yet
+        mark = time.monotonic()
+        key_index = await key_scheduler.acquire(message.model, estimated_tokens, exclude=tried_keys)
+        mark = flight.timer.add("key", mark)
+        if key_index is None:
+            break
+        tried_keys.add(key_index)
+        if last_error_kind is not None:
+            key_rotations.inc((message.model, last_error_kind))
+        
+        attempt_contents = continuation_contents(contents, partial_text) if partial_text else contents
+        attempt = GenerationAttempt(
+            key_index, message, attempt_contents, generate_content_config, estimated_tokens,
+            profiles=flight.attempt_profiles
+        )
+        resuming = bool(partial_text)
+        forwarded = False
+        
+        try:
+            attempt, event = await first_event(attempt, tried_keys)
+            mark = flight.timer.add("ttft", mark)
             
-            # Generate response
-            response_text = ""
-            response_images = []
+            events = with_first_event(event, attempt.events)
+            if resuming:
+                events = splice_continuation(events, partial_text)
             
-            try:
-                # Use streaming for better handling of responses
-                response_stream = client.models.generate_content_stream(
-                    model=message.model,
-                    contents=contents,
-                    config=generate_content_config,
-                )
-                
-                for chunk in response_stream:
-                    if chunk.candidates and chunk.candidates[0].content:
-                        for part in chunk.candidates[0].content.parts:
-                            # Handle text
-                            if hasattr(part, 'text') and part.text:
-                                response_text += part.text
-                            
-                            # Handle inline data (images)
-                            elif hasattr(part, 'inline_data') and part.inline_data:
-                                if part.inline_data.data:
-                                    response_images.append({
-                                        "data": base64.b64encode(part.inline_data.data).decode('utf-8'),
-                                        "mime_type": part.inline_data.mime_type
-                                    })
-                
-                # Success - return the response
-                print(f"Successfully used API key index {key_index}")
-                
-            except Exception as stream_error:
-                # Fallback to non-streaming if streaming fails
-                print(f"Streaming failed with key {key_index}, trying non-streaming: {str(stream_error)}")
-                
-                response = client.models.generate_content(
-                    model=message.model,
-                    contents=contents,
-                    config=generate_content_config,
-                )
-                
-                if response.candidates and response.candidates[0].content:
-                    for part in response.candidates[0].content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            response_text += part.text
-                        elif hasattr(part, 'inline_data') and part.inline_data:
-                            if part.inline_data.data:
-                                response_images.append({
-                                    "data": base64.b64encode(part.inline_data.data).decode('utf-8'),
-                                    "mime_type": part.inline_data.mime_type
-                                })
+            async for event in events:
+                if event["type"] == "done":
+                    break
+                if event["type"] == "text":
+                    partial_text += event["text"]
+                    text = event["text"]
+                    flight.output_bytes += len(text) if text.isascii() else len(text.encode("utf-8"))
+                elif event["type"] == "image":
+                    flight.output_bytes += len(event["bytes"])
+                    generated_images.append((event["bytes"], event["mime_type"]))
+                    mark = flight.timer.add("stream", mark)
+                    handle, _ = await blob_store.put(event["bytes"], event["mime_type"])
+                    mark = flight.timer.add("store", mark)
+                    generated_handles.append({"handle": handle, "mime_type": event["mime_type"]})
+                    event = {"type": "image", "url": f"/images/{handle}", "mime_type": event["mime_type"]}
+                forwarded = True
+                flight.publish(event)
+            mark = flight.timer.add("stream", mark)
             
             # Ensure we have some response
-            if not response_text and not response_images:
-                if message.images:
-                    response_text = f"I've analyzed the {len(message.images)} image(s) you uploaded. How can I help you with them?"
+            if not attempt.emitted and not partial_text:
+                if image_count:
+                    text = f"I've analyzed the {image_count} image(s) you uploaded. How can I help you with them?"
                 else:
-                    response_text = "I've processed your request. How else can I help you?"
+                    text = "I've processed your request. How else can I help you?"
+                flight.publish({"type": "text", "text": text})
             
-            return ChatResponse(
-                text=response_text,
-                images=response_images
-            )
+            attempt.release("success")
+            
+            # The model turn's exact size is known from usage unless it was spliced together
+            if attempt.usage and attempt.usage.candidates_token_count and not resumes:
+                flight.model_tokens = attempt.usage.candidates_token_count
+            flight.text = partial_text
+            flight.generated_images = generated_images
+            flight.completed = True
+            # Only complete answers are worth replaying
+            if cache_key and event.get("finish_reason") == "STOP" and (partial_text or generated_handles):
+                ttl = MODEL_METADATA.get(message.model, {}).get("response_cache_ttl", DEFAULT_RESPONSE_CACHE_TTL)
+                await response_cache.put(
+                    cache_key, {"text": partial_text, "images": generated_handles, "finish_reason": "STOP"}, ttl
+                )
+            flight.publish(event)
+            return
             
         except Exception as e:
-            error_msg = str(e).lower()
             last_error = str(e)
+            last_error_kind = attempt.fail(e)
+            if last_error_kind == ERROR_QUOTA:
+                flight.quota_errors += 1
             
-            print(f"Error with API key {current_key_index}: {str(e)}")
-            
-            # Check if it's a quota/rate limit error
-            if any(err in error_msg for err in ['quota', 'rate', 'limit', '429', 'resource', 'exhaust']):
-                # Mark this key as failed and try next one
-                failed_keys.add(current_key_index)
-                current_key_index = (current_key_index + 1) % len(API_KEYS)
-                retry_count += 1
-                
-                # If we haven't tried all keys yet, continue
-                if retry_count < max_retries:
-                    print(f"Rate limit hit, rotating to API key index {current_key_index}")
-                    time.sleep(0.5)  # Small delay before retry
-                    continue
+            print(f"Error with API key {attempt.key_index} ({last_error_kind}): {str(e)}")
             
-            # For non-quota errors, provide specific error messages
-            if "model not found" in error_msg:
+            # Problems with the request itself fail the same way on every key
+            if last_error_kind == ERROR_CLIENT:
+                if isinstance(e, errors.APIError) and e.code == 404:
+                    raise HTTPException(
+                        status_code=400, 
+                        detail=f"Model '{message.model}' is not available. Please try a different model."
+                    )
                 raise HTTPException(
-                    status_code=400, 
-                    detail=f"Model '{message.model}' is not available. Please try a different model."
+                    status_code=400,
+                    detail=f"The model rejected the request: {getattr(e, 'message', None) or last_error}"
                 )
-            else:
-                # Try next key for any other error too
-                failed_keys.add(current_key_index)
-                current_key_index = (current_key_index + 1) % len(API_KEYS)
-                retry_count += 1
-                
-                if retry_count < max_retries:
-                    print(f"Error occurred, trying next API key index {current_key_index}")
-                    continue
+            
+            # Output already sent can't be retracted; continue from it on another key
+            if forwarded or partial_text:
+                if not partial_text or resumes >= RESUME_MAX_ATTEMPTS:
+                    raise HTTPException(
+                        status_code=502,
+                        detail=f"Response interrupted. Please try again. Error: {last_error}"
+                    )
+                resumes += 1
+                print(f"Stream broke on key {attempt.key_index} after {len(partial_text)} chars, resuming on another key")
+                continue
+            
+            print(f"Trying another API key after failure on index {attempt.key_index}")
+            
+        finally:
+            # Abandoned mid-stream (client went away or the request was cancelled)
+            if not attempt.released:
+                await attempt.cancel()
     
     # If all retries failed
-    print(f"All API keys exhausted. Failed keys: {failed_keys}")
-    
-    # Reset failed keys for next attempt
-    if len(failed_keys) >= len(API_KEYS):
-        failed_keys = set()
-        return ChatResponse(
-            text="I'm experiencing high demand right now. Please try again in a moment.",
-            images=[]
+    print(f"No API key could serve the request. Keys tried: {sorted(tried_keys)}")
+    
+    if partial_text:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Response interrupted. Please try again. Error: {last_error}"
         )
     
+    # Nothing failed outright, the keys are just out of quota for now
+    if last_error_kind in (None, ERROR_QUOTA):
+        flight.publish({"type": "text", "text": "I'm experiencing high demand right now. Please try again in a moment."})
+        flight.publish({"type": "done", "model": message.model, "finish_reason": None, "usage": None})
+        return
+    
     raise HTTPException(
         status_code=503,
         detail=f"Service temporarily unavailable. Please try again. Error: {last_error}"
     )
 
+# Response headers for Server-Sent Events streams
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"  # Disable proxy buffering so events flush immediately
+}
+
+def format_sse(event: dict, event_id: Optional[int] = None) -> str:
+    """Format an event as a Server-Sent Events frame"""
+    frame = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return frame if event_id is None else f"id: {event_id}\n{frame}"
+
+async def wait_for_disconnect(request: Request):
+    """Return once the client has disconnected; the request body must already be read"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def unless_disconnected(request: Request, awaitable):
+    """Await a step of chat generation, cancelling it if the client disconnects first
+    
+    Starlette only watches for disconnects while a streaming body is being sent, so
+    without this a non-streaming request, or a stream still waiting for its first
+    event, keeps its upstream call and key busy for an answer nobody will read.
+    """
+    work = asyncio.ensure_future(awaitable)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait((work, disconnected), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+        if not work.done():
+            work.cancel()
+            # Let the generation unwind and close its upstream stream before moving on
+            await asyncio.wait((work,))
+    if work.cancelled():
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed the request")
+    return work.result()
+
+async def collect_chat_response(events) -> ChatResponse:
+    """Aggregate chat events into a single ChatResponse"""
+    return build_chat_response([event async for event in events])
+
+def build_chat_response(events) -> ChatResponse:
+    """Aggregate a list of chat events into a single ChatResponse"""
+    response_text = ""
+    response_images = []
+    conversation_id = None
+    prompt_tokens_saved = 0
+    timings = None
+    
+    for event in events:
+        if event["type"] == "text":
+            response_text += event["text"]
+        elif event["type"] == "image":
+            response_images.append({
+                "url": event["url"],
+                "mime_type": event["mime_type"]
+            })
+        elif event["type"] == "done":
+            conversation_id = event["conversation_id"]
+            prompt_tokens_saved = event.get("prompt_tokens_saved", 0)
+            timings = event.get("timings")
+    
+    return ChatResponse(
+        text=response_text,
+        images=response_images,
+        conversation_id=conversation_id,
+        prompt_tokens_saved=prompt_tokens_saved,
+        timings=timings
+    )
+
+async def sse_response(events, timer: Optional[StageTimer] = None,
+                       request: Optional[Request] = None) -> StreamingResponse:
+    """Stream chat events to the client as Server-Sent Events
+    
+    The Server-Timing header covers the stages up to the first event; the done event
+    carries the timings of the whole request. Given the request, a client that
+    disconnects while the first event is awaited cancels the generation.
+    """
+    # Wait for the first event so a request that fails before any output (rejected,
+    # shed under load) gets a real status code instead of a 200 stream with an error
+    try:
+        first = await (unless_disconnected(request, anext(events)) if request else anext(events))
+    except StopAsyncIteration:
+        first = None
+    except HTTPException:
+        await events.aclose()
+        raise
+    
+    async def event_stream():
+        try:
+            if first is not None:
+                yield format_sse(first)
+            async for event in events:
+                yield format_sse(event)
+        except HTTPException as e:
+            yield format_sse({"type": "error", "status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            print(f"Streaming chat failed: {str(e)}")
+            yield format_sse({"type": "error", "status_code": 500, "detail": str(e)})
+    
+    headers = {**SSE_HEADERS, "Server-Timing": timer.header()} if timer else SSE_HEADERS
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+async def read_form_chat(message: str, model: str, generate_image: bool, temperature: Optional[float],
+                         conversation_id: Optional[str], history: str, images: List[UploadFile]):
+    """Build a ChatMessage and raw image bytes from a multipart chat request"""
+    try:
+        chat_message = ChatMessage(
+            message=message,
+            model=model,
+            generate_image=generate_image,
+            temperature=temperature,
+            conversation_id=conversation_id or None,
+            history=json.loads(history)
+        )
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid chat form: {str(e)}")
+    
+    uploaded_images = []
+    for image in images:
+        mime_type = normalize_image_type(image.content_type)
+        if mime_type is None:
+            raise HTTPException(
+                status_code=415, detail=f"'{image.filename}' is not a supported image ({', '.join(IMAGE_TYPES)})"
+            )
+        # Parts above the spool threshold are already on disk; reading them runs in a thread
+        uploaded_images.append((await image.read(), mime_type))
+        await image.close()
+    return chat_message, uploaded_images
+
+class Job:
+    """A chat generation run by a background worker, independent of any client connection
+    
+    Events are numbered from 0 in the order they were published, so an events stream
+    can be resumed from the last id a client saw.
+    """
+    
+    def __init__(self, message: ChatMessage, idempotency_key: Optional[str], fingerprint: str):
+        self.id = uuid.uuid4().hex
+        self.message = message
+        self.idempotency_key = idempotency_key
+        self.fingerprint = fingerprint
+        self.status = "queued"
+        self.events = []
+        self.error = None
+        self.changed = asyncio.Event()
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.text_chars = 0
+        self.image_count = 0
+        self.publish({"type": "status", "status": "queued"})
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+    
+    def publish(self, event: dict):
+        if event["type"] == "text":
+            self.text_chars += len(event["text"])
+        elif event["type"] == "image":
+            self.image_count += 1
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+    
+    async def subscribe(self, start: int = 0):
+        """Yield (id, event) pairs from the given event id on, until the job has finished"""
+        index = start
+        while True:
+            changed = self.changed
+            while index < len(self.events):
+                yield index, self.events[index]
+                index += 1
+            if self.finished:
+                return
+            await changed.wait()
+    
+    def snapshot(self) -> dict:
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": {"events": len(self.events), "text_chars": self.text_chars, "images": self.image_count},
+            "status_url": f"/jobs/{self.id}",
+            "events_url": f"/jobs/{self.id}/events"
+        }
+        if self.status == "succeeded":
+            job["result"] = build_chat_response(self.events).model_dump()
+        elif self.status == "failed":
+            job["error"] = self.error
+        return job
+
+class JobStore:
+    """Queued chat jobs run by a fixed pool of worker tasks, with results kept for a TTL
+    
+    Jobs run to completion whether or not anyone is watching. A job submitted again
+    under the same idempotency key returns the existing job for as long as it is kept.
+    Finished jobs expire oldest first, after the TTL or past the retention limit.
+    """
+    
+    def __init__(self, workers: int, queue_size: int, ttl: float, max_finished: int):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.idempotency_keys = {}
+        self.finished = OrderedDict()  # job id -> monotonic finish time, oldest first
+        self.queue = None
+        self.workers = []
+        self.submitted = 0
+        self.deduplicated = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.expired = 0
+    
+    def submit(self, message: ChatMessage, idempotency_key: Optional[str] = None):
+        """Queue a job for the message; returns the job and whether it was newly created"""
+        self._evict()
+        fingerprint = hashlib.sha256(message.model_dump_json().encode("utf-8")).hexdigest()
+        
+        if idempotency_key is not None:
+            if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+                raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+            existing = self.jobs.get(self.idempotency_keys.get(idempotency_key))
+            if existing is not None:
+                if existing.fingerprint != fingerprint:
+                    raise HTTPException(status_code=409, detail="Idempotency-Key was already used for a different request")
+                self.deduplicated += 1
+                return existing, False
+        
+        self._start_workers()
+        if self.queue.full():
+            raise HTTPException(
+                status_code=503,
+                detail="Too many queued jobs. Please try again later.",
+                headers={"Retry-After": "30"}
+            )
+        
+        job = Job(message, idempotency_key, fingerprint)
+        self.jobs[job.id] = job
+        if idempotency_key is not None:
+            self.idempotency_keys[idempotency_key] = job.id
+        self.queue.put_nowait(job)
+        self.submitted += 1
+        return job, True
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        self._evict()
+        return self.jobs.get(job_id)
+    
+    def stats(self):
+        return {
+            "workers": self.worker_count,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "jobs": len(self.jobs),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "expired": self.expired
+        }
+    
+    def _start_workers(self):
+        # Started on first use so the queue and tasks belong to the running event loop
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+    
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                print(f"Job {job.id} worker error: {str(e)}")
+            finally:
+                self.queue.task_done()
+    
+    async def _run(self, job: Job):
+        job.status = "running"
+        job.started_at = datetime.now().isoformat()
+        job.publish({"type": "status", "status": "running"})
+        
+        events = generate_chat_events(job.message)
+        try:
+            async for event in events:
+                job.publish(event)
+            job.status = "succeeded"
+            self.succeeded += 1
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                job.error = {"status_code": e.status_code, "detail": e.detail}
+            else:
+                print(f"Job {job.id} failed: {str(e)}")
+                job.error = {"status_code": 500, "detail": str(e)}
+            job.status = "failed"
+            self.failed += 1
+            job.publish({"type": "error", **job.error})
+        finally:
+            await events.aclose()
+            job.finished_at = datetime.now().isoformat()
+            # Image payloads aren't needed once the job has run
+            job.message = None
+            self.finished[job.id] = time.monotonic()
+            job.changed.set()
+    
+    def _evict(self):
+        """Drop finished jobs past the TTL, then the oldest beyond the retention limit"""
+        now = time.monotonic()
+        while self.finished:
+            job_id, finished_at = next(iter(self.finished.items()))
+            if now - finished_at <= self.ttl and len(self.finished) <= self.max_finished:
+                break
+            del self.finished[job_id]
+            job = self.jobs.pop(job_id)
+            if job.idempotency_key is not None and self.idempotency_keys.get(job.idempotency_key) == job_id:
+                del self.idempotency_keys[job.idempotency_key]
+            self.expired += 1
+
+# Background chat jobs that outlive the request that created them
+job_store = JobStore(
+    workers=JOB_WORKERS,
+    queue_size=JOB_QUEUE_SIZE,
+    ttl=JOB_RESULT_TTL,
+    max_finished=MAX_FINISHED_JOBS
+)
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(message: ChatMessage, request: Request, response: Response):
+    """Handle chat messages and generate responses with automatic API key rotation"""
+    timer = request_timer(request)
+    chat_response = await unless_disconnected(
+        request, collect_chat_response(generate_chat_events(message, timer=timer))
+    )
+    response.headers["Server-Timing"] = timer.header()
+    return chat_response
+
+@app.post("/chat/stream")
+async def chat_stream(message: ChatMessage, request: Request):
+    """Stream chat responses as Server-Sent Events as soon as each chunk arrives"""
+    timer = request_timer(request)
+    return await sse_response(generate_chat_events(message, timer=timer), timer, request)
+
+@app.post("/chat/upload", response_model=ChatResponse)
+async def chat_upload(
+    request: Request,
+    response: Response,
+    message: str = Form(""),
+    model: str = Form("gemini-2.0-flash-exp"),
+    generate_image: bool = Form(False),
+    temperature: Optional[float] = Form(None),
+    conversation_id: Optional[str] = Form(None),
+    history: str = Form("[]"),  # JSON list of {"role", "text"} turns
+    images: List[UploadFile] = File([])
+):
+    """Handle a multipart chat request with images sent as binary file parts"""
+    timer = request_timer(request)
+    mark = time.monotonic()
+    chat_message, uploaded_images = await read_form_chat(
+        message, model, generate_image, temperature, conversation_id, history, images
+    )
+    timer.add("parse", mark)
+    chat_response = await unless_disconnected(
+        request, collect_chat_response(generate_chat_events(chat_message, uploaded_images, timer))
+    )
+    response.headers["Server-Timing"] = timer.header()
+    return chat_response
+
+@app.post("/chat/upload/stream")
+async def chat_upload_stream(
+    request: Request,
+    message: str = Form(""),
+    model: str = Form("gemini-2.0-flash-exp"),
+    generate_image: bool = Form(False),
+    temperature: Optional[float] = Form(None),
+    conversation_id: Optional[str] = Form(None),
+    history: str = Form("[]"),  # JSON list of {"role", "text"} turns
+    images: List[UploadFile] = File([])
+):
+    """Stream the response to a multipart chat request as Server-Sent Events"""
+    timer = request_timer(request)
+    mark = time.monotonic()
+    chat_message, uploaded_images = await read_form_chat(
+        message, model, generate_image, temperature, conversation_id, history, images
+    )
+    timer.add("parse", mark)
+    return await sse_response(generate_chat_events(chat_message, uploaded_images, timer), timer, request)
+
+@app.post("/jobs", status_code=202)
+async def create_job(message: ChatMessage, request: Request, response: Response):
+    """Queue a chat request as a background job and return its id without waiting for it
+    
+    Send an Idempotency-Key header to make retries safe: a repeated key returns the
+    job it first created instead of starting another generation.
+    """
+    job, created = job_store.submit(message, request.headers.get("idempotency-key"))
+    if not created:
+        response.status_code = 200
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return job.snapshot()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get a job's status and progress, and its result once it has finished"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.snapshot()
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, request: Request):
+    """Stream a job's events as Server-Sent Events, replaying those already published
+    
+    A reconnecting client's Last-Event-ID header resumes the stream after that event.
+    Disconnecting only stops the stream; the job keeps running.
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    try:
+        start = int(request.headers.get("last-event-id", "-1")) + 1
+    except ValueError:
+        start = 0
+    
+    async def event_stream():
+        async for event_id, event in job.subscribe(max(start, 0)):
+            yield format_sse(event, event_id)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/blobs")
+async def upload_blob(file: UploadFile = File(...)):
+    """Store an image once and return a handle that chat messages can reference"""
+    mime_type = normalize_image_type(file.content_type)
+    if mime_type is None:
+        raise HTTPException(
+            status_code=415, detail=f"'{file.filename}' is not a supported image ({', '.join(IMAGE_TYPES)})"
+        )
+    if file.size is not None and file.size > BLOB_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {BLOB_MAX_BYTES} bytes")
+    
+    data = await file.read()
+    await file.close()
+    handle, created = await blob_store.put(data, mime_type)
+    return {"handle": handle, "mime_type": mime_type, "size": len(data), "created": created}
+
+@app.head("/blobs/{handle}")
+async def check_blob(handle: str):
+    """Check whether a blob is stored, so clients can skip uploading it again"""
+    mime_type = blob_store.mime_type(handle)
+    if mime_type is None:
+        return Response(status_code=404)
+    return Response(headers={"Content-Type": mime_type})
+
+@app.api_route("/images/{handle}", methods=["GET", "HEAD"])
+async def get_image(handle: str, request: Request):
+    """Serve a stored image by content hash; the content never changes, so it is cached forever"""
+    mime_type = blob_store.mime_type(handle) if is_blob_handle(handle) else None
+    if mime_type is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    headers = {
+        "ETag": f'"{handle}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        # Never let a browser run stored content as a page of this origin
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "default-src 'none'; sandbox"
+    }
+    # Blobs of any other type (e.g. left over from before the allowlist) are only downloaded
+    if mime_type not in IMAGE_TYPES:
+        headers["Content-Disposition"] = f'attachment; filename="{handle}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or f'"{handle}"' in if_none_match:
+        return Response(status_code=304, headers=headers)
+    
+    # Files are streamed with Range support; memory-only blobs are sent whole
+    path = blob_store.path(handle)
+    if path is not None:
+        try:
+            # Stat here rather than in FileResponse, which fails with a 500 if a put
+            # has evicted the file in the meantime
+            stat = await run_in_threadpool(os.stat, path)
+        except OSError:
+            stat = None
+        if stat is not None:
+            return FileResponse(path, media_type=mime_type, headers=headers, stat_result=stat)
+    # Gone from disk: blob_store.get serves a copy still in memory or forgets it
+    blob = await blob_store.get(handle)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=blob[0], media_type=mime_type, headers=headers)
+
+@app.websocket("/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Multiplex concurrent chat requests over one WebSocket connection
+    
+    Client frames are {"type": "chat", "id": ..., <ChatMessage fields>} to start a
+    request and {"type": "cancel", "id": ...} to stop one. Server frames are the
+    events of generate_chat_events tagged with the request id.
+    """
+    await websocket.accept()
+    
+    tasks = {}
+    send_lock = asyncio.Lock()
+    
+    async def send(event: dict):
+        async with send_lock:
+            try:
+                await websocket.send_json(event)
+            except Exception:
+                pass  # Connection already closed; the receive loop cancels remaining work
+    
+    async def run(request_id, message: ChatMessage):
+        events = generate_chat_events(message)
+        try:
+            async for event in events:
+                await send({"id": request_id, **event})
+        except HTTPException as e:
+            error = {"id": request_id, "type": "error", "status_code": e.status_code, "detail": e.detail}
+            if e.headers and "Retry-After" in e.headers:
+                error["retry_after"] = int(e.headers["Retry-After"])
+            await send(error)
+        except Exception as e:
+            print(f"WebSocket chat {request_id} failed: {str(e)}")
+            await send({"id": request_id, "type": "error", "status_code": 500, "detail": str(e)})
+        finally:
+            # Close the generator so an abandoned upstream stream is released promptly
+            await events.aclose()
+            # After a cancel the id may already belong to a newer request
+            if tasks.get(request_id) is asyncio.current_task():
+                del tasks[request_id]
+    
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+            except ValueError:
+                await send({"type": "error", "status_code": 400, "detail": "Frame is not valid JSON"})
+                continue
+            
+            request_id = frame.get("id") if isinstance(frame, dict) else None
+            
+            if request_id is None:
+                await send({"type": "error", "status_code": 400, "detail": "Frame must be an object with an 'id'"})
+                continue
+            
+            # Ids key the task table, so they must be hashable scalars
+            if isinstance(request_id, bool) or not isinstance(request_id, (str, int)):
+                await send({"type": "error", "status_code": 400, "detail": "Frame 'id' must be a string or an integer"})
+                continue
+            
+            if frame.get("type") == "cancel":
+                task = tasks.pop(request_id, None)
+                if task:
+                    task.cancel()
+                    await send({"id": request_id, "type": "cancelled", "detail": "Request cancelled"})
+                continue
+            
+            if frame.get("type") != "chat":
+                await send({"id": request_id, "type": "error", "status_code": 400, "detail": f"Unknown frame type: {frame.get('type')}"})
+                continue
+            
+            if request_id in tasks:
+                await send({"id": request_id, "type": "error", "status_code": 409, "detail": "Request id already in flight"})
+                continue
+            
+            try:
+                message = ChatMessage.model_validate(frame)
+            except ValidationError as e:
+                await send({"id": request_id, "type": "error", "status_code": 422, "detail": e.errors(include_url=False, include_context=False)})
+                continue
+            
+            tasks[request_id] = asyncio.create_task(run(request_id, message))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+
 @app.get("/models")
 async def get_models():
     """Get list of available models"""
-    return {"models": AVAILABLE_MODELS}
+    return {
+        "models": AVAILABLE_MODELS,
+        "metadata": MODEL_METADATA,
+        "default_max_image_dimension": DEFAULT_MAX_IMAGE_DIMENSION
+    }
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint with API key status"""
-    global failed_keys, current_key_index
+    cooling_down = key_scheduler.cooling_down()
     
     return {
         "status": "healthy", 
         "available_models": AVAILABLE_MODELS,
         "total_api_keys": len(API_KEYS),
-        "working_keys": len(API_KEYS) - len(failed_keys),
-        "current_key_index": current_key_index,
-        "failed_keys": list(failed_keys)
+        "working_keys": len(API_KEYS) - len(cooling_down),
+        "failed_keys": cooling_down,
+        "key_scheduler": key_scheduler.snapshot(),
+        "hedging": {"enabled": HEDGE_ENABLED, **hedge_stats},
+        "conversations": conversation_store.stats(),
+        "blobs": blob_store.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": {"enabled": COALESCE_REQUESTS, "in_flight": len(in_flight), **single_flight_stats},
+        "admission": {"adaptive": ADMISSION_ADAPTIVE, **admission_controller.snapshot()},
+        "jobs": job_store.stats(),
+        "traffic_recording": traffic_recorder.stats()
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Request, latency and API key metrics in the Prometheus text format"""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/reset-keys")
 async def reset_api_keys():
     """Reset failed API keys to retry them"""
-    global failed_keys, current_key_index
-    
-    old_failed = len(failed_keys)
-    failed_keys = set()
-    current_key_index = 0
+    old_failed = len(key_scheduler.cooling_down())
+    key_scheduler.reset()
     
     return {
         "message": "API keys reset successfully",
@@ -0,0 +1,86 @@
+"""Micro-benchmark of the /metrics instrumentation on the request path
+
+Simulates the metric updates one successful single-attempt chat request makes
+(request count and duration, upstream attempt, time to first token, duration and
+chunks, attempts per request and bytes in and out, including sizing the prompt)
+across every model and key, and reports the cost per request next to an empty
+loop. Rendering /metrics once all series exist is timed as well.
+
+    python bench_metrics.py [--requests 200000] [--repeat 5] [--max-us 10]
+
+Exits non-zero if the best run costs more than --max-us microseconds per request.
+"""
+import argparse
+import os
+import sys
+import time
+
+# Blobs in memory only, so importing the app leaves nothing on disk
+os.environ.setdefault("BLOB_DIR", "")
+import app as chat_app
+from google.genai import types
+
+def sample_contents():
+    """A prompt of the usual shape: two history turns, a question and a small image"""
+    return [
+        types.Content(role="user", parts=[types.Part.from_text(text="Describe the picture I sent earlier " * 4)]),
+        types.Content(role="model", parts=[types.Part.from_text(text="It shows a river at dusk with a bridge " * 6)]),
+        types.Content(role="user", parts=[
+            types.Part.from_text(text="What colour is the bridge?"),
+            types.Part.from_bytes(data=b"\x89PNG\r\n\x1a\n" + bytes(2048), mime_type="image/png")
+        ])
+    ]
+
+def record_request(model: str, key: int, contents):
+    """The metric updates of one successful request that made a single upstream call"""
+    chat_app.chat_requests.inc((model, "upstream"))
+    chat_app.upstream_ttft.observe((model, key), 0.42)
+    chat_app.upstream_attempts.inc((model, key, "success"))
+    chat_app.upstream_duration.observe((model, key), 1.3)
+    chat_app.upstream_chunks.observe((model, key), 12)
+    chat_app.chat_attempts.observe((model,), 1)
+    chat_app.chat_input_bytes.inc((model,), chat_app.content_bytes(contents))
+    chat_app.chat_output_bytes.inc((model,), 480)
+    chat_app.chat_request_duration.observe((model, "upstream"), 1.4)
+
+def run(requests: int, contents, instrumented: bool) -> float:
+    """Seconds to simulate the given number of requests, spread over models and keys"""
+    models = chat_app.AVAILABLE_MODELS
+    keys = len(chat_app.API_KEYS) or 1
+    started = time.perf_counter()
+    for index in range(requests):
+        model = models[index % len(models)]
+        key = index % keys
+        if instrumented:
+            record_request(model, key, contents)
+    return time.perf_counter() - started
+
+def main(args) -> int:
+    contents = sample_contents()
+    baseline = min(run(args.requests, contents, False) for _ in range(args.repeat))
+    instrumented = min(run(args.requests, contents, True) for _ in range(args.repeat))
+    per_request_us = (instrumented - baseline) / args.requests * 1e6
+
+    started = time.perf_counter()
+    text = chat_app.render_metrics()
+    render_ms = (time.perf_counter() - started) * 1000
+
+    sizing_started = time.perf_counter()
+    for _ in range(args.requests):
+        chat_app.content_bytes(contents)
+    sizing_us = (time.perf_counter() - sizing_started) / args.requests * 1e6
+
+    print(f"{args.requests} requests, best of {args.repeat} runs")
+    print(f"instrumentation: {per_request_us:.2f} us per request (of which prompt sizing {sizing_us:.2f} us)")
+    print(f"rendering /metrics: {render_ms:.2f} ms for {len(text.splitlines())} lines")
+    if per_request_us > args.max_us:
+        print(f"FAIL: over the budget of {args.max_us} us per request")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the metric updates made by one chat request")
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-us", type=float, default=10.0, help="Budget per request in microseconds")
+    sys.exit(main(parser.parse_args()))
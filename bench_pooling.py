@@ -0,0 +1,105 @@
+"""Micro-benchmark of pooled Gemini clients against a local HTTPS stub
+
+Serves fake_gemini.py over TLS with a throwaway self-signed certificate, answering
+at once, and makes the same generate_content calls two ways: with a new genai.Client
+per call, as get_working_client() used to, and with the app's long-lived per-key
+clients from get_client(). Reports the time per call of each, rotating over the keys
+like the app does.
+
+    python bench_pooling.py [--calls 200] [--keys 9]
+
+Needs the openssl command to create the certificate.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import certifi
+import httpx
+import loadtest
+
+MODEL = "gemini-2.0-flash-exp"
+
+def make_certificate(directory: str):
+    """Self-signed certificate and key for 127.0.0.1, and a CA bundle of the usual
+    public roots that also trusts it; returns their paths"""
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"
+        ],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # Loading the full bundle is much of what a fresh client costs, so keep it
+    bundle = os.path.join(directory, "bundle.pem")
+    with open(bundle, "w", encoding="ascii") as out:
+        for path in (certifi.where(), cert):
+            with open(path, encoding="ascii") as f:
+                out.write(f.read() + "\n")
+    return cert, key, bundle
+
+async def time_calls(calls: int, keys: int, client_for) -> list:
+    """Seconds taken by each of a run of sequential calls"""
+    durations = []
+    for index in range(calls):
+        started = time.perf_counter()
+        client = client_for(index % keys)
+        await client.aio.models.generate_content(model=MODEL, contents=f"ping {index}")
+        durations.append(time.perf_counter() - started)
+    return durations
+
+async def main(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix="bench-pooling-")
+    cert, key, bundle = make_certificate(directory)
+    port = loadtest.free_port()
+    base_url = f"https://127.0.0.1:{port}"
+
+    # Read by the SDK, httpx and the app when they build their SSL contexts
+    os.environ["SSL_CERT_FILE"] = bundle
+    os.environ["GEMINI_BASE_URL"] = base_url
+    os.environ.setdefault("BLOB_DIR", "")
+    import app as chat_app
+    from google import genai
+    from google.genai import types
+
+    stub = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "fake_gemini:app", "--host", "127.0.0.1", "--port", str(port),
+            "--ssl-keyfile", key, "--ssl-certfile", cert, "--log-level", "warning"
+        ],
+        cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        await loadtest.wait_until_up(f"{base_url}/_fake/stats")
+        async with httpx.AsyncClient() as admin:
+            await admin.post(f"{base_url}/_fake/config", json={"ttft": 0, "chunk_interval": 0, "chunks": 1})
+
+        keys = min(args.keys, len(chat_app.API_KEYS))
+        unpooled = await time_calls(args.calls, keys, lambda key_index: genai.Client(
+            api_key=chat_app.API_KEYS[key_index], http_options=types.HttpOptions(base_url=base_url)
+        ))
+        pooled = await time_calls(args.calls, keys, chat_app.get_client)
+    finally:
+        stub.terminate()
+        stub.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{args.calls} sequential calls over {keys} keys to a local HTTPS stub that answers at once")
+    print(f"{'client':<12} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, durations in (("per call", unpooled), ("pooled", pooled)):
+        summary = loadtest.percentiles(durations)
+        print(f"{name:<12} {summary['mean']:>9} {summary['p50']:>9} {summary['p99']:>9}")
+    saved = (sum(unpooled) - sum(pooled)) / args.calls * 1000
+    print(f"pooling saves {saved:.2f} ms per call")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Gemini calls with and without pooled clients")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--keys", type=int, default=9, help="Keys to rotate over")
+    asyncio.run(main(parser.parse_args()))
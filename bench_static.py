@@ -0,0 +1,94 @@
+"""Benchmark of the main page: bytes on the wire per visit and GET / throughput
+
+Calls the app in-process as an ASGI application, since over HTTP the client is the
+bottleneck. A first visit fetches / and every /static/ asset it references, with and
+without compression; a repeat visit revalidates / with its ETag, the assets being
+cached as immutable. Bytes are response bodies as sent, before any decompression. Throughput is
+sequential GET / requests, full responses and 304s.
+
+    python bench_static.py [--requests 5000]
+
+Only the app object is used, so running it from a checkout of an older revision gives
+the numbers to compare against.
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+# Blobs in memory only, so importing the app leaves nothing on disk
+os.environ.setdefault("BLOB_DIR", "")
+import app as chat_app
+
+BROWSER_ENCODINGS = "gzip, deflate, br"
+
+async def fetch(path: str, headers: dict):
+    """Status, headers and raw body of a GET request made straight to the ASGI app"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode("ascii"), "query_string": b"",
+        "root_path": "", "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000), "server": ("bench", 80)
+    }
+    response = {"status": None, "headers": {}, "body": b""}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode("latin-1"): value.decode("latin-1") for name, value in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await chat_app.app(scope, receive, send)
+    return response
+
+async def first_visit(accept_encoding: str) -> dict:
+    """Body bytes of / and of each static asset it references"""
+    headers = {"accept-encoding": accept_encoding}
+    page = await fetch("/", headers)
+    sizes = {"/": len(page["body"])}
+    # Every variant holds the same markup, so read the asset URLs from the identity one
+    markup = (await fetch("/", {"accept-encoding": "identity"}))["body"].decode("utf-8")
+    for url in sorted(set(re.findall(r'(?:src|href)="(/static/[^"]+)"', markup))):
+        sizes[url] = len((await fetch(url, headers))["body"])
+    return {"sizes": sizes, "etag": page["headers"].get("etag")}
+
+async def throughput(requests: int, headers: dict) -> float:
+    """Sequential GET / requests per second"""
+    started = time.perf_counter()
+    for _ in range(requests):
+        await fetch("/", headers)
+    return requests / (time.perf_counter() - started)
+
+async def main(args) -> int:
+    compressed = await first_visit(BROWSER_ENCODINGS)
+    identity = await first_visit("identity")
+    revalidate = {"accept-encoding": BROWSER_ENCODINGS}
+    if compressed["etag"]:
+        revalidate["if-none-match"] = compressed["etag"]
+    repeat = await fetch("/", revalidate)
+
+    # Warm up, then time full pages and revalidations
+    await throughput(min(args.requests, 200), {"accept-encoding": BROWSER_ENCODINGS})
+    full_rate = await throughput(args.requests, {"accept-encoding": BROWSER_ENCODINGS})
+    revalidate_rate = await throughput(args.requests, revalidate)
+
+    print(f"{'first visit':<28} {'identity':>9} {BROWSER_ENCODINGS:>18}")
+    for url in compressed["sizes"]:
+        print(f"{url:<28} {identity['sizes'].get(url, '-'):>9} {compressed['sizes'][url]:>18}")
+    print(f"{'total':<28} {sum(identity['sizes'].values()):>9} {sum(compressed['sizes'].values()):>18}")
+    print(f"repeat visit: / answers {repeat['status']} with {len(repeat['body'])} bytes")
+    print(f"GET / throughput over {args.requests} sequential requests:")
+    print(f"  full page   {full_rate:>9.0f} req/s")
+    print(f"  revalidated {revalidate_rate:>9.0f} req/s (status {repeat['status']})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure bytes on the wire and throughput of the main page")
+    parser.add_argument("--requests", type=int, default=5000)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,109 @@
+"""Benchmark of image uploads on the JSON/base64 and multipart chat paths
+
+Starts a fresh app and fake Gemini server for each path and sends chat requests
+carrying --images random images of --size-mb each: base64 in a JSON body to /chat,
+and as binary file parts to /chat/upload. Reports the time the app spent reading and
+decoding the request (the parse and decode stages of its Server-Timing header), the
+whole request time, and the app process's peak RSS above its RSS once warmed up, read
+from /proc/<pid>/status.
+
+    python bench_upload.py [--images 10] [--size-mb 5] [--runs 3]
+
+Linux only, for /proc.
+"""
+import argparse
+import asyncio
+import base64
+import random
+import statistics
+import sys
+import time
+import httpx
+import loadtest
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def process_memory(pid: int) -> dict:
+    """Current (VmRSS) and peak (VmHWM) resident set size of a process, in MB"""
+    memory = {}
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                memory[name] = int(value.split()[0]) / 1024
+    return memory
+
+def random_images(count: int, size: int, rng: random.Random) -> list:
+    """Incompressible image-sized payloads; the app doesn't look past the mime type"""
+    return [PNG_SIGNATURE + rng.randbytes(size - len(PNG_SIGNATURE)) for _ in range(count)]
+
+async def send_json(client: httpx.AsyncClient, message: str, images: list) -> httpx.Response:
+    body = {
+        "message": message,
+        "images": [{"data": base64.b64encode(image).decode("ascii"), "mime_type": "image/png"} for image in images]
+    }
+    return await client.post("/chat", json=body)
+
+async def send_multipart(client: httpx.AsyncClient, message: str, images: list) -> httpx.Response:
+    files = [("images", (f"image{index}.png", image, "image/png")) for index, image in enumerate(images)]
+    return await client.post("/chat/upload", data={"message": message}, files=files)
+
+async def bench_path(name: str, send, args) -> dict:
+    """Time uploads on one path against a fresh app, and track the app's memory"""
+    app_url, fake_url, processes = loadtest.spawn_servers(app_rate_limits=False)
+    app_pid = processes[0].pid
+    rng = random.Random(f"{args.seed}:{name}")
+    try:
+        await loadtest.wait_until_up(f"{fake_url}/_fake/stats")
+        await loadtest.wait_until_up(f"{app_url}/health")
+        async with httpx.AsyncClient(base_url=app_url, timeout=300) as client:
+            await client.post(f"{fake_url}/_fake/config", json={"ttft": 0, "chunk_interval": 0, "chunks": 1})
+            # Warm up with a small upload so imports and pools don't count
+            (await send(client, "warm up", random_images(1, 1024, rng))).raise_for_status()
+            baseline = process_memory(app_pid)["VmRSS"]
+
+            parse, total = [], []
+            for run in range(args.runs):
+                # Fresh bytes and prompt every run, so neither dedup nor the response cache kicks in
+                images = random_images(args.images, int(args.size_mb * 1024 * 1024), rng)
+                started = time.perf_counter()
+                response = await send(client, f"Describe these pictures ({run})", images)
+                total.append((time.perf_counter() - started) * 1000)
+                response.raise_for_status()
+                timings = loadtest.parse_server_timing(response.headers.get("server-timing", ""))
+                parse.append(timings.get("parse", 0) + timings.get("decode", 0))
+        peak = process_memory(app_pid)["VmHWM"]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    return {
+        "path": name,
+        "parse_ms": round(statistics.median(parse), 1),
+        "request_ms": round(statistics.median(total), 1),
+        "baseline_mb": round(baseline, 1),
+        "peak_increase_mb": round(peak - baseline, 1)
+    }
+
+async def main(args) -> int:
+    results = [
+        await bench_path("json", send_json, args),
+        await bench_path("multipart", send_multipart, args)
+    ]
+    print(f"{args.runs} requests per path, each with {args.images} x {args.size_mb} MB images")
+    print(f"{'path':<10} {'parse ms':>9} {'request ms':>10} {'RSS warm MB':>11} {'peak RSS +MB':>12}")
+    for result in results:
+        print(
+            f"{result['path']:<10} {result['parse_ms']:>9} {result['request_ms']:>10} "
+            f"{result['baseline_mb']:>11} {result['peak_increase_mb']:>12}"
+        )
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON/base64 and multipart image uploads")
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--size-mb", type=float, default=5)
+    parser.add_argument("--runs", type=int, default=3, help="Requests per path")
+    parser.add_argument("--seed", type=int, default=1)
+    sys.exit(asyncio.run(main(parser.parse_args())))
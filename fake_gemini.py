@@ -0,0 +1,414 @@
+"""Deterministic stand-in for the Gemini API, for load tests and local experiments
+
+Speaks the v1beta generateContent and streamGenerateContent (alt=sse) protocol, so
+the app can be pointed at it with GEMINI_BASE_URL and no quota is spent. Latency,
+chunking, image output and injected errors are configurable. Every random choice
+comes from a generator seeded with the seed, the API key, the request body and how
+many times that key has sent that body, so a replayed request behaves the same way.
+
+    python fake_gemini.py --port 8001 [--config fake.json] [--seed 1]
+    GEMINI_BASE_URL=http://127.0.0.1:8001 uvicorn app:app
+
+GET /_fake/stats reports what was served, POST /_fake/config changes the behaviour
+at runtime and POST /_fake/reset clears the counters. Requests whose prompt carries a
+[replay:<id>] marker are answered from the recorded upstream calls in "scripts"
+instead, with their recorded timing, chunk sizes and errors (see replay.py).
+"""
+import argparse
+import asyncio
+import base64
+import copy
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from collections import deque
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+app = FastAPI()
+
+# Behaviour when not overridden. Durations are in seconds and may be a number or a
+# distribution: {"dist": "fixed", "value"}, {"dist": "uniform", "low", "high"},
+# {"dist": "exponential", "mean"} or {"dist": "lognormal", "median", "sigma"}
+DEFAULT_CONFIG = {
+    "seed": 0,
+    # Delay before the first chunk, and between the following ones
+    "ttft": {"dist": "lognormal", "median": 0.3, "sigma": 0.4},
+    "chunk_interval": {"dist": "uniform", "low": 0.01, "high": 0.04},
+    # Text chunks per response (rounded) and characters per chunk
+    "chunks": {"dist": "uniform", "low": 4, "high": 12},
+    "chunk_chars": 40,
+    # Image returned after the text when the request asks for the IMAGE modality
+    "image_bytes": 256 * 1024,
+    "image_mime_type": "image/png",
+    # Probability of failing a request with each status, and how long that takes
+    "error_rates": {"429": 0.0, "500": 0.0, "503": 0.0},
+    "error_latency": 0.05,
+    # Probability of cutting a stream off halfway through
+    "stream_break_rate": 0.0,
+    # Characters from the end of an interrupted answer that a request to continue it
+    # repeats before going on, as real models often do
+    "resume_overlap_chars": 0,
+    # Requests each API key may make per minute before getting 429 (0 is unlimited)
+    "key_rpm": 0,
+    # Retry delay (seconds) advertised with injected 429s
+    "retry_delay": 7,
+    # Replay id -> the upstream calls recorded for it, served in order to requests
+    # carrying its marker; each is {"outcome", "status", "duration_ms", "chunks"}
+    # with chunks as [offset_ms, text_chars, image_bytes]
+    "scripts": {}
+}
+
+# Error bodies in the shape the Gemini API returns them
+ERROR_STATUSES = {
+    400: "INVALID_ARGUMENT",
+    403: "PERMISSION_DENIED",
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE"
+}
+
+# Status for recorded failures that carry none, by the app's error kind
+SCRIPTED_ERROR_STATUSES = {"quota": 429, "auth": 403, "transient": 503, "client": 400}
+
+REPLAY_MARKER = re.compile(r"\[replay:(\w+)\]")
+
+# Output token estimate per generated image
+IMAGE_TOKENS = 1290
+
+WORDS = (
+    "the model streams tokens while the server forwards each chunk to the client as soon as "
+    "it arrives so latency stays low even for long answers about images keys quotas and caches"
+).split()
+
+class InjectedStreamBreak(ConnectionResetError):
+    """Raised to cut a response stream off on purpose"""
+
+class HideInjectedBreaks(logging.Filter):
+    """Keep deliberate stream breaks out of the server's error log"""
+
+    def filter(self, record):
+        return not (record.exc_info and isinstance(record.exc_info[1], InjectedStreamBreak))
+
+config = copy.deepcopy(DEFAULT_CONFIG)
+key_windows = {}  # API key -> timestamps of its requests in the last minute
+seen = {}  # (API key, body hash) -> times seen
+image_payloads = {}  # (size, seed) -> base64 image data
+script_positions = {}  # replay id -> scripted calls served
+stats = {}
+
+def reset_stats():
+    """Clear counters, per-key windows and replay positions"""
+    key_windows.clear()
+    seen.clear()
+    script_positions.clear()
+    stats.clear()
+    stats.update({
+        "requests": 0,
+        "streaming": 0,
+        "by_status": {},
+        "by_key": {},
+        "stream_breaks": 0,
+        "images": 0,
+        "scripted": 0,
+        "bytes_in": 0,
+        "bytes_out": 0,
+        "in_flight": 0,
+        "max_in_flight": 0
+    })
+
+reset_stats()
+
+def sample(spec, rng: random.Random) -> float:
+    """Draw a value from a number or distribution spec"""
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    dist = spec.get("dist", "fixed")
+    if dist == "fixed":
+        return float(spec["value"])
+    if dist == "uniform":
+        return rng.uniform(spec["low"], spec["high"])
+    if dist == "exponential":
+        return rng.expovariate(1 / spec["mean"])
+    if dist == "lognormal":
+        return spec["median"] * rng.lognormvariate(0, spec["sigma"])
+    raise ValueError(f"Unknown distribution: {dist}")
+
+def image_payload(size: int, seed) -> str:
+    """Base64 of a deterministic fake PNG of the given size, built once per size"""
+    key = (size, seed)
+    if key not in image_payloads:
+        rng = random.Random(f"{seed}:image:{size}")
+        data = b"\x89PNG\r\n\x1a\n" + rng.randbytes(max(0, size - 8))
+        image_payloads[key] = base64.b64encode(data).decode("ascii")
+    return image_payloads[key]
+
+def error_response(status_code: int, message: str, retry_delay: float = None) -> JSONResponse:
+    error = {"code": status_code, "message": message, "status": ERROR_STATUSES.get(status_code, "UNKNOWN")}
+    if retry_delay is not None:
+        error["details"] = [{
+            "@type": "type.googleapis.com/google.rpc.RetryInfo",
+            "retryDelay": f"{max(1, int(retry_delay))}s"
+        }]
+    return JSONResponse({"error": error}, status_code=status_code)
+
+def chunk_payload(parts, finish_reason=None, usage=None) -> dict:
+    candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    payload = {"candidates": [candidate]}
+    if usage:
+        payload["usageMetadata"] = usage
+    return payload
+
+def filler_text(length: int, rng: random.Random) -> str:
+    text = ""
+    while len(text) < length:
+        text += rng.choice(WORDS) + " "
+    return text[:length]
+
+def usage_metadata(prompt_bytes: int, output_chars: int, image_count: int) -> dict:
+    prompt_tokens = prompt_bytes // 4 + 1
+    output_tokens = output_chars // 4 + 1 + IMAGE_TOKENS * image_count
+    return {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": output_tokens,
+        "totalTokenCount": prompt_tokens + output_tokens
+    }
+
+def plan_response(body: dict, rng: random.Random, prompt_bytes: int):
+    """Decide the chunks of a response: (delay, parts) pairs, the usage, the chunk the
+    stream breaks at (None if it doesn't) and the number of images"""
+    modalities = [m.upper() for m in (body.get("generationConfig") or {}).get("responseModalities") or []]
+    chunk_count = max(1, round(sample(config["chunks"], rng)))
+
+    # A request ending with a model turn asks to continue that answer
+    last = (body.get("contents") or [{}])[-1]
+    overlap = ""
+    if last.get("role") == "model" and config["resume_overlap_chars"]:
+        previous = "".join(part.get("text", "") for part in last.get("parts", []))
+        overlap = previous[-config["resume_overlap_chars"]:]
+
+    plan = []
+    output_chars = 0
+    for index in range(chunk_count):
+        delay = sample(config["ttft"] if index == 0 else config["chunk_interval"], rng)
+        text = filler_text(config["chunk_chars"], rng)
+        if index == 0:
+            text = overlap + text
+        plan.append((delay, [{"text": text}]))
+        output_chars += len(text)
+
+    image_count = 0
+    if "IMAGE" in modalities and config["image_bytes"]:
+        image = {"inlineData": {"mimeType": config["image_mime_type"], "data": image_payload(config["image_bytes"], config["seed"])}}
+        plan.append((sample(config["chunk_interval"], rng), [image]))
+        image_count = 1
+
+    break_at = len(plan) // 2 if rng.random() < config["stream_break_rate"] else None
+    return plan, usage_metadata(prompt_bytes, output_chars, image_count), break_at, image_count
+
+def scripted_call(body: dict):
+    """The next recorded upstream call for a request carrying a replay marker, if any"""
+    if not config["scripts"]:
+        return None
+    # Newest first: a resumed stream appends its continuation after the prompt
+    for content in reversed(body.get("contents", [])):
+        for part in content.get("parts", []):
+            match = REPLAY_MARKER.search(part.get("text", ""))
+            if match:
+                calls = config["scripts"].get(match.group(1))
+                if not calls:
+                    return None
+                # Once the recorded calls run out, the last one is repeated
+                position = script_positions.get(match.group(1), 0)
+                script_positions[match.group(1)] = position + 1
+                return calls[min(position, len(calls) - 1)]
+    return None
+
+def plan_scripted(call: dict, rng: random.Random, prompt_bytes: int):
+    """Rebuild a recorded upstream call's chunks at their recorded offsets, ending with a
+    break if the call failed after sending output; same shape as plan_response"""
+    plan = []
+    output_chars = image_count = 0
+    previous = 0
+    for offset, text_chars, image_bytes in call["chunks"]:
+        parts = []
+        if text_chars:
+            parts.append({"text": filler_text(text_chars, rng)})
+            output_chars += text_chars
+        if image_bytes:
+            parts.append({"inlineData": {"mimeType": config["image_mime_type"], "data": image_payload(image_bytes, config["seed"])}})
+            image_count += 1
+        plan.append((max(0, offset - previous) / 1000, parts))
+        previous = offset
+
+    break_at = None
+    if call["outcome"] not in ("success", "released"):
+        plan.append((max(0, call["duration_ms"] - previous) / 1000, []))
+        break_at = len(plan) - 1
+    elif not plan:
+        plan.append((call["duration_ms"] / 1000, []))
+    return plan, usage_metadata(prompt_bytes, output_chars, image_count), break_at, image_count
+
+def key_rate_limited(api_key: str):
+    """Seconds until the key may make another request, or None if it is within key_rpm"""
+    if not config["key_rpm"]:
+        return None
+    now = time.monotonic()
+    window = key_windows.setdefault(api_key, deque())
+    while window and now - window[0] >= 60:
+        window.popleft()
+    if len(window) >= config["key_rpm"]:
+        return 60 - (now - window[0])
+    window.append(now)
+    return None
+
+def record(api_key: str, status_code: int):
+    status = str(status_code)
+    stats["by_status"][status] = stats["by_status"].get(status, 0) + 1
+    # Keys are only identified by their tail so reports don't spread them further
+    key_stats = stats["by_key"].setdefault(api_key[-4:], {"requests": 0, "by_status": {}})
+    key_stats["requests"] += 1
+    key_stats["by_status"][status] = key_stats["by_status"].get(status, 0) + 1
+
+@app.post("/{version}/models/{model_action}")
+async def generate(version: str, model_action: str, request: Request):
+    """Handle generateContent and streamGenerateContent calls"""
+    model, _, action = model_action.partition(":")
+    if action not in ("generateContent", "streamGenerateContent"):
+        raise HTTPException(status_code=404, detail=f"Unsupported method: {action}")
+
+    raw = await request.body()
+    api_key = request.headers.get("x-goog-api-key") or request.query_params.get("key") or ""
+    stats["requests"] += 1
+    stats["bytes_in"] += len(raw)
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        record(api_key, 400)
+        return error_response(400, "Request body is not valid JSON")
+
+    # Seed from the request itself so identical traffic gets identical behaviour
+    digest = hashlib.sha256(raw).hexdigest()
+    occurrence = seen[(api_key, digest)] = seen.get((api_key, digest), 0) + 1
+    rng = random.Random(f"{config['seed']}:{api_key}:{model}:{digest}:{occurrence}")
+
+    prompt_bytes = sum(
+        len(part.get("text", "")) + len((part.get("inlineData") or {}).get("data", "")) * 3 // 4
+        for content in body.get("contents", []) for part in content.get("parts", [])
+    )
+
+    call = scripted_call(body)
+    if call is not None:
+        # Replayed traffic: the recording decides the outcome, not the injection settings
+        stats["scripted"] += 1
+        status = call["status"] or SCRIPTED_ERROR_STATUSES.get(call["outcome"])
+        if status and not call["chunks"]:
+            await asyncio.sleep(call["duration_ms"] / 1000)
+            record(api_key, status)
+            return error_response(status, "Replayed error", config["retry_delay"] if status == 429 else None)
+        plan, usage, break_at, image_count = plan_scripted(call, rng, prompt_bytes)
+    else:
+        retry_after = key_rate_limited(api_key)
+        if retry_after is not None:
+            record(api_key, 429)
+            return error_response(429, f"Quota exceeded for key (key_rpm={config['key_rpm']})", retry_after)
+
+        roll = rng.random()
+        for status, rate in config["error_rates"].items():
+            if roll < rate:
+                await asyncio.sleep(sample(config["error_latency"], rng))
+                record(api_key, int(status))
+                if int(status) == 429:
+                    return error_response(429, "Injected quota error", config["retry_delay"])
+                return error_response(int(status), f"Injected error {status}")
+            roll -= rate
+
+        plan, usage, break_at, image_count = plan_response(body, rng, prompt_bytes)
+    record(api_key, 200)
+    stats["images"] += image_count
+
+    if action == "generateContent":
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(sum(delay for delay, _ in plan))
+        finally:
+            stats["in_flight"] -= 1
+        if break_at is not None:
+            return error_response(503, "Injected failure")
+        parts = [part for _, chunk_parts in plan for part in chunk_parts]
+        response = JSONResponse(chunk_payload(parts, "STOP", usage))
+        stats["bytes_out"] += len(response.body)
+        return response
+
+    stats["streaming"] += 1
+
+    async def stream():
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            for index, (delay, parts) in enumerate(plan):
+                await asyncio.sleep(delay)
+                if index == break_at:
+                    stats["stream_breaks"] += 1
+                    raise InjectedStreamBreak("Injected stream break")
+                last = index == len(plan) - 1
+                frame = "data: " + json.dumps(chunk_payload(parts, "STOP" if last else None, usage if last else None)) + "\r\n\r\n"
+                stats["bytes_out"] += len(frame)
+                yield frame
+        finally:
+            stats["in_flight"] -= 1
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/_fake/stats")
+async def get_stats():
+    """What has been served since the last reset"""
+    return stats
+
+@app.get("/_fake/config")
+async def get_config():
+    return config
+
+@app.post("/_fake/config")
+async def update_config(request: Request):
+    """Start from the defaults, apply the given overrides and reset the counters"""
+    overrides = await request.json()
+    unknown = set(overrides) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown settings: {sorted(unknown)}")
+    config.clear()
+    config.update(copy.deepcopy(DEFAULT_CONFIG))
+    config.update(overrides)
+    reset_stats()
+    return config
+
+@app.post("/_fake/reset")
+async def reset():
+    reset_stats()
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deterministic fake Gemini API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--config", help="JSON file of settings overriding DEFAULT_CONFIG")
+    parser.add_argument("--seed", type=int, help="Seed for every random choice")
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config.update(json.load(f))
+    if args.seed is not None:
+        config["seed"] = args.seed
+
+    print(f"Fake Gemini API listening on http://{args.host}:{args.port}")
+    server = uvicorn.Server(uvicorn.Config(app, host=args.host, port=args.port, log_level="warning"))
+    logging.getLogger("uvicorn.error").addFilter(HideInjectedBreaks())
+    server.run()
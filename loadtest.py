@@ -0,0 +1,479 @@
+"""Load-test scenarios for the chat app, run against the fake Gemini server
+
+Each scenario configures fake_gemini.py, fires its requests at the app with a fixed
+concurrency and reports throughput, time to first token and latency percentiles.
+Results are written as JSON so runs can be compared for regressions.
+
+    python loadtest.py --spawn                        # start the fake and the app on free ports
+    python loadtest.py --app http://127.0.0.1:8000 --fake http://127.0.0.1:8001
+    python loadtest.py --spawn --scenario text_burst --requests 500 --output report.json
+
+Request payloads are generated from a seed, and the fake seeds its behaviour from
+each request, so repeated runs send and receive the same traffic. The run exits
+non-zero if a scenario breaks one of its bounds.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Optional
+import httpx
+
+# Shortest run of characters that counts as text repeated within one answer; the
+# fake's filler text practically never repeats this much by chance
+REPEAT_WINDOW = 48
+
+# Scenarios in the order they run; "fake" overrides fake_gemini.DEFAULT_CONFIG.
+# Key exhaustion runs last because it leaves keys cooling down
+SCENARIOS = {
+    "text_burst": {
+        "description": "Short text prompts streamed back, many at once",
+        "endpoint": "/chat/stream",
+        "requests": 200,
+        "concurrency": 50,
+        "fake": {"ttft": {"dist": "lognormal", "median": 0.3, "sigma": 0.4}}
+    },
+    "concurrent_chat": {
+        "description": "Non-streaming /chat calls that each take half a second upstream, 50 in flight at once",
+        "endpoint": "/chat",
+        "requests": 200,
+        "concurrency": 50,
+        "fake": {"ttft": {"dist": "fixed", "value": 0.5}, "chunks": 4}
+    },
+    "identical_prompts": {
+        "description": "The same few prompts asked over and over at once; duplicates should share an upstream call",
+        "endpoint": "/chat/stream",
+        "requests": 200,
+        "concurrency": 50,
+        "distinct_prompts": 5,
+        "fake": {"ttft": {"dist": "lognormal", "median": 0.5, "sigma": 0.3}}
+    },
+    "image_upload": {
+        "description": "Multipart uploads of a 256 KB image with a question about it",
+        "endpoint": "/chat/upload",
+        "requests": 50,
+        "concurrency": 10,
+        "image_bytes": 256 * 1024,
+        "fake": {"ttft": {"dist": "lognormal", "median": 0.6, "sigma": 0.3}}
+    },
+    "image_generation": {
+        "description": "Image generation returning a 1 MB image, streamed",
+        "endpoint": "/chat/stream",
+        "requests": 30,
+        "concurrency": 10,
+        "model": "gemini-2.5-flash-image-preview",
+        "generate_image": True,
+        "fake": {"ttft": {"dist": "uniform", "low": 1.0, "high": 3.0}, "image_bytes": 1024 * 1024}
+    },
+    "client_disconnect": {
+        "description": "Clients that give up after a second, before or during the stream; upstream calls must stop",
+        "endpoint": "/chat/stream",
+        "requests": 50,
+        "concurrency": 25,
+        "disconnect_after": 1.0,
+        "fake": {
+            "ttft": {"dist": "uniform", "low": 0.5, "high": 1.5},
+            "chunks": 60,
+            "chunk_interval": 0.2
+        }
+    },
+    "stream_breaks": {
+        "description": "Half the upstream streams break midway and are resumed on another key; answers must not repeat text",
+        "endpoint": "/chat/stream",
+        "requests": 100,
+        "concurrency": 20,
+        "check_repeats": True,
+        "fake": {
+            "ttft": {"dist": "fixed", "value": 0.2},
+            "chunks": 8,
+            "stream_break_rate": 0.5,
+            "resume_overlap_chars": REPEAT_WINDOW + 20
+        }
+    },
+    "key_exhaustion": {
+        "description": "More traffic than the keys' upstream quota, so requests rotate keys and degrade",
+        "endpoint": "/chat/stream",
+        "requests": 100,
+        "concurrency": 20,
+        "fake": {"key_rpm": 3, "ttft": {"dist": "fixed", "value": 0.2}}
+    }
+}
+
+# Percentiles reported for latency and time to first token
+PERCENTILES = (50, 95, 99)
+
+# How long to wait for spawned servers to come up
+STARTUP_TIMEOUT = 60
+
+# Longest the fake may keep streaming after the last client disconnected
+DISCONNECT_CLOSE_BOUND = 1.0
+
+# Fallback text the app sends when every key is out of quota
+DEGRADED_PREFIX = "I'm experiencing high demand"
+
+def build_request(scenario: dict, index: int, rng: random.Random) -> dict:
+    """Keyword arguments for the httpx request of one scenario request"""
+    if scenario.get("distinct_prompts"):
+        message = f"Popular question {index % scenario['distinct_prompts']}: what happened today?"
+        return {"json": {"message": message, "model": scenario.get("model", "gemini-2.0-flash-exp")}}
+    words = " ".join(rng.choice(("cats", "rivers", "engines", "stars", "bread", "code")) for _ in range(8))
+    message = f"Request {index}: tell me about {words}"
+    if scenario["endpoint"] == "/chat/upload":
+        # Distinct bytes per request so nothing is answered from a cache or coalesced
+        image = b"\x89PNG\r\n\x1a\n" + rng.randbytes(scenario["image_bytes"] - 8)
+        return {
+            "data": {"message": message, "model": scenario.get("model", "gemini-2.0-flash-exp")},
+            "files": [("images", (f"image{index}.png", image, "image/png"))]
+        }
+    payload = {"message": message, "model": scenario.get("model", "gemini-2.0-flash-exp")}
+    if scenario.get("generate_image"):
+        payload["generate_image"] = True
+    return {"json": payload}
+
+def parse_server_timing(header: str) -> dict:
+    """Stage durations (ms) from a Server-Timing header"""
+    timings = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if name and params.startswith("dur="):
+            timings[name] = float(params[4:])
+    return timings
+
+async def run_request(client: httpx.AsyncClient, scenario: dict, kwargs: dict) -> dict:
+    """Send one request and measure it; streams are read event by event"""
+    result = {
+        "status": None, "latency": None, "ttft": None, "outcome": "ok", "timings": None, "images": 0,
+        "text": "", "error_status": None
+    }
+    started = time.perf_counter()
+    try:
+        if scenario["endpoint"].endswith("/stream"):
+            async with client.stream("POST", scenario["endpoint"], **kwargs) as response:
+                result["status"] = response.status_code
+                if response.status_code != 200:
+                    await response.aread()
+                    result["outcome"] = "http_error"
+                else:
+                    text = ""
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[6:])
+                        if event["type"] in ("text", "image") and result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - started
+                        if event["type"] == "text":
+                            text += event["text"]
+                        elif event["type"] == "image":
+                            result["images"] += 1
+                        elif event["type"] == "done":
+                            result["timings"] = event.get("timings")
+                        elif event["type"] == "error":
+                            result["outcome"] = "stream_error"
+                            result["error_status"] = event.get("status_code")
+                    result["text"] = text
+                    if text.startswith(DEGRADED_PREFIX):
+                        result["outcome"] = "degraded"
+        else:
+            response = await client.post(scenario["endpoint"], **kwargs)
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                result["outcome"] = "http_error"
+            else:
+                body = response.json()
+                result["images"] = len(body.get("images", []))
+                result["timings"] = body.get("timings") or parse_server_timing(response.headers.get("server-timing", ""))
+                # Not streamed, so the app's own measurement is the only time to first token
+                if result["timings"].get("ttft") is not None:
+                    result["ttft"] = result["timings"]["ttft"] / 1000
+                if body.get("text", "").startswith(DEGRADED_PREFIX):
+                    result["outcome"] = "degraded"
+    except httpx.HTTPError as e:
+        result["outcome"] = f"client_error:{type(e).__name__}"
+    result["latency"] = time.perf_counter() - started
+    return result
+
+def repeats_text(text: str) -> bool:
+    """Whether some REPEAT_WINDOW characters of an answer occur in it twice"""
+    seen = set()
+    for start in range(len(text) - REPEAT_WINDOW + 1):
+        window = text[start:start + REPEAT_WINDOW]
+        if window in seen:
+            return True
+        seen.add(window)
+    return False
+
+def percentiles(values) -> dict:
+    """Nearest-rank percentiles, mean and max in milliseconds"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    summary = {f"p{p}": round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 2) for p in PERCENTILES}
+    summary["mean"] = round(sum(ordered) / len(ordered) * 1000, 2)
+    summary["max"] = round(ordered[-1] * 1000, 2)
+    return summary
+
+def parse_metrics(text: str) -> dict:
+    """Counter values from /metrics, keyed by (name, labels)"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        values[series] = float(value)
+    return values
+
+def metrics_delta(before: dict, after: dict) -> dict:
+    """Chat requests by source, upstream attempts by outcome, key rotations by reason
+    and cancelled requests by stage during a scenario"""
+    groups = (
+        ("chat_requests_total", "source", "request_sources"),
+        ("gemini_attempts_total", "outcome", "upstream_attempts"),
+        ("chat_key_rotations_total", "reason", "key_rotations"),
+        ("chat_requests_cancelled_total", "stage", "cancelled_requests")
+    )
+    delta = {group: {} for _, _, group in groups}
+    for series, value in after.items():
+        change = value - before.get(series, 0)
+        if not change:
+            continue
+        for name, field, group in groups:
+            if series.startswith(name + "{"):
+                label = series.split(f'{field}="', 1)[1].split('"', 1)[0]
+                delta[group][label] = delta[group].get(label, 0) + change
+    return delta
+
+async def wait_for_upstream_idle(admin: httpx.AsyncClient, fake_url: str, timeout: float) -> Optional[float]:
+    """Seconds until the fake has no response in progress, or None if that takes over timeout"""
+    started = time.perf_counter()
+    while True:
+        if (await admin.get(f"{fake_url}/_fake/stats")).json()["in_flight"] == 0:
+            return time.perf_counter() - started
+        if time.perf_counter() - started > timeout:
+            return None
+        await asyncio.sleep(0.01)
+
+async def run_scenario(name: str, scenario: dict, app_url: str, fake_url: str, seed: int) -> dict:
+    """Configure the fake, drive the scenario's requests and summarize them"""
+    async with httpx.AsyncClient(timeout=120) as admin:
+        await admin.post(f"{fake_url}/_fake/config", json={"seed": seed, **scenario.get("fake", {})})
+        # Start each scenario with every key available
+        await admin.get(f"{app_url}/reset-keys")
+        metrics_before = parse_metrics((await admin.get(f"{app_url}/metrics")).text)
+
+    rng = random.Random(f"{seed}:{name}")
+    requests = [build_request(scenario, index, rng) for index in range(scenario["requests"])]
+    semaphore = asyncio.Semaphore(scenario["concurrency"])
+    limits = httpx.Limits(max_connections=scenario["concurrency"], max_keepalive_connections=scenario["concurrency"])
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        async def limited(kwargs):
+            async with semaphore:
+                if not scenario.get("disconnect_after"):
+                    return await run_request(client, scenario, kwargs)
+                # Give up like a user closing the tab; cancelling the request closes its connection
+                try:
+                    return await asyncio.wait_for(
+                        run_request(client, scenario, kwargs), scenario["disconnect_after"]
+                    )
+                except asyncio.TimeoutError:
+                    return {
+                        "status": None, "latency": None, "ttft": None, "outcome": "disconnected",
+                        "timings": None, "images": 0, "text": "", "error_status": None
+                    }
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(kwargs) for kwargs in requests))
+        duration = time.perf_counter() - started
+
+    async with httpx.AsyncClient(timeout=30) as admin:
+        # Streams the app should have abandoned along with their clients
+        upstream_close = None
+        if scenario.get("disconnect_after"):
+            upstream_close = await wait_for_upstream_idle(admin, fake_url, STARTUP_TIMEOUT)
+        upstream = (await admin.get(f"{fake_url}/_fake/stats")).json()
+        metrics_after = parse_metrics((await admin.get(f"{app_url}/metrics")).text)
+
+    outcomes = {}
+    statuses = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    successful = [result for result in results if result["outcome"] == "ok"]
+
+    stages = {}
+    for result in successful:
+        for stage, value in (result["timings"] or {}).items():
+            stages.setdefault(stage, []).append(value)
+
+    return {
+        "scenario": name,
+        "description": scenario["description"],
+        "endpoint": scenario["endpoint"],
+        "requests": len(results),
+        "concurrency": scenario["concurrency"],
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(results) / duration, 2),
+        "successful_rps": round(len(successful) / duration, 2),
+        "outcomes": outcomes,
+        "status_codes": statuses,
+        "images_received": sum(result["images"] for result in results),
+        "latency_ms": percentiles([result["latency"] for result in successful]),
+        "ttft_ms": percentiles([result["ttft"] for result in successful if result["ttft"] is not None]),
+        "server_timing_mean_ms": {stage: round(sum(values) / len(values), 2) for stage, values in stages.items()},
+        "app_metrics": metrics_delta(metrics_before, metrics_after),
+        "upstream_close_ms": round(upstream_close * 1000, 2) if upstream_close is not None else None,
+        "repeated_text": sum(repeats_text(result["text"]) for result in results) if scenario.get("check_repeats") else None,
+        # Requests whose stream broke more times than the app resumes (RESUME_MAX_ATTEMPTS)
+        "resume_limit_502": sum(result["error_status"] == 502 for result in results),
+        "upstream": {
+            key: upstream[key] for key in ("requests", "by_status", "stream_breaks", "images", "max_in_flight")
+        }
+    }
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_until_up(url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with httpx.AsyncClient(timeout=2) as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up within {STARTUP_TIMEOUT}s")
+                await asyncio.sleep(0.2)
+
+def spawn_servers(app_rate_limits: bool):
+    """Start the fake and the app on free ports; returns their URLs and processes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    fake_port, app_port = free_port(), free_port()
+    # Their logs would drown the report, so they go to a file
+    log_path = os.path.join(tempfile.gettempdir(), "loadtest-servers.log")
+    log = open(log_path, "w")
+    print(f"Server output is logged to {log_path}")
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(here, "fake_gemini.py"), "--port", str(fake_port)],
+        stdout=log, stderr=subprocess.STDOUT
+    )
+
+    env = {**os.environ, "GEMINI_BASE_URL": f"http://127.0.0.1:{fake_port}"}
+    env.setdefault("BLOB_DIR", tempfile.mkdtemp(prefix="loadtest-blobs-"))
+    command = [sys.executable, os.path.abspath(__file__), "--serve-app", "--port", str(app_port)]
+    if app_rate_limits:
+        command.append("--app-rate-limits")
+    app = subprocess.Popen(command, env=env, cwd=here, stdout=log, stderr=subprocess.STDOUT)
+    return f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{fake_port}", [app, fake]
+
+def serve_app(port: int, app_rate_limits: bool):
+    """Run the app, by default without its own per-key rate limits so the fake's quota binds"""
+    if not app_rate_limits:
+        os.environ.setdefault("KEY_RPM_LIMIT", "1000000")
+    import app as chat_app
+    if not app_rate_limits:
+        for limits in list(chat_app.MODEL_RATE_LIMITS.values()) + [chat_app.DEFAULT_RATE_LIMIT]:
+            limits.update({"rpm": 1000000, "tpm": 10 ** 12})
+    import uvicorn
+    uvicorn.run(chat_app.app, host="127.0.0.1", port=port, log_level="warning")
+
+def print_summary(report: dict) -> bool:
+    """Print the results table; False if a scenario broke one of its bounds"""
+    passed = True
+    print(f"{'scenario':<18} {'req':>5} {'rps':>8} {'ok':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ttft p50':>9}")
+    for result in report["scenarios"]:
+        latency, ttft = result["latency_ms"], result["ttft_ms"]
+        print(
+            f"{result['scenario']:<18} {result['requests']:>5} {result['throughput_rps']:>8} "
+            f"{result['outcomes'].get('ok', 0):>5} {latency.get('p50', '-'):>9} {latency.get('p95', '-'):>9} "
+            f"{latency.get('p99', '-'):>9} {ttft.get('p50', '-'):>9}"
+        )
+        if "disconnect_after" in SCENARIOS[result["scenario"]]:
+            close_ms = result["upstream_close_ms"]
+            within_bound = close_ms is not None and close_ms <= DISCONNECT_CLOSE_BOUND * 1000
+            passed = passed and within_bound
+            print(
+                f"  {result['outcomes'].get('disconnected', 0)} clients disconnected; upstream streams closed "
+                f"{close_ms} ms after the last ({'ok' if within_bound else 'FAIL'}, "
+                f"bound {DISCONNECT_CLOSE_BOUND * 1000:.0f} ms)"
+            )
+        if SCENARIOS[result["scenario"]].get("distinct_prompts"):
+            print(
+                f"  {result['requests']} client requests for {SCENARIOS[result['scenario']]['distinct_prompts']} "
+                f"distinct prompts made {result['upstream']['requests']} upstream calls "
+                f"({result['app_metrics']['request_sources'].get('coalesced', 0):.0f} coalesced)"
+            )
+        if SCENARIOS[result["scenario"]].get("check_repeats"):
+            passed = passed and result["repeated_text"] == 0
+            print(
+                f"  {result['upstream']['stream_breaks']} upstream streams broke; "
+                f"{result['repeated_text']} answers repeated text ({'ok' if result['repeated_text'] == 0 else 'FAIL'}), "
+                f"{result['resume_limit_502']} hit the resume limit (502)"
+            )
+    return passed
+
+async def main(args) -> int:
+    processes = []
+    app_url, fake_url = args.app, args.fake
+    if args.spawn:
+        app_url, fake_url, processes = spawn_servers(args.app_rate_limits)
+    try:
+        await wait_until_up(f"{fake_url}/_fake/stats")
+        await wait_until_up(f"{app_url}/health")
+
+        report = {
+            "started_at": datetime.now().isoformat(),
+            "app": app_url,
+            "fake": fake_url,
+            "seed": args.seed,
+            "scenarios": []
+        }
+        for name in args.scenario or list(SCENARIOS):
+            scenario = dict(SCENARIOS[name])
+            if args.requests:
+                scenario["requests"] = args.requests
+            if args.concurrency:
+                scenario["concurrency"] = args.concurrency
+            print(f"Running {name}: {scenario['requests']} requests at concurrency {scenario['concurrency']}")
+            report["scenarios"].append(await run_scenario(name, scenario, app_url, fake_url, args.seed))
+
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        passed = print_summary(report)
+        print(f"Report written to {args.output}")
+        return 0 if passed else 1
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the chat app against the fake Gemini server")
+    parser.add_argument("--app", default="http://127.0.0.1:8000", help="Base URL of a running app")
+    parser.add_argument("--fake", default="http://127.0.0.1:8001", help="Base URL of a running fake_gemini.py")
+    parser.add_argument("--spawn", action="store_true", help="Start the fake and the app on free ports")
+    parser.add_argument("--app-rate-limits", action="store_true", help="Keep the app's own per-key rate limits when spawning it")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Run only these scenarios")
+    parser.add_argument("--requests", type=int, help="Override the number of requests per scenario")
+    parser.add_argument("--concurrency", type=int, help="Override the concurrency of every scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest-report.json")
+    parser.add_argument("--serve-app", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=8000, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_app:
+        serve_app(args.port, args.app_rate_limits)
+    else:
+        sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,198 @@
+"""Replay a traffic recording against the chat app and the fake Gemini server
+
+The app appends the shape of each chat request and the timing of its upstream calls
+to TRAFFIC_RECORD_FILE. This sends requests of the same shape (model, prompt and
+history length, image sizes, image output) at the recorded arrival times, while the
+fake answers each one's upstream calls with the recorded chunk timing, chunk sizes
+and errors. Requests that were identical in the recording are identical in the
+replay, so cache hits and coalescing happen again.
+
+    TRAFFIC_RECORD_FILE=traffic.jsonl uvicorn app:app    # record
+    python replay.py traffic.jsonl --spawn                # replay on free ports
+    python replay.py traffic.jsonl --app http://127.0.0.1:8000 --fake http://127.0.0.1:8001
+
+Gaps between requests longer than --max-gap are shortened, and --speed scales the
+whole timeline. The report compares recorded and replayed latency per source.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+from datetime import datetime
+import httpx
+import loadtest
+
+# Replayed requests are streamed and measured like the load test's
+REPLAY_SCENARIO = {"endpoint": "/chat/stream"}
+
+def load_recording(path: str, limit: int = None) -> list:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["t"])
+    return records[:limit] if limit else records
+
+def assign_ids(records: list):
+    """Give each record a replay id, shared by records with the same fingerprint, and
+    collect each id's upstream calls in the order they were made"""
+    ids = {}
+    scripts = {}
+    for index, record in enumerate(records):
+        fingerprint = record.get("fingerprint")
+        replay_id = ids.setdefault(fingerprint, f"r{index}") if fingerprint else f"r{index}"
+        record["replay_id"] = replay_id
+        for call in record.get("attempts", []):
+            # Calls still running when the request ended were abandoned by the app
+            scripts.setdefault(replay_id, []).append({
+                **call, "outcome": call["outcome"] or "released", "duration_ms": call["duration_ms"] or 0
+            })
+    return scripts
+
+def build_request(record: dict) -> dict:
+    """Keyword arguments for an httpx request shaped like the recorded one"""
+    marker = f"[replay:{record['replay_id']}] "
+    message = marker + "x" * max(0, record["prompt_chars"] - len(marker))
+    rng = random.Random(record["replay_id"])
+
+    history = []
+    turns = record["history_turns"]
+    for index in range(turns):
+        size = record["history_chars"] // turns + (1 if index < record["history_chars"] % turns else 0)
+        history.append({"role": "user" if index % 2 == 0 else "model", "text": "h" * size})
+
+    images = [
+        {"data": base64.b64encode(b"\x89PNG\r\n\x1a\n" + rng.randbytes(max(0, size - 8))).decode("ascii"), "mime_type": "image/png"}
+        for size in record["images"]
+    ]
+
+    payload = {"message": message, "model": record["model"], "history": history, "images": images}
+    if record["generate_image"]:
+        payload["generate_image"] = True
+    if record["temperature"] is not None:
+        payload["temperature"] = record["temperature"]
+    return {"json": payload}
+
+def schedule(records: list, speed: float, max_gap: float) -> list:
+    """Seconds after the start at which to send each record"""
+    offsets = []
+    elapsed = 0.0
+    for index, record in enumerate(records):
+        if index:
+            elapsed += min(record["t"] - records[index - 1]["t"], max_gap) / speed
+        offsets.append(elapsed)
+    return offsets
+
+def compare(records: list, results: list) -> dict:
+    """Recorded against replayed latency, overall and by how the app answered"""
+    groups = {}
+    for record, result in zip(records, results):
+        for group in ("all", record["source"]):
+            entry = groups.setdefault(group, {"recorded": [], "replayed": [], "status_mismatches": 0})
+            entry["recorded"].append(record["total_ms"] / 1000)
+            if result["outcome"] == "ok" or result["status"] == record["status"]:
+                entry["replayed"].append(result["latency"])
+            if (result["status"] or 0) != record["status"]:
+                entry["status_mismatches"] += 1
+    return {
+        group: {
+            "requests": len(entry["recorded"]),
+            "status_mismatches": entry["status_mismatches"],
+            "recorded_ms": loadtest.percentiles(entry["recorded"]),
+            "replayed_ms": loadtest.percentiles(entry["replayed"])
+        }
+        for group, entry in groups.items()
+    }
+
+async def replay(records: list, app_url: str, fake_url: str, speed: float, max_gap: float) -> dict:
+    scripts = assign_ids(records)
+    async with httpx.AsyncClient(timeout=120) as admin:
+        response = await admin.post(f"{fake_url}/_fake/config", json={"scripts": scripts})
+        response.raise_for_status()
+        await admin.get(f"{app_url}/reset-keys")
+
+    requests = [build_request(record) for record in records]
+    offsets = schedule(records, speed, max_gap)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(base_url=app_url, timeout=300, limits=limits) as client:
+        started = time.perf_counter()
+
+        async def send_at(offset, kwargs):
+            await asyncio.sleep(max(0, started + offset - time.perf_counter()))
+            return await loadtest.run_request(client, REPLAY_SCENARIO, kwargs)
+
+        results = await asyncio.gather(*(send_at(offset, kwargs) for offset, kwargs in zip(offsets, requests)))
+        duration = time.perf_counter() - started
+
+    async with httpx.AsyncClient(timeout=30) as admin:
+        upstream = (await admin.get(f"{fake_url}/_fake/stats")).json()
+
+    outcomes = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+    return {
+        "requests": len(records),
+        "duration_s": round(duration, 3),
+        "recorded_span_s": round(records[-1]["t"] - records[0]["t"], 3) if records else 0,
+        "outcomes": outcomes,
+        "latency": compare(records, results),
+        "upstream": {key: upstream[key] for key in ("requests", "scripted", "by_status", "stream_breaks", "images")}
+    }
+
+def print_summary(report: dict):
+    print(f"{'source':<12} {'req':>5} {'status !=':>9} {'rec p50':>9} {'rep p50':>9} {'rec p95':>9} {'rep p95':>9}")
+    for source, entry in report["latency"].items():
+        recorded, replayed = entry["recorded_ms"], entry["replayed_ms"]
+        print(
+            f"{source:<12} {entry['requests']:>5} {entry['status_mismatches']:>9} "
+            f"{recorded.get('p50', '-'):>9} {replayed.get('p50', '-'):>9} "
+            f"{recorded.get('p95', '-'):>9} {replayed.get('p95', '-'):>9}"
+        )
+
+async def main(args):
+    records = load_recording(args.recording, args.limit)
+    if not records:
+        raise SystemExit(f"No records in {args.recording}")
+
+    processes = []
+    app_url, fake_url = args.app, args.fake
+    if args.spawn:
+        app_url, fake_url, processes = loadtest.spawn_servers(args.app_rate_limits)
+    try:
+        await loadtest.wait_until_up(f"{fake_url}/_fake/stats")
+        await loadtest.wait_until_up(f"{app_url}/health")
+        print(f"Replaying {len(records)} requests from {args.recording}")
+        report = {
+            "started_at": datetime.now().isoformat(),
+            "recording": args.recording,
+            "app": app_url,
+            "fake": fake_url,
+            "speed": args.speed,
+            "max_gap": args.max_gap,
+            **await replay(records, app_url, fake_url, args.speed, args.max_gap)
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print_summary(report)
+        print(f"Report written to {args.output}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded chat traffic against the fake Gemini server")
+    parser.add_argument("recording", help="File written by the app with TRAFFIC_RECORD_FILE")
+    parser.add_argument("--app", default="http://127.0.0.1:8000", help="Base URL of a running app")
+    parser.add_argument("--fake", default="http://127.0.0.1:8001", help="Base URL of a running fake_gemini.py")
+    parser.add_argument("--spawn", action="store_true", help="Start the fake and the app on free ports")
+    parser.add_argument("--app-rate-limits", action="store_true", help="Keep the app's own per-key rate limits when spawning it")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="Longest pause (seconds) between requests")
+    parser.add_argument("--limit", type=int, help="Replay only the first N requests")
+    parser.add_argument("--output", default="replay-report.json")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,200 @@
+"""Simulate the API key scheduler against synthetic 429 patterns on a fake clock
+
+Drives app.KeyScheduler with Poisson request arrivals in simulated time, while an
+upstream model with its own per-key quotas answers each call with success or 429.
+Each request tries up to MAX_KEY_ATTEMPTS keys and waits up to KEY_WAIT_TIMEOUT for
+one, as the app does. The report gives throughput, 429s, requests that ran out of
+keys to try (degraded) or waited too long for one (timed out), and key wait.
+
+    python simulate_keys.py [--pattern random_429] [--minutes 10] [--rate 1.2] [--seed 1]
+
+The run also checks that no key is handed out for a model while it is cooling down
+after a 429, and exits non-zero if one is.
+"""
+import argparse
+import asyncio
+import heapq
+import math
+import os
+import random
+import sys
+from collections import deque
+
+# Blobs in memory only, so importing the app leaves nothing on disk
+os.environ.setdefault("BLOB_DIR", "")
+import app as chat_app
+
+MODEL = "gemini-2.0-flash-exp"
+
+# Simulation step, and how long a successful call holds its key
+TICK = 0.05
+SERVICE_TIME = 2.0
+
+# Upstream behaviour by pattern. real_rpm: what each key is really allowed per
+# minute (None means the configured limit); outages: (start, end, retry_after) in
+# seconds when every call gets 429; random_429: chance of a 429 without retry info
+PATTERNS = {
+    "steady": {"description": "Upstream quota matches the configured limits"},
+    "hidden_lower_quota": {
+        "description": "A third of the keys really allow only 4 requests a minute",
+        "real_rpm": lambda index: 4 if index % 3 == 0 else None,
+        "retry_after": 20
+    },
+    "burst_outage": {
+        "description": "Every key is rate limited for 45s twice, retry delay 15s",
+        "outages": [(120, 165, 15), (360, 405, 15)]
+    },
+    "random_429": {
+        "description": "5% of calls get a 429 with no retry delay",
+        "random_429": 0.05
+    }
+}
+
+class FakeClock:
+    """Stands in for the time module inside app, so the scheduler runs on simulated time"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+class Upstream:
+    """Decides whether a call is accepted, from sliding-window quotas per key"""
+
+    def __init__(self, pattern: dict, key_count: int, rng: random.Random):
+        configured = chat_app.MODEL_RATE_LIMITS[MODEL]["rpm"]
+        real_rpm = pattern.get("real_rpm", lambda index: None)
+        self.limits = [real_rpm(index) or configured for index in range(key_count)]
+        self.windows = [deque() for _ in range(key_count)]
+        self.pattern = pattern
+        self.rng = rng
+
+    def call(self, key_index: int, elapsed: float, now: float):
+        """None if the call is accepted, otherwise the retry delay (or -1 for none) of its 429"""
+        for start, end, retry_after in self.pattern.get("outages", []):
+            if start <= elapsed < end:
+                return retry_after
+        if self.rng.random() < self.pattern.get("random_429", 0):
+            return -1
+        window = self.windows[key_index]
+        while window and now - window[0] >= 60:
+            window.popleft()
+        if len(window) >= self.limits[key_index]:
+            return self.pattern.get("retry_after", -1)
+        window.append(now)
+        return None
+
+async def simulate(pattern_name: str, minutes: float, rate: float, key_count: int, seed: int) -> dict:
+    pattern = PATTERNS[pattern_name]
+    rng = random.Random(f"{seed}:{pattern_name}")
+    clock = FakeClock()
+    chat_app.time = clock
+    scheduler = chat_app.KeyScheduler(key_count)
+    upstream = Upstream(pattern, key_count, rng)
+    started = clock.now
+    duration = minutes * 60
+
+    arrivals = []
+    elapsed = 0.0
+    while True:
+        elapsed += rng.expovariate(rate)
+        if elapsed >= duration:
+            break
+        arrivals.append(elapsed)
+    arrivals.reverse()
+
+    waiting = []  # [arrived_at, tried keys]
+    completions = []  # (finishes_at, key index)
+    stats = {
+        "requests": len(arrivals), "served": 0, "degraded": 0, "timed_out": 0, "upstream_429": 0, "violations": 0
+    }
+    waits = []
+    # Model cooldowns as the upstream demanded them, to check the scheduler honours them
+    cooldowns = [0.0] * key_count
+
+    while clock.now - started < duration or waiting or completions:
+        elapsed = clock.now - started
+        while arrivals and arrivals[-1] <= elapsed:
+            waiting.append([arrivals.pop(), set()])
+        while completions and completions[0][0] <= clock.now:
+            _, key_index = heapq.heappop(completions)
+            scheduler.release(key_index, MODEL, "success", tokens_reserved=1500, tokens_used=1500)
+
+        still_waiting = []
+        for request in waiting:
+            arrived_at, tried = request
+            outcome = None
+            while outcome is None and len(tried) < min(chat_app.MAX_KEY_ATTEMPTS, key_count):
+                key_index = await scheduler.acquire(MODEL, 1500, exclude=tried, timeout=0)
+                if key_index is None:
+                    break
+                tried.add(key_index)
+                if clock.now < cooldowns[key_index]:
+                    stats["violations"] += 1
+                retry_after = upstream.call(key_index, elapsed, clock.now)
+                if retry_after is None:
+                    outcome = "served"
+                    heapq.heappush(completions, (clock.now + SERVICE_TIME, key_index))
+                else:
+                    stats["upstream_429"] += 1
+                    delay = retry_after if retry_after >= 0 else None
+                    # Without a delay the app picks a random cooldown of at least half the default
+                    cooldown = delay if delay is not None else chat_app.RATE_LIMIT_COOLDOWN / 2
+                    cooldowns[key_index] = clock.now + cooldown
+                    scheduler.release(
+                        key_index, MODEL, chat_app.ERROR_QUOTA, tokens_reserved=1500, retry_after=delay
+                    )
+            if outcome is None and len(tried) >= min(chat_app.MAX_KEY_ATTEMPTS, key_count):
+                # Every key it may try has failed it; the app answers with its busy message
+                outcome = "degraded"
+            if outcome is None and elapsed - arrived_at >= chat_app.KEY_WAIT_TIMEOUT:
+                outcome = "timed_out"
+            if outcome is None:
+                still_waiting.append(request)
+                continue
+            stats[outcome] += 1
+            if outcome == "served":
+                waits.append(elapsed - arrived_at)
+        waiting = still_waiting
+        clock.now += TICK
+
+    waits.sort()
+    stats.update({
+        "pattern": pattern_name,
+        "description": pattern["description"],
+        "served_per_minute": round(stats["served"] / minutes, 2),
+        "offered_per_minute": round(stats["requests"] / minutes, 2),
+        "capacity_per_minute": sum(upstream.limits),
+        "wait_p50_s": round(waits[max(0, math.ceil(0.5 * len(waits)) - 1)], 2) if waits else None,
+        "wait_p99_s": round(waits[max(0, math.ceil(0.99 * len(waits)) - 1)], 2) if waits else None
+    })
+    return stats
+
+async def main(args) -> int:
+    failed = False
+    print(
+        f"{'pattern':<20} {'offered/min':>11} {'capacity':>8} {'served/min':>10} {'429s':>6} "
+        f"{'degraded':>8} {'timed out':>9} {'wait p50':>8} {'wait p99':>8}"
+    )
+    for name in args.pattern or list(PATTERNS):
+        result = await simulate(name, args.minutes, args.rate, args.keys, args.seed)
+        print(
+            f"{name:<20} {result['offered_per_minute']:>11} {result['capacity_per_minute']:>8} "
+            f"{result['served_per_minute']:>10} {result['upstream_429']:>6} "
+            f"{result['degraded']:>8} {result['timed_out']:>9} "
+            f"{result['wait_p50_s']:>8} {result['wait_p99_s']:>8}"
+        )
+        if result["violations"]:
+            print(f"  FAIL: {result['violations']} calls went to a key still cooling down after a 429")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the key scheduler against synthetic 429 patterns")
+    parser.add_argument("--pattern", action="append", choices=list(PATTERNS), help="Run only these patterns")
+    parser.add_argument("--minutes", type=float, default=10, help="Simulated minutes per pattern")
+    parser.add_argument("--rate", type=float, default=1.2, help="Requests per simulated second")
+    parser.add_argument("--keys", type=int, default=9)
+    parser.add_argument("--seed", type=int, default=1)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,541 @@
+let uploadedImages = [];
+let lastMessageData = null;
+let retryCount = 0;
+let chatSocketReady = null;
+const pendingRequests = new Map();
+let conversationId = null;
+let modelMetadata = {};
+let defaultMaxImageDimension = 1536;
+let resizeWorker = null;
+const resizeJobs = new Map();
+
+// Per-model limits such as the longest image edge worth uploading
+fetch('/models')
+    .then(response => response.json())
+    .then(data => {
+        modelMetadata = data.metadata || {};
+        defaultMaxImageDimension = data.default_max_image_dimension || defaultMaxImageDimension;
+    })
+    .catch(() => {});
+
+function handleKeyPress(event) {
+    if (event.key === 'Enter' && !event.shiftKey) {
+        event.preventDefault();
+        sendMessage();
+    }
+}
+
+function handleFileSelect(event) {
+    const files = Array.from(event.target.files);
+
+    files.forEach(file => {
+        if (file && file.type.startsWith('image/')) {
+            // Keep the File itself; it is uploaded as a binary multipart part
+            uploadedImages.push({
+                file: file,
+                mimeType: file.type,
+                name: file.name,
+                preview: URL.createObjectURL(file),
+                id: Date.now() + Math.random() // Unique ID for each image
+            });
+        }
+    });
+    updateImagePreview();
+
+    // Clear the file input
+    event.target.value = '';
+}
+
+function updateImagePreview() {
+    const previewContainer = document.getElementById('uploadedImagesPreview');
+    const imagesGrid = document.getElementById('imagesGrid');
+    const imageCountBadge = document.getElementById('imageCountBadge');
+
+    if (uploadedImages.length > 0) {
+        previewContainer.classList.add('active');
+        imageCountBadge.style.display = 'inline-block';
+        imageCountBadge.textContent = uploadedImages.length;
+
+        // Clear and rebuild the grid
+        imagesGrid.innerHTML = '';
+
+        uploadedImages.forEach((image, index) => {
+            const imageItem = document.createElement('div');
+            imageItem.className = 'image-preview-item';
+            imageItem.innerHTML = `
+                <img src="${image.preview}" alt="${image.name}" title="${image.name}">
+                <button class="remove-image-btn" onclick="removeImage(${index})" title="Remove image">×</button>
+            `;
+            imagesGrid.appendChild(imageItem);
+        });
+    } else {
+        previewContainer.classList.remove('active');
+        imageCountBadge.style.display = 'none';
+        imagesGrid.innerHTML = '';
+    }
+}
+
+function removeImage(index) {
+    uploadedImages.splice(index, 1);
+    updateImagePreview();
+}
+
+function clearAllImages() {
+    uploadedImages = [];
+    updateImagePreview();
+}
+
+function saveLastMessage(message, images, model, generateImage) {
+    lastMessageData = {
+        message: message,
+        images: [...images], // Create a copy
+        model: model,
+        generateImage: generateImage,
+        timestamp: Date.now()
+    };
+
+    // Show restore button
+    document.getElementById('restoreButton').classList.add('active');
+}
+
+function restoreLastMessage() {
+    if (!lastMessageData) return;
+
+    // Restore text
+    document.getElementById('chatInput').value = lastMessageData.message;
+
+    // Restore images
+    uploadedImages = [...lastMessageData.images];
+    updateImagePreview();
+
+    // Restore model
+    document.getElementById('modelSelect').value = lastMessageData.model;
+
+    // Restore generate image checkbox
+    document.getElementById('generateImageCheck').checked = lastMessageData.generateImage;
+
+    // Hide restore button after restoring
+    document.getElementById('restoreButton').classList.remove('active');
+}
+
+async function sendMessage(isRetry = false) {
+    const input = document.getElementById('chatInput');
+    const message = input.value.trim();
+    const selectedModel = document.getElementById('modelSelect').value;
+    const generateImage = document.getElementById('generateImageCheck').checked;
+
+    if (!message && uploadedImages.length === 0) return;
+
+    const sendButton = document.getElementById('sendButton');
+    sendButton.disabled = true;
+
+    // Save message data before sending (for retry functionality)
+    if (!isRetry) {
+        saveLastMessage(message, uploadedImages, selectedModel, generateImage);
+        retryCount = 0;
+
+        // Add user message to chat with all uploaded images
+        const userImagePreviews = uploadedImages.map(img => img.preview);
+        addMessage(message, 'user', userImagePreviews, null, selectedModel);
+    } else {
+        retryCount++;
+    }
+
+    // Keep the images to send; clearing the preview below empties uploadedImages
+    const images = [...uploadedImages];
+
+    // Clear input and images (only if not retrying)
+    if (!isRetry) {
+        input.value = '';
+        clearAllImages();
+        document.getElementById('generateImageCheck').checked = false;
+    }
+
+    // Show typing indicator
+    document.getElementById('typingIndicator').classList.add('active');
+
+    try {
+        // Images are downscaled for the model first, then uploaded once and referenced by
+        // handle, so retries only resend the handles
+        const maxEdge = (modelMetadata[selectedModel] || {}).max_image_dimension || defaultMaxImageDimension;
+        const handles = await Promise.all(images.map(
+            async image => uploadImageBlob(await prepareImage(image, maxEdge))
+        ));
+        const payload = {
+            message: message,
+            model: selectedModel,
+            generate_image: generateImage,
+            conversation_id: conversationId,
+            images: handles.map(handle => ({ handle: handle }))
+        };
+        const renderer = createResponseRenderer(selectedModel);
+
+        // Requests go over the shared WebSocket when it's up, else as an SSE POST
+        const socket = await connectChatSocket().catch(() => null);
+        let done;
+        if (socket) {
+            done = await sendOverSocket(socket, payload, renderer);
+        } else {
+            const response = await fetch('/chat/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(payload)
+            });
+
+            if (!response.ok) {
+                const error = await response.text();
+                throw new Error(error || 'Failed to get response');
+            }
+
+            // Render the assistant response incrementally as events arrive
+            done = await readChatStream(response, renderer);
+        }
+
+        // Follow-up messages continue the same conversation
+        conversationId = done.conversation_id || conversationId;
+
+        // Clear saved message data on success
+        lastMessageData = null;
+        document.getElementById('restoreButton').classList.remove('active');
+
+        // Clear input if it was a retry
+        if (isRetry) {
+            input.value = '';
+            clearAllImages();
+            document.getElementById('generateImageCheck').checked = false;
+        }
+
+    } catch (error) {
+        console.error('Error:', error);
+
+        // Add error message to chat with retry button
+        addErrorMessage(error.message, selectedModel);
+
+    } finally {
+        document.getElementById('typingIndicator').classList.remove('active');
+        sendButton.disabled = false;
+    }
+}
+
+function resizeWorkerMain() {
+    // Runs in a Web Worker: decode, downscale and re-encode off the UI thread
+    self.onmessage = async event => {
+        const { id, file, maxEdge } = event.data;
+        try {
+            const bitmap = await createImageBitmap(file);
+            const scale = Math.min(1, maxEdge / Math.max(bitmap.width, bitmap.height));
+            if (scale === 1) {
+                bitmap.close();
+                self.postMessage({ id: id, blob: null });
+                return;
+            }
+
+            const canvas = new OffscreenCanvas(Math.round(bitmap.width * scale), Math.round(bitmap.height * scale));
+            const context = canvas.getContext('2d');
+            context.imageSmoothingQuality = 'high';
+            context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+            bitmap.close();
+
+            // WebP keeps transparency; browsers that can't encode it fall back to PNG,
+            // in which case opaque formats are better off as JPEG
+            let blob = await canvas.convertToBlob({ type: 'image/webp', quality: 0.85 });
+            if (blob.type !== 'image/webp' && file.type !== 'image/png') {
+                blob = await canvas.convertToBlob({ type: 'image/jpeg', quality: 0.85 });
+            }
+            self.postMessage({ id: id, blob: blob.size < file.size ? blob : null });
+        } catch (error) {
+            self.postMessage({ id: id, error: error.message });
+        }
+    };
+}
+
+function resizeImage(file, maxEdge) {
+    // Without worker canvas support the original is uploaded unchanged
+    if (!window.Worker || !window.OffscreenCanvas || !window.createImageBitmap) {
+        return Promise.resolve(file);
+    }
+    if (!resizeWorker) {
+        const source = '(' + resizeWorkerMain.toString() + ')()';
+        resizeWorker = new Worker(URL.createObjectURL(new Blob([source], { type: 'text/javascript' })));
+        resizeWorker.onmessage = event => {
+            const job = resizeJobs.get(event.data.id);
+            resizeJobs.delete(event.data.id);
+            if (event.data.error) job.reject(new Error(event.data.error));
+            else job.resolve(event.data.blob);
+        };
+    }
+
+    const id = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    return new Promise((resolve, reject) => {
+        resizeJobs.set(id, { resolve: resolve, reject: reject });
+        resizeWorker.postMessage({ id: id, file: file, maxEdge: maxEdge });
+    }).then(blob => blob ? new File([blob], file.name, { type: blob.type }) : file);
+}
+
+function prepareImage(image, maxEdge) {
+    // Resized copies are kept per target size so retries reuse the same bytes and handle
+    image.variants = image.variants || {};
+    if (!image.variants[maxEdge]) {
+        image.variants[maxEdge] = Promise.resolve()
+            .then(() => resizeImage(image.file, maxEdge))
+            .catch(() => image.file)
+            .then(file => ({ file: file, name: image.name }));
+    }
+    return image.variants[maxEdge];
+}
+
+async function uploadImageBlob(image) {
+    // Hash locally (where available) and skip the upload if the server already has the blob
+    if (!image.handle && window.crypto && crypto.subtle) {
+        const digest = await crypto.subtle.digest('SHA-256', await image.file.arrayBuffer());
+        image.handle = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    }
+    if (image.handle) {
+        const check = await fetch('/blobs/' + image.handle, { method: 'HEAD' });
+        if (check.ok) return image.handle;
+    }
+
+    const formData = new FormData();
+    formData.append('file', image.file, image.name);
+    const response = await fetch('/blobs', {
+        method: 'POST',
+        body: formData
+    });
+    if (!response.ok) {
+        const error = await response.text();
+        throw new Error(error || 'Failed to upload image');
+    }
+    image.handle = (await response.json()).handle;
+    return image.handle;
+}
+
+function createResponseRenderer(model) {
+    let text = '';
+    const images = [];
+    let messageDiv = null;
+
+    function render() {
+        if (!messageDiv) {
+            document.getElementById('typingIndicator').classList.remove('active');
+            messageDiv = addMessage(text, 'assistant', null, images, model);
+        } else {
+            updateMessage(messageDiv, text, 'assistant', null, images, model);
+        }
+    }
+
+    return {
+        // Returns true once the response is complete, throws if it failed
+        handle(event) {
+            if (event.type === 'text') {
+                text += event.text;
+                render();
+            } else if (event.type === 'image') {
+                images.push(event.url);
+                render();
+            } else if (event.type === 'error' || event.type === 'cancelled') {
+                throw new Error(event.detail || 'Failed to get response');
+            } else if (event.type === 'done') {
+                return true;
+            }
+            return false;
+        },
+        // Drop the partial answer; the error message offers a retry instead
+        discard() {
+            if (messageDiv) messageDiv.remove();
+        }
+    };
+}
+
+async function readChatStream(response, renderer) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    try {
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // SSE frames are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                const dataLine = frame.split('\n').find(line => line.startsWith('data: '));
+                if (!dataLine) continue;
+                const event = JSON.parse(dataLine.slice(6));
+                if (renderer.handle(event)) return event;
+            }
+        }
+        throw new Error('Connection closed before the response finished');
+    } catch (error) {
+        renderer.discard();
+        throw error;
+    }
+}
+
+function connectChatSocket() {
+    if (chatSocketReady) return chatSocketReady;
+
+    chatSocketReady = new Promise((resolve, reject) => {
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(protocol + '//' + window.location.host + '/ws');
+
+        socket.onopen = () => resolve(socket);
+        socket.onmessage = (e) => {
+            const event = JSON.parse(e.data);
+            const handler = pendingRequests.get(event.id);
+            if (handler) handler(event);
+        };
+        socket.onclose = () => {
+            chatSocketReady = null;
+            reject(new Error('WebSocket unavailable'));
+
+            // Fail anything still in flight so it can be retried
+            pendingRequests.forEach(handler => handler({ type: 'error', detail: 'Connection lost' }));
+            pendingRequests.clear();
+        };
+    });
+    return chatSocketReady;
+}
+
+function sendOverSocket(socket, payload, renderer) {
+    const id = Date.now().toString(36) + Math.random().toString(36).slice(2);
+
+    return new Promise((resolve, reject) => {
+        pendingRequests.set(id, event => {
+            try {
+                if (renderer.handle(event)) {
+                    pendingRequests.delete(id);
+                    resolve(event);
+                }
+            } catch (error) {
+                pendingRequests.delete(id);
+                renderer.discard();
+                reject(error);
+            }
+        });
+        socket.send(JSON.stringify({ type: 'chat', id: id, ...payload }));
+    });
+}
+
+function addErrorMessage(errorText, model) {
+    const messagesContainer = document.getElementById('chatMessages');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message error';
+
+    let content = '<div class="message-content">';
+    content += '<div class="error-badge">Error</div>';
+    content += '<div>' + escapeHtml(errorText || 'Failed to send message. Please try again.') + '</div>';
+    content += `<button class="retry-button" onclick="retryLastMessage()" ${retryCount >= 3 ? 'disabled' : ''}>
+                ${retryCount >= 3 ? 'Max retries reached' : '🔄 Try Again (Attempt ' + (retryCount + 1) + '/3)'}
+               </button>`;
+    content += '</div>';
+
+    messageDiv.innerHTML = content;
+    messagesContainer.appendChild(messageDiv);
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+}
+
+function retryLastMessage() {
+    if (!lastMessageData || retryCount >= 3) return;
+
+    // Remove the last error message
+    const messages = document.getElementById('chatMessages');
+    const errorMessages = messages.querySelectorAll('.message.error');
+    if (errorMessages.length > 0) {
+        errorMessages[errorMessages.length - 1].remove();
+    }
+
+    // Restore the message data
+    document.getElementById('chatInput').value = lastMessageData.message;
+    uploadedImages = [...lastMessageData.images];
+    updateImagePreview();
+    document.getElementById('modelSelect').value = lastMessageData.model;
+    document.getElementById('generateImageCheck').checked = lastMessageData.generateImage;
+
+    // Retry sending
+    sendMessage(true);
+}
+
+function addMessage(text, sender, uploadedImages = null, generatedImages = null, model = null) {
+    const messagesContainer = document.getElementById('chatMessages');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message ' + sender;
+
+    messageDiv.innerHTML = buildMessageContent(text, sender, uploadedImages, generatedImages, model);
+    messagesContainer.appendChild(messageDiv);
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    return messageDiv;
+}
+
+function updateMessage(messageDiv, text, sender, uploadedImages = null, generatedImages = null, model = null) {
+    const messagesContainer = document.getElementById('chatMessages');
+    messageDiv.innerHTML = buildMessageContent(text, sender, uploadedImages, generatedImages, model);
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+}
+
+function buildMessageContent(text, sender, uploadedImages = null, generatedImages = null, model = null) {
+    let content = '<div class="message-content">';
+
+    // Add model badge for assistant messages
+    if (sender === 'assistant' && model) {
+        content += '<div class="model-badge">' + model + '</div>';
+    }
+
+    if (text) {
+        content += '<div>' + escapeHtml(text) + '</div>';
+    }
+
+    // Display uploaded images
+    if (uploadedImages && uploadedImages.length > 0) {
+        if (uploadedImages.length === 1) {
+            content += '<img src="' + uploadedImages[0] + '" class="message-image" onclick="openImage(this.src)" />';
+        } else {
+            content += '<div class="image-gallery">';
+            uploadedImages.forEach(img => {
+                content += '<img src="' + img + '" onclick="openImage(this.src)" />';
+            });
+            content += '</div>';
+        }
+    }
+
+    // Display generated images
+    if (generatedImages && generatedImages.length > 0) {
+        if (generatedImages.length === 1) {
+            content += '<img src="' + generatedImages[0] + '" class="message-image" onclick="openImage(this.src)" />';
+        } else {
+            content += '<div class="image-gallery">';
+            generatedImages.forEach(img => {
+                content += '<img src="' + img + '" onclick="openImage(this.src)" />';
+            });
+            content += '</div>';
+        }
+    }
+
+    content += '</div>';
+    return content;
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+function openImage(src) {
+    window.open(src, '_blank');
+}
+
+function showError(message) {
+    const errorDiv = document.getElementById('errorMessage');
+    errorDiv.textContent = message;
+    errorDiv.style.display = 'block';
+    setTimeout(() => {
+        errorDiv.style.display = 'none';
+    }, 5000);
+}